@@ -86,8 +86,9 @@ client_contexts = {}  # Client contexts
 speech_token = None  # Speech token
 ice_token = None  # ICE token
 
-# --- REMOVED: Global initialization of GroceryConciergeApp ---
-# grocery_concierge_app = None
+# Process-wide GroceryConciergeApp (vector store, DB pool, LLM clients), shared by every client
+grocery_concierge_app = None
+grocery_concierge_app_lock = threading.Lock()
 
 # Original AzureOpenAI client - keep if needed for other features, otherwise remove
 if azure_openai_endpoint and azure_openai_api_key:
@@ -104,32 +105,34 @@ if enable_vad and enable_websockets:
     vad_model, _ = torch.hub.load(repo_or_dir='snakers4/silero-vad', model='silero_vad')
     vad_iterator = VADIterator(model=vad_model, threshold=0.5, sampling_rate=16000, min_silence_duration_ms=150, speech_pad_ms=100)
 
-# --- REMOVED: Function to initialize the GroceryConciergeApp globally ---
-# def initialize_grocery_concierge():
-#     global grocery_concierge_app
-#     if grocery_concierge_app is None:
-#         grocery_concierge_app = GroceryConciergeApp()
-#         grocery_concierge_app.initialize_backend()
-#         print("GroceryConciergeApp backend initialized.")
+# Get the shared GroceryConciergeApp, initializing its backend on first use.
+# Clients only hold a ConciergeSession (chat history and settings) created from it.
+def getGroceryConcierge() -> GroceryConciergeApp:
+    global grocery_concierge_app
+    if grocery_concierge_app is None:
+        with grocery_concierge_app_lock:
+            if grocery_concierge_app is None:
+                concierge_app = GroceryConciergeApp()
+                concierge_app.initialize_backend()
+                grocery_concierge_app = concierge_app
+                print("GroceryConciergeApp backend initialized.")
+    return grocery_concierge_app
 
 # The default route, which shows the default web page (basic.html)
 @app.route("/")
 def index():
-    # REMOVED: Call to global initialize_grocery_concierge
     return render_template("basic.html", methods=["GET"], client_id=initializeClient())
 
 
 # The basic route, which shows the basic web page
 @app.route("/basic")
 def basicView():
-    # REMOVED: Call to global initialize_grocery_concierge
     return render_template("basic.html", methods=["GET"], client_id=initializeClient())
 
 
 # The chat route, which shows the chat web page
 @app.route("/chat")
 def chatView():
-    # REMOVED: Call to global initialize_grocery_concierge
     return render_template("chat.html", methods=["GET"], client_id=initializeClient(), enable_websockets=enable_websockets)
 
 
@@ -157,6 +160,21 @@ def getIceToken() -> Response:
     return Response(ice_token, status=200)
 
 
+# The API route to get the concierge pipeline metrics: stage latencies, retries, cache hit rates
+# and token counts, in Prometheus text format or, with ?format=json, as a JSON summary
+@app.route("/api/metrics", methods=["GET"])
+def getMetrics() -> Response:
+    as_json = request.args.get('format') == 'json'
+    # Scraping must not initialize the backend, so nothing is reported until the first page load
+    if grocery_concierge_app is None:
+        metrics = '{}' if as_json else ''
+    elif as_json:
+        metrics = json.dumps(grocery_concierge_app.metrics_summary())
+    else:
+        metrics = grocery_concierge_app.metrics_prometheus()
+    return Response(metrics, status=200, mimetype='application/json' if as_json else 'text/plain; version=0.0.4')
+
+
 # The API route to get the status of server
 @app.route("/api/getStatus", methods=["GET"])
 def getStatus() -> Response:
@@ -376,13 +394,12 @@ def connectSTT() -> Response:
                         client_context['chat_initiated'] = True
                     first_response_chunk = True
                     
-                    # --- MODIFIED: Call your client-specific GroceryConciergeApp for response ---
-                    concierge_response = client_context['grocery_concierge_instance'].process_user_question(user_query)
-                    
-                    if first_response_chunk:
-                        socketio.emit("response", {'path': 'api.chat', 'chatResponse': 'Assistant: '}, room=client_id)
-                        first_response_chunk = False
-                    socketio.emit("response", {'path': 'api.chat', 'chatResponse': concierge_response}, room=client_id)
+                    # --- MODIFIED: Stream the GroceryConciergeApp response for this client's session ---
+                    for chat_response in handleUserQuery(user_query, client_id):
+                        if first_response_chunk:
+                            socketio.emit("response", {'path': 'api.chat', 'chatResponse': 'Assistant: '}, room=client_id)
+                            first_response_chunk = False
+                        socketio.emit("response", {'path': 'api.chat', 'chatResponse': chat_response}, room=client_id)
                     # --- END MODIFIED ---
 
                 except Exception as e:
@@ -450,14 +467,8 @@ def chat() -> Response:
         client_context['chat_initiated'] = True
     user_query = request.data.decode('utf-8')
     
-    # --- MODIFIED: Call your client-specific GroceryConciergeApp for response ---
-    concierge_response = client_context['grocery_concierge_instance'].process_user_question(user_query)
-    # Speak the response
-    try:
-        speakWithQueue(concierge_response, 0, client_id)
-    except Exception as e:
-        print(f"Error in speaking response: {e}")
-    return Response(concierge_response, mimetype='text/plain', status=200)
+    # --- MODIFIED: Stream the GroceryConciergeApp response for this session, spoken sentence by sentence ---
+    return Response(handleUserQuery(user_query, client_id), mimetype='text/plain', status=200)
     # --- END MODIFIED ---
 
 
@@ -480,10 +491,10 @@ def continueSpeaking() -> Response:
 def clearChatHistory() -> Response:
     client_id = uuid.UUID(request.headers.get('ClientId'))
     client_context = client_contexts[client_id]
-    # To clear the chat history for a specific client, we'll reset its GroceryConciergeApp instance's history.
+    # Clear the backend history of this client's session; the shared backend is untouched.
     # Note: If initializeChatContext also manages this, ensure it's consistent.
-    if 'grocery_concierge_instance' in client_context:
-        client_context['grocery_concierge_instance'].chat_history.clear() # Clear backend history
+    if 'concierge_session' in client_context:
+        client_context['concierge_session'].chat_history.clear() # Clear backend history
     initializeChatContext(request.headers.get('SystemPrompt'), client_id) # This clears client-side 'messages'
     client_context['chat_initiated'] = True
     return Response('Chat history cleared.', status=200)
@@ -507,9 +518,9 @@ def releaseClient() -> Response:
     try:
         disconnectAvatarInternal(client_id, False)
         disconnectSttInternal(client_id)
-        # Explicitly remove the GroceryConciergeApp instance
-        if 'grocery_concierge_instance' in client_contexts[client_id]:
-            del client_contexts[client_id]['grocery_concierge_instance']
+        # Explicitly remove the client's concierge session
+        if 'concierge_session' in client_contexts[client_id]:
+            del client_contexts[client_id]['concierge_session']
         time.sleep(2)  # Wait some time for the connection to close
         client_contexts.pop(client_id)
         print(f"Client context released for client {client_id}.")
@@ -559,26 +570,18 @@ def handleWsMessage(message):
 
         user_query = message.get('userQuery')
 
-        # --- MODIFIED: Call client-specific GroceryConciergeApp instance ---
-        concierge_response = client_context['grocery_concierge_instance'].process_user_question(user_query)
-
-        # Send the response in chunks (first the "Assistant: " prefix, then the actual response)
+        # --- MODIFIED: Stream the GroceryConciergeApp response for this client's session ---
+        # Send the response in chunks (first the "Assistant: " prefix, then the tokens as they are generated)
         socketio.emit("response", {'path': 'api.chat', 'chatResponse': 'Assistant: '}, room=client_id)
-        socketio.emit("response", {'path': 'api.chat', 'chatResponse': concierge_response}, room=client_id)
-
-        # Speak the response
-        try:
-            speakWithQueue(concierge_response, 0, client_id)
-        except Exception as e:
-            print(f"Error in speaking response: {e}")
+        for chat_response in handleUserQuery(user_query, client_id):
+            socketio.emit("response", {'path': 'api.chat', 'chatResponse': chat_response}, room=client_id)
 
 # Initialize the client by creating a client id and an initial context
 def initializeClient() -> uuid.UUID:
     client_id = uuid.uuid4()
-    
-    # Initialize a new GroceryConciergeApp instance for this client
-    client_grocery_concierge_app = GroceryConciergeApp()
-    client_grocery_concierge_app.initialize_backend() # Initialize its backend components
+
+    # Only the per-client conversation state is created here; the backend is shared
+    concierge_session = getGroceryConcierge().new_session()
 
     client_contexts[client_id] = {
         'audio_input_stream': None,  # Audio input stream for speech recognition
@@ -603,7 +606,7 @@ def initializeClient() -> uuid.UUID:
         'spoken_text_queue': [],  # Queue to store the spoken text
         'speaking_thread': None,  # The thread to speak the spoken text queue
         'last_speak_time': None,  # The last time the avatar spoke
-        'grocery_concierge_instance': client_grocery_concierge_app # Store the client-specific instance
+        'concierge_session': concierge_session # Chat history and settings of this client
     }
     return client_id
 
@@ -710,7 +713,7 @@ def initializeChatContext(system_prompt: str, client_id: uuid.UUID) -> None:
 
 # Handle the user query and return the assistant reply. For chat scenario.
 # The function is a generator, which yields the assistant reply in chunks.
-# --- MODIFIED: This function now calls your client-specific GroceryConciergeApp instance ---
+# --- MODIFIED: This function now calls the shared GroceryConciergeApp with the client's session ---
 def handleUserQuery(user_query: str, client_id: uuid.UUID):
     client_context = client_contexts[client_id]
     
@@ -726,15 +729,34 @@ def handleUserQuery(user_query: str, client_id: uuid.UUID):
         speakWithQueue(random.choice(quick_replies), 2000, client_id)
 
     # Call your integrated backend to process the user question
-    # The `process_user_question` method in GroceryConciergeApp returns the final string answer.
+    # `process_user_question_stream` yields the answer token by token. Each completed sentence
+    # is queued for the avatar right away, so it starts speaking before the answer is complete.
     try:
-        concierge_response = client_context['grocery_concierge_instance'].process_user_question(user_query)
-        
-        # Yield the response as a single chunk.
-        # If your frontend expects streaming, you would need to modify
-        # `GroceryConciergeApp.process_user_question` to be a generator
-        # and yield chunks, then iterate here.
-        yield concierge_response
+        chat_start_time = datetime.datetime.now(pytz.UTC)
+        is_first_chunk = True
+        is_first_sentence = True
+        spoken_sentence = ''
+        for response_token in getGroceryConcierge().process_user_question_stream(user_query, client_context['concierge_session']):
+            if is_first_chunk:
+                first_token_latency_ms = round((datetime.datetime.now(pytz.UTC) - chat_start_time).total_seconds() * 1000)
+                print(f"Concierge first token latency: {first_token_latency_ms}ms")
+                yield f"<FTL>{first_token_latency_ms}</FTL>"
+                is_first_chunk = False
+
+            spoken_sentence += response_token.replace('\n', ' ')
+            if response_token.strip()[-1:] in sentence_level_punctuations or '\n' in response_token:
+                if spoken_sentence.strip():
+                    if is_first_sentence:
+                        first_sentence_latency_ms = round((datetime.datetime.now(pytz.UTC) - chat_start_time).total_seconds() * 1000)
+                        print(f"Concierge first sentence latency: {first_sentence_latency_ms}ms")
+                        yield f"<FSL>{first_sentence_latency_ms}</FSL>"
+                        is_first_sentence = False
+                    speakWithQueue(spoken_sentence.strip(), 0, client_id)
+                spoken_sentence = ''
+            yield response_token
+
+        if spoken_sentence.strip():
+            speakWithQueue(spoken_sentence.strip(), 0, client_id)
 
         # Update chat history for display if needed (not for LLM input anymore)
         # client_context['messages'].append({'role': 'user', 'content': user_query})
@@ -862,7 +884,6 @@ iceTokenRefreshThread.start()
 # --- MODIFIED: Main entry point to run the Flask app with SocketIO ---
 # This ensures the web server starts and listens for incoming requests.
 if __name__ == "__main__":
-    # REMOVED: Global initialization of the backend
-    # initialize_grocery_concierge()
+    # The shared backend is initialized by the first page load, see getGroceryConcierge()
     # Run the Flask app with SocketIO
     socketio.run(app, debug=True, allow_unsafe_werkzeug=True) # debug=True for development, allow_unsafe_werkzeug=True for older Werkzeug versions
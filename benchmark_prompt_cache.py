@@ -0,0 +1,81 @@
+"""
+Time-to-first-token benchmark for Ollama prompt prefix reuse.
+Streams the SQL prompt of every business question to Ollama and measures
+the time until the first generated token, with and without reuse of the
+cached prompt prefix. Without reuse, every prompt starts with a unique
+line, which forces Ollama to evaluate the whole prompt again. With reuse,
+consecutive prompts share their static instructions (and the schema, when
+it is not pruned), so only the tail is evaluated.
+
+Usage:
+    ollama serve & ollama pull llama3.2
+    python benchmark_prompt_cache.py --model llama3.2 --repeats 3
+"""
+
+import argparse
+import json
+import time
+import uuid
+from typing import List, Dict, Any
+
+import numpy as np
+import requests
+
+from grocery_concierge_backend import LLMService, OLLAMA_KEEP_ALIVE
+from benchmark_sql_prompt import build_prompts
+
+
+def time_to_first_token(host: str, model: str, prompt: str) -> Dict[str, float]:
+    """Streams one prompt and returns the milliseconds until the first token and the prompt tokens evaluated."""
+    start = time.perf_counter()
+    ttft_ms, evaluated = None, 0
+    with requests.post(f"{host}/api/generate", json={
+        "model": model, "prompt": prompt, "stream": True, "raw": True, "keep_alive": OLLAMA_KEEP_ALIVE,
+        "options": {"num_predict": 8}
+    }, stream=True, timeout=600) as response:
+        response.raise_for_status()
+        for line in response.iter_lines():
+            if not line:
+                continue
+            chunk = json.loads(line)
+            if ttft_ms is None and chunk.get("response"):
+                ttft_ms = (time.perf_counter() - start) * 1000
+            if chunk.get("done"):
+                evaluated = chunk.get("prompt_eval_count", 0)
+    return {"ttft_ms": ttft_ms if ttft_ms is not None else (time.perf_counter() - start) * 1000, "evaluated": evaluated}
+
+
+def benchmark_variant(name: str, prompts: List[str], reuse: bool, args: argparse.Namespace) -> Dict[str, Any]:
+    latencies, evaluated = [], []
+    for _ in range(args.repeats):
+        for prompt in prompts:
+            if not reuse:
+                prompt = f"Request {uuid.uuid4().hex}\n{prompt}"
+            result = time_to_first_token(args.host, args.model, prompt)
+            latencies.append(result["ttft_ms"])
+            evaluated.append(result["evaluated"])
+    return {"variant": name, "evaluated": np.mean(evaluated),
+            "p50_ms": np.percentile(latencies, 50), "p95_ms": np.percentile(latencies, 95)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="http://localhost:11434")
+    parser.add_argument("--model", default="llama3.2")
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    llm_service = LLMService(sql_llm_model=args.model, chat_llm_model=args.model)
+    time_to_first_token(args.host, args.model, "Hello") # Load the model before measuring
+
+    print(f"{'variant':>16} {'eval tok':>9} {'p50 ms':>9} {'p95 ms':>9}")
+    for schema, prune in (("full", False), ("pruned", True)):
+        prompts = build_prompts(llm_service, prune)
+        for reuse in (False, True):
+            name = f"{schema}/{'reuse' if reuse else 'no reuse'}"
+            row = benchmark_variant(name, prompts, reuse, args)
+            print(f"{row['variant']:>16} {row['evaluated']:>9.0f} {row['p50_ms']:>9.1f} {row['p95_ms']:>9.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,455 @@
+"""
+Offline replay benchmark for the whole concierge pipeline.
+Replays a recorded question set through GroceryConciergeApp.process_user_question
+(or process_user_question_async with --async), with every external service
+replaced by a local stand-in:
+
+- Ollama: a fake HTTP server for /api/generate and /api/embed with a configurable
+  time to first token and tokens per second. SQL prompts are answered with the
+  recorded query of the question, chat prompts with filler text, and embeddings
+  are bag-of-words vectors, so reworded questions land close to each other.
+- Redis: a local Redis Stack. The benchmark uses its own index and key prefix and
+  clears them, its learned examples and the query embedding cache before each run.
+- Azure SQL: a SQLite copy of the supermarket schema filled with synthetic rows,
+  behind the real connection pool. Queries are translated with translate_tsql_to_sqlite.
+
+Reports per-stage p50/p99, requests per second and memory. --save writes the
+results as JSON and --baseline compares the run with saved results.
+
+A question set is a JSON lines file of {"question": ..., "sql": ...} objects;
+"sql" is what the fake SQL model answers. By default every example question is
+replayed as asked and reworded.
+
+Usage:
+    docker run -d -p 6379:6379 redis/redis-stack-server:latest
+    python benchmark_replay.py --passes 2 --concurrency 4 --save baseline.json
+    python benchmark_replay.py --passes 2 --concurrency 4 --baseline baseline.json
+"""
+
+import argparse
+import asyncio
+import contextlib
+import datetime
+import json
+import os
+import random
+import re
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import List, Dict, Any
+
+import numpy as np
+import pyodbc
+import redis
+
+import grocery_concierge_backend as backend
+from grocery_concierge_backend import (
+    BUSINESS_QUESTIONS_DATA, TABLE_DESCRIPTIONS, INVENTORY_TABLES, VECTOR_DIMENSIONS, CHARS_PER_TOKEN,
+    EMBEDDING_CACHE_PREFIX, LEARNED_CANDIDATE_PREFIX, EmbeddingCache, GroceryConciergeApp, PipelineMetrics,
+    SQLConnectionPool, SQLDatabaseManager, translate_tsql_to_sqlite
+)
+
+REPLAY_INDEX_NAME = "replay_index"
+REPLAY_DOC_PREFIX = "replay_question:"
+FALLBACK_SQL = "SELECT TOP 5 ItemName, Brand, Price FROM [dbo].[SupermarketItems] ORDER BY SalesPerMonth DESC"
+FILLER_ANSWER = ("Sure, I found that for you. It is in aisle three next to the fresh bread, "
+                 "and it is on offer this week for a very good price.")
+SUMMARY_ANSWER = "The customer asked about products, their prices and where to find them."
+
+# Synthetic catalog values, including those the example queries filter on
+ITEM_NAMES = ["Choco Milk Pack", "Whole Milk", "Flour", "Tomato Sauce", "Mozzarella", "Basil", "Olive Oil",
+              "Minced Beef", "Spaghetti", "Onion", "Garlic", "Carrot", "Yeast", "Parmesan", "Red Wine"]
+CATEGORIES = ["Dairy", "Bakery", "Produce", "Meat", "Pantry", "Beverages", "Frozen"]
+BRANDS = ["FreshFarm", "GreenValley", "DailyBest", "NaturePure", "HomeChoice"]
+ALLERGIES = ["gluten free", "lactose free", "nut free", "none"]
+RECIPES = ["Pizza Margherita", "Spaghetti Bolognese", "Pizza Funghi", "Vegetable Soup", "Pancakes"]
+
+
+# --- Question set ---
+
+def default_question_set() -> List[Dict[str, str]]:
+    """Every example question as asked and reworded, with its recorded query."""
+    questions = []
+    for example in BUSINESS_QUESTIONS_DATA:
+        question, sql = example["business_question"], example["business_query"]
+        for variant in (question, question.lower(), f"Could you tell me: {question}", question.rstrip("?") + " please?"):
+            questions.append({"question": variant, "sql": sql})
+    return questions
+
+
+def load_question_set(path: str) -> List[Dict[str, str]]:
+    with open(path, encoding="utf-8") as lines:
+        return [json.loads(line) for line in lines if line.strip()]
+
+
+# --- SQLite stand-in for Azure SQL ---
+
+def build_supermarket_db(path: str, items: int, seed: int):
+    """Creates the inventory tables described in TABLE_DESCRIPTIONS and fills them with synthetic rows."""
+    rng = random.Random(seed)
+    names = ITEM_NAMES + [f"Product {i}" for i in range(max(0, items - len(ITEM_NAMES)))]
+    rows = {
+        "SupermarketItems": [{
+            "ID": f"I{i:05d}", "ItemName": name, "Category": rng.choice(CATEGORIES), "Brand": rng.choice(BRANDS),
+            "Price": round(rng.uniform(0.5, 25), 2), "StockQuantity": rng.randint(0, 200),
+            "ExpiryDate": (datetime.date(2025, 1, 1) + datetime.timedelta(days=rng.randint(0, 365))).isoformat(),
+            "Supplier": f"Supplier {rng.randint(1, 20)}", "Allergy": rng.choice(ALLERGIES),
+            "Location": f"Aisle {rng.randint(1, 12)}", "NutriScore": rng.choice("ABCDE"),
+            "SalesPerMonth": rng.randint(0, 1000)
+        } for i, name in enumerate(names)],
+        "Recipes": [{"RecipeID": i, "RecipeName": name, "Description": f"A classic {name.lower()}.",
+                     "Category": rng.choice(["Main", "Starter", "Dessert"])} for i, name in enumerate(RECIPES, 1)],
+        "Instructions": [{"InstructionID": recipe * 10 + step, "RecipeID": recipe, "StepNumber": step,
+                          "StepDescription": f"Step {step} of {RECIPES[recipe - 1]}."}
+                         for recipe in range(1, len(RECIPES) + 1) for step in range(1, rng.randint(3, 7))],
+        "Ingredients": [{"IngredientID": recipe * 10 + n, "RecipeID": recipe, "IngredientName": name,
+                         "Quantity": f"{rng.randint(1, 500)} g"}
+                        for recipe in range(1, len(RECIPES) + 1)
+                        for n, name in enumerate(rng.sample(ITEM_NAMES, rng.randint(4, 7)))]
+    }
+    conn = sqlite3.connect(path)
+    for table in INVENTORY_TABLES:
+        columns = TABLE_DESCRIPTIONS[table]["columns"]
+        definitions = ", ".join(f"{name} {sqlite_type(data_type)}" for name, data_type, _ in columns)
+        conn.execute(f"DROP TABLE IF EXISTS {table}")
+        conn.execute(f"CREATE TABLE {table} ({definitions})")
+        conn.executemany(f"INSERT INTO {table} VALUES ({', '.join('?' for _ in columns)})",
+                         [[row.get(name) for name, _, _ in columns] for row in rows[table]])
+    conn.commit()
+    conn.close()
+
+
+def sqlite_type(data_type: str) -> str:
+    if data_type.startswith("int"):
+        return "INTEGER"
+    return "REAL" if data_type in ("float", "real") or data_type.startswith("decimal") else "TEXT"
+
+
+def to_sqlite(query: str) -> str:
+    """Translates a query of the backend, including its metadata queries, to SQLite."""
+    tables = re.search(r"TABLE_NAME IN \(([^)]*)\)", query)
+    if "INFORMATION_SCHEMA.COLUMNS" in query and tables:
+        return ("SELECT m.name, p.name FROM sqlite_master AS m JOIN pragma_table_info(m.name) AS p "
+                f"WHERE m.type = 'table' AND m.name IN ({tables.group(1)}) ORDER BY m.name, p.cid")
+    # The copy never changes while the benchmark runs, so any stable value serves as checksum
+    query = query.replace("CHECKSUM_AGG(BINARY_CHECKSUM(*))", "COUNT(*)")
+    return translate_tsql_to_sqlite(query)
+
+
+class SQLiteCursor:
+    """The part of the pyodbc cursor API the backend uses, over a SQLite cursor."""
+    def __init__(self, cursor: sqlite3.Cursor):
+        self.cursor = cursor
+
+    @property
+    def description(self):
+        return self.cursor.description
+
+    def execute(self, query: str) -> "SQLiteCursor":
+        try:
+            self.cursor.execute(to_sqlite(query))
+        except (sqlite3.Error, ValueError) as e:
+            raise pyodbc.ProgrammingError(str(e)) from e
+        return self
+
+    def fetchmany(self, size: int) -> List[Any]:
+        return self.cursor.fetchmany(size)
+
+    def fetchall(self) -> List[Any]:
+        return self.cursor.fetchall()
+
+    def nextset(self) -> bool:
+        return False
+
+    def close(self):
+        self.cursor.close()
+
+
+class SQLiteConnection:
+    """Stands in for a pyodbc connection to Azure SQL in the real connection pool."""
+    def __init__(self, path: str):
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.timeout = 0 # Set by execute_query; SQLite queries here finish well within any timeout
+
+    def cursor(self) -> SQLiteCursor:
+        return SQLiteCursor(self.conn.cursor())
+
+    def close(self):
+        self.conn.close()
+
+
+# --- Fake Ollama ---
+
+class FakeOllamaServer(ThreadingHTTPServer):
+    """Answers the Ollama endpoints the backend calls, with simulated generation latency."""
+    daemon_threads = True
+
+    def __init__(self, args: argparse.Namespace, questions: List[Dict[str, str]]):
+        super().__init__(("127.0.0.1", args.ollama_port), FakeOllamaHandler)
+        self.ttft_seconds = args.ttft_ms / 1000
+        self.token_seconds = 1 / args.tokens_per_second
+        self.embed_seconds = args.embed_ms / 1000
+        self.answer_tokens = args.answer_tokens
+        self.queries = {EmbeddingCache.normalize(q["question"]): q["sql"] for q in questions if q.get("sql")}
+        self._word_vectors: Dict[str, np.ndarray] = {}
+
+    def completion(self, prompt: str) -> str:
+        question = re.search(r"===User question: (.*)", prompt)
+        if question:
+            return f"```sql\n{self.queries.get(EmbeddingCache.normalize(question.group(1)), FALLBACK_SQL)}\n```"
+        if "=== New messages:" in prompt:
+            return SUMMARY_ANSWER
+        words = FILLER_ANSWER.split()
+        return " ".join(words[i % len(words)] for i in range(self.answer_tokens))
+
+    def embed(self, text: str) -> List[float]:
+        vector = np.zeros(VECTOR_DIMENSIONS, dtype=np.float32)
+        for word in re.findall(r"\w+", text.lower()):
+            if word not in self._word_vectors:
+                rng = np.random.default_rng(zlib.crc32(word.encode("utf-8")))
+                self._word_vectors[word] = rng.standard_normal(VECTOR_DIMENSIONS).astype(np.float32)
+            vector += self._word_vectors[word]
+        return (vector / (np.linalg.norm(vector) or 1.0)).tolist()
+
+
+class FakeOllamaHandler(BaseHTTPRequestHandler):
+    server: FakeOllamaServer
+
+    def log_message(self, format: str, *args: Any):
+        pass
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        if self.path == "/api/embed":
+            inputs = body.get("input", "")
+            time.sleep(self.server.embed_seconds)
+            self._send_json({"model": body.get("model"), "embeddings": [
+                self.server.embed(text) for text in ([inputs] if isinstance(inputs, str) else inputs)]})
+        elif self.path == "/api/embeddings":
+            time.sleep(self.server.embed_seconds)
+            self._send_json({"embedding": self.server.embed(body.get("prompt", ""))})
+        elif self.path == "/api/generate":
+            self._generate(body)
+        else:
+            self.send_error(404)
+
+    def _generate(self, body: Dict[str, Any]):
+        prompt = body.get("prompt", "")
+        tokens = re.findall(r"\S+\s*", self.server.completion(prompt))
+        num_predict = (body.get("options") or {}).get("num_predict")
+        if num_predict and num_predict > 0:
+            tokens = tokens[:num_predict]
+        base = {"model": body.get("model"), "created_at": datetime.datetime.now(datetime.timezone.utc).isoformat()}
+        final = {**base, "response": "", "done": True, "done_reason": "stop",
+                 "prompt_eval_count": len(prompt) // CHARS_PER_TOKEN, "eval_count": len(tokens)}
+        time.sleep(self.server.ttft_seconds)
+        if not body.get("stream", True):
+            time.sleep(self.server.token_seconds * max(0, len(tokens) - 1))
+            self._send_json({**final, "response": "".join(tokens)})
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.end_headers()
+        try:
+            for i, token in enumerate(tokens):
+                if i:
+                    time.sleep(self.server.token_seconds)
+                self.wfile.write(json.dumps({**base, "response": token, "done": False}).encode() + b"\n")
+                self.wfile.flush()
+            self.wfile.write(json.dumps(final).encode() + b"\n")
+        except (BrokenPipeError, ConnectionResetError):
+            pass # The client cancelled, e.g. a warmup or a request past its deadline
+
+    def _send_json(self, payload: Dict[str, Any]):
+        data = json.dumps(payload).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+# --- Replay ---
+
+def reset_redis(args: argparse.Namespace):
+    """Drops the benchmark index, its keys and learned examples, and the query embedding cache from the local Redis."""
+    client = redis.Redis(host=args.redis_host, port=args.redis_port, password=args.redis_password)
+    try:
+        client.ft(REPLAY_INDEX_NAME).dropindex(delete_documents=False)
+    except redis.exceptions.ResponseError:
+        pass # No index yet
+    client.delete(f"{REPLAY_INDEX_NAME}:learned")
+    for prefix in (REPLAY_DOC_PREFIX, LEARNED_CANDIDATE_PREFIX, EMBEDDING_CACHE_PREFIX):
+        for key in client.scan_iter(match=f"{prefix}*", count=1000):
+            client.delete(key)
+
+
+def build_app(args: argparse.Namespace, db_path: str) -> GroceryConciergeApp:
+    """A GroceryConciergeApp wired to the local Redis, the fake Ollama and the SQLite copy."""
+    backend.REDIS_HOST, backend.REDIS_PORT, backend.REDIS_PASSWORD = args.redis_host, args.redis_port, args.redis_password
+    backend.INDEX_NAME, backend.DOC_PREFIX = REPLAY_INDEX_NAME, REPLAY_DOC_PREFIX
+    backend.USE_AGGREGATE_TABLES = False # Their rebuild is T-SQL DDL the SQLite copy cannot run
+    app = GroceryConciergeApp()
+    app.db_manager = SQLDatabaseManager("sqlite", pool=SQLConnectionPool(lambda: SQLiteConnection(db_path)),
+                                        replica=app.db_manager.replica, result_cache=app.db_manager.result_cache)
+    app.initialize_backend(incremental=True) # Never flush the whole Redis
+    return app
+
+
+def replay(app: GroceryConciergeApp, questions: List[str], args: argparse.Namespace) -> Dict[str, Any]:
+    """
+    Replays the questions with `args.concurrency` kiosks, each asking its share of the
+    questions one after the other in its own session. Returns the wall time and errors.
+    """
+    kiosks = [questions[i::args.concurrency] for i in range(args.concurrency)]
+    errors = []
+
+    def ask_all(share: List[str]):
+        session = app.new_session()
+        for question in share:
+            try:
+                app.process_user_question(question, session)
+            except Exception as e:
+                errors.append(repr(e))
+
+    async def ask_all_async(share: List[str]):
+        session = app.new_session()
+        for question in share:
+            try:
+                await app.process_user_question_async(question, session)
+            except Exception as e:
+                errors.append(repr(e))
+
+    async def run_async():
+        await asyncio.gather(*(ask_all_async(share) for share in kiosks))
+
+    start = time.perf_counter()
+    if args.use_async:
+        asyncio.run(run_async())
+    else:
+        with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+            list(executor.map(ask_all, kiosks))
+    return {"seconds": time.perf_counter() - start, "errors": errors}
+
+
+def rss_mb() -> float:
+    """Current resident set size in MB (Linux), or the peak where /proc is not available."""
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except (OSError, ValueError, AttributeError):
+        return peak_rss_mb()
+
+
+def peak_rss_mb() -> float:
+    import resource # Not available on Windows
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2**20 if sys.platform == "darwin" else peak / 2**10
+
+
+def run_benchmark(args: argparse.Namespace) -> Dict[str, Any]:
+    question_set = load_question_set(args.questions) if args.questions else default_question_set()
+    server = FakeOllamaServer(args, question_set)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    os.environ["OLLAMA_HOST"] = f"http://127.0.0.1:{server.server_port}"
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, "supermarket.db")
+        build_supermarket_db(db_path, args.items, args.seed)
+        reset_redis(args)
+        rss_before = rss_mb()
+        app = build_app(args, db_path)
+
+        questions = [q["question"] for q in question_set]
+        if args.warmup:
+            warmup = replay(app, questions[:args.warmup], argparse.Namespace(**{**vars(args), "concurrency": 1}))
+            if warmup["errors"]:
+                print(f"Warmup failed on {len(warmup['errors'])} questions, e.g. {warmup['errors'][0]}")
+        replayed = [question for _ in range(args.passes) for question in questions]
+        app.metrics = app.llm_service.metrics = PipelineMetrics(window_size=max(1, len(replayed)))
+        # The pipeline prints every streamed token; keep the report readable
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(sys.stdout if args.verbose else devnull):
+            outcome = replay(app, replayed, args)
+            if app.summary_executor is not None:
+                app.summary_executor.shutdown(wait=True) # Let queued summaries finish while the fake Ollama is up
+        summary = app.metrics_summary()
+        server.shutdown()
+
+    return {
+        "config": {key: value for key, value in vars(args).items() if key not in ("save", "baseline", "redis_password", "verbose")},
+        "requests": len(replayed),
+        "errors": len(outcome["errors"]),
+        "seconds": round(outcome["seconds"], 3),
+        "requests_per_second": round(len(replayed) / outcome["seconds"], 2),
+        "stages": {stage: {"count": values["count"], "p50_ms": values["p50_ms"], "p99_ms": values["p99_ms"]}
+                   for stage, values in summary["stages"].items()},
+        "counters": summary["counters"],
+        "memory_mb": {"rss_before": round(rss_before, 1), "rss_after": round(rss_mb(), 1),
+                      "peak_rss": round(peak_rss_mb(), 1)}
+    }
+
+
+def delta(value: float, baseline: float | None) -> str:
+    if not baseline:
+        return ""
+    return f"{(value - baseline) / baseline * 100:+.0f}%"
+
+
+def print_results(results: Dict[str, Any], baseline: Dict[str, Any] = None):
+    base_stages = (baseline or {}).get("stages", {})
+    print(f"{'stage':>18} {'count':>7} {'p50 ms':>9} {'':>6} {'p99 ms':>9} {'':>6}")
+    for stage, row in results["stages"].items():
+        base = base_stages.get(stage, {})
+        print(f"{stage:>18} {row['count']:>7} {row['p50_ms']:>9.2f} {delta(row['p50_ms'], base.get('p50_ms')):>6} "
+              f"{row['p99_ms']:>9.2f} {delta(row['p99_ms'], base.get('p99_ms')):>6}")
+    rate = results["requests_per_second"]
+    print(f"\n{results['requests']} requests ({results['errors']} errors) in {results['seconds']:.2f}s: "
+          f"{rate:.2f} req/s {delta(rate, (baseline or {}).get('requests_per_second'))}")
+    memory = results["memory_mb"]
+    print(f"RSS {memory['rss_before']:.0f} MB before startup, {memory['rss_after']:.0f} MB after replay, "
+          f"{memory['peak_rss']:.0f} MB peak")
+    for name, value in results["counters"].items():
+        print(f"  {name}: {value:g}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--questions", default=None, help="JSON lines question set; the examples when omitted")
+    parser.add_argument("--passes", type=int, default=2, help="Times the question set is replayed")
+    parser.add_argument("--warmup", type=int, default=0, help="Questions asked before measuring")
+    parser.add_argument("--concurrency", type=int, default=1, help="Kiosks asking questions at the same time")
+    parser.add_argument("--async", dest="use_async", action="store_true", help="Use process_user_question_async")
+    parser.add_argument("--ttft-ms", type=float, default=150, help="Fake Ollama time to first token")
+    parser.add_argument("--tokens-per-second", type=float, default=40, help="Fake Ollama generation speed")
+    parser.add_argument("--answer-tokens", type=int, default=40, help="Length of the fake chat answers")
+    parser.add_argument("--embed-ms", type=float, default=15, help="Fake Ollama embedding latency")
+    parser.add_argument("--ollama-port", type=int, default=0, help="Port of the fake Ollama; any free port when 0")
+    parser.add_argument("--redis-host", default="localhost")
+    parser.add_argument("--redis-port", type=int, default=6379)
+    parser.add_argument("--redis-password", default=None)
+    parser.add_argument("--items", type=int, default=500, help="Rows of the synthetic SupermarketItems table")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--verbose", action="store_true", help="Show the output of the pipeline while replaying")
+    parser.add_argument("--save", default=None, help="Write the results to this JSON file")
+    parser.add_argument("--baseline", default=None, help="Compare with results saved by --save")
+    args = parser.parse_args()
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as baseline_file:
+            baseline = json.load(baseline_file)
+    results = run_benchmark(args)
+    print_results(results, baseline)
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as save_file:
+            json.dump(results, save_file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
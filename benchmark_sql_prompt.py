@@ -0,0 +1,95 @@
+"""
+Prompt size and prefill benchmark for the SQL-generation prompt.
+Renders the SQL prompt of every business question twice, once describing
+every table and once with the schema pruned to the tables the question
+needs, and sends each prompt to Ollama with a single output token, so the
+reported prompt_eval_count and prompt_eval_duration are the prompt tokens
+and the prefill time.
+
+By default a unique first line defeats Ollama's prompt cache, so every
+request pays the full prefill; pass --warm to measure with the cache.
+
+Usage:
+    ollama serve & ollama pull llama3.2
+    python benchmark_sql_prompt.py --model llama3.2 --repeats 3
+    python benchmark_sql_prompt.py --offline   # estimated token counts only
+"""
+
+import argparse
+import uuid
+from typing import List, Dict, Any
+
+import numpy as np
+import requests
+
+from grocery_concierge_backend import LLMService, BUSINESS_QUESTIONS_DATA, CHARS_PER_TOKEN
+
+
+def build_prompts(llm_service: LLMService, prune: bool) -> List[str]:
+    """The SQL prompt of every example question, using the example itself as the retrieved context."""
+    registry = llm_service.schema_registry
+    prompts = []
+    for example in BUSINESS_QUESTIONS_DATA:
+        question, query = example["business_question"], example["business_query"]
+        tables = registry.select_tables(question, [query]) if prune else None
+        prompts.append(llm_service.sql_prompt_template.format(
+            question=question,
+            business_question=f"Question: {question}\nQuery: {query}",
+            exception=None,
+            query=None,
+            schema=registry.render(tables)
+        ))
+    return prompts
+
+
+def prefill(host: str, model: str, prompt: str) -> Dict[str, float]:
+    """Runs one prompt with a single output token and returns its prompt tokens and prefill milliseconds."""
+    response = requests.post(f"{host}/api/generate", json={
+        "model": model, "prompt": prompt, "stream": False, "raw": True, "options": {"num_predict": 1}
+    }, timeout=600)
+    response.raise_for_status()
+    body = response.json()
+    return {"tokens": body.get("prompt_eval_count", 0), "ms": body.get("prompt_eval_duration", 0) / 1e6}
+
+
+def benchmark_variant(name: str, prompts: List[str], args: argparse.Namespace) -> Dict[str, Any]:
+    chars = np.array([len(prompt) for prompt in prompts])
+    row = {"variant": name, "chars": chars.mean(), "est_tokens": chars.mean() / CHARS_PER_TOKEN,
+           "tokens": float("nan"), "p50_ms": float("nan"), "p95_ms": float("nan")}
+    if args.offline:
+        return row
+    tokens, latencies = [], []
+    for _ in range(args.repeats):
+        for prompt in prompts:
+            if not args.warm:
+                prompt = f"Request {uuid.uuid4().hex}\n{prompt}"
+            result = prefill(args.host, args.model, prompt)
+            tokens.append(result["tokens"])
+            latencies.append(result["ms"])
+    row.update(tokens=np.mean(tokens), p50_ms=np.percentile(latencies, 50), p95_ms=np.percentile(latencies, 95))
+    return row
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="http://localhost:11434")
+    parser.add_argument("--model", default="llama3.2")
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--warm", action="store_true", help="Let Ollama reuse the cached prompt prefix")
+    parser.add_argument("--offline", action="store_true", help="Only report prompt sizes, without calling Ollama")
+    args = parser.parse_args()
+
+    llm_service = LLMService(sql_llm_model=args.model, chat_llm_model=args.model)
+    # Load the model once so the first measured request does not include it
+    if not args.offline:
+        prefill(args.host, args.model, "Hello")
+
+    print(f"{'variant':>8} {'chars':>8} {'est tok':>8} {'tokens':>8} {'p50 ms':>9} {'p95 ms':>9}")
+    for name, prune in (("full", False), ("pruned", True)):
+        row = benchmark_variant(name, build_prompts(llm_service, prune), args)
+        print(f"{row['variant']:>8} {row['chars']:>8.0f} {row['est_tokens']:>8.0f} {row['tokens']:>8.0f} "
+              f"{row['p50_ms']:>9.1f} {row['p95_ms']:>9.1f}")
+
+
+if __name__ == "__main__":
+    main()
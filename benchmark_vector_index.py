@@ -0,0 +1,157 @@
+"""
+Recall and latency benchmark for the RediSearch vector index algorithms.
+Loads synthetic embeddings into a local Redis stack at several corpus sizes,
+builds a FLAT and an HNSW index over the same documents, and reports
+recall@k of HNSW against the FLAT ground truth plus p50/p99 query latency.
+
+Usage:
+    docker run -d -p 6379:6379 redis/redis-stack-server:latest
+    python benchmark_vector_index.py --sizes 1000 10000 50000 --ef-runtime 10 50 200
+"""
+
+import argparse
+import time
+from typing import List, Dict, Any
+
+import numpy as np
+
+from grocery_concierge_backend import (
+    RedisVectorStore, encode_embedding, VECTOR_DIMENSIONS, HNSW_M, HNSW_EF_CONSTRUCTION, HNSW_EF_RUNTIME
+)
+
+BENCH_PREFIX = "bench_question:"
+FLAT_INDEX_NAME = "bench_flat_index"
+HNSW_INDEX_NAME = "bench_hnsw_index"
+
+
+def make_corpus(size: int, dimensions: int, rng: np.random.Generator,
+                clusters: int = 64) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Generates clustered unit vectors, which resemble sentence embeddings more
+    closely than uniform noise and make the HNSW recall figures meaningful.
+    Returns the vectors and the cluster centers, for make_queries.
+    """
+    centers = rng.standard_normal((clusters, dimensions)).astype(np.float32)
+    return sample_clusters(centers, size, rng), centers
+
+
+def make_queries(centers: np.ndarray, count: int, rng: np.random.Generator) -> np.ndarray:
+    """Query vectors drawn from the same clusters as the corpus, like real questions about the same topics."""
+    return sample_clusters(centers, count, rng)
+
+
+def sample_clusters(centers: np.ndarray, count: int, rng: np.random.Generator) -> np.ndarray:
+    assignment = rng.integers(0, len(centers), count)
+    vectors = centers[assignment] + 0.35 * rng.standard_normal((count, centers.shape[1])).astype(np.float32)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors
+
+
+def load_corpus(store: RedisVectorStore, vectors: np.ndarray, batch_size: int = 1000):
+    """Writes the vectors, at the store's precision, as business question hashes with pipelined HSETs."""
+    for start in range(0, len(vectors), batch_size):
+        pipe = store.client.pipeline(transaction=False)
+        for i in range(start, min(start + batch_size, len(vectors))):
+            vector, scale = encode_embedding(vectors[i], store.precision)
+            pipe.hset(f"{store.doc_prefix}{i}", mapping={
+                "id": i,
+                "business_question": f"synthetic question {i}",
+                "business_query": f"SELECT {i}",
+                "embedding": vector,
+                "embedding_scale": scale
+            })
+        pipe.execute()
+
+
+def wait_for_indexing(store: RedisVectorStore, expected: int, timeout: float = 600.0):
+    """Blocks until the index has picked up every document."""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        info = store.client.ft(store.index_name).info()
+        if int(info["num_docs"]) >= expected and int(info.get("indexing", 0)) == 0:
+            return
+        time.sleep(0.2)
+    raise TimeoutError(f"Index '{store.index_name}' did not finish indexing {expected} documents.")
+
+
+def run_queries(store: RedisVectorStore, queries: np.ndarray, top_k: int, ef_runtime: int = None):
+    """Runs every query and returns the result ids and per-query latencies in milliseconds."""
+    ids, latencies = [], []
+    for query in queries:
+        start = time.perf_counter()
+        docs = store.search_by_embedding(query, top_k, ef_runtime=ef_runtime)
+        latencies.append((time.perf_counter() - start) * 1000)
+        ids.append([doc.id for doc in docs])
+    return ids, np.array(latencies)
+
+
+def recall_at_k(results: List[List[str]], ground_truth: List[List[str]], top_k: int) -> float:
+    """Mean fraction of the exact top-k neighbours found by the approximate search."""
+    hits = [len(set(found[:top_k]) & set(truth[:top_k])) / top_k for found, truth in zip(results, ground_truth)]
+    return float(np.mean(hits))
+
+
+def benchmark_size(size: int, args: argparse.Namespace, rng: np.random.Generator) -> List[Dict[str, Any]]:
+    flat = RedisVectorStore(args.host, args.port, args.password, FLAT_INDEX_NAME, BENCH_PREFIX, use_local_index=False)
+    hnsw = RedisVectorStore(args.host, args.port, args.password, HNSW_INDEX_NAME, BENCH_PREFIX, use_local_index=False)
+
+    # Remove leftovers from a previous size before loading the new corpus
+    for key in flat.client.scan_iter(match=f"{BENCH_PREFIX}*", count=1000):
+        flat.client.delete(key)
+
+    corpus, centers = make_corpus(size, args.dimensions, rng)
+    queries = make_queries(centers, args.queries, rng)
+    load_corpus(flat, corpus)
+
+    flat.create_index(args.dimensions, algorithm="FLAT", drop_existing=True)
+    build_start = time.perf_counter()
+    hnsw.create_index(args.dimensions, algorithm="HNSW", m=args.m, ef_construction=args.ef_construction,
+                      ef_runtime=HNSW_EF_RUNTIME, drop_existing=True)
+    wait_for_indexing(flat, size)
+    wait_for_indexing(hnsw, size)
+    hnsw_build_seconds = time.perf_counter() - build_start
+
+    ground_truth, flat_latency = run_queries(flat, queries, args.top_k)
+    rows = [{
+        "size": size, "index": "FLAT", "ef_runtime": "-", "recall": 1.0,
+        "p50_ms": np.percentile(flat_latency, 50), "p99_ms": np.percentile(flat_latency, 99), "build_s": "-"
+    }]
+    for ef_runtime in args.ef_runtime:
+        results, latency = run_queries(hnsw, queries, args.top_k, ef_runtime=ef_runtime)
+        rows.append({
+            "size": size, "index": "HNSW", "ef_runtime": ef_runtime,
+            "recall": recall_at_k(results, ground_truth, args.top_k),
+            "p50_ms": np.percentile(latency, 50), "p99_ms": np.percentile(latency, 99),
+            "build_s": f"{hnsw_build_seconds:.1f}"
+        })
+
+    flat.client.ft(FLAT_INDEX_NAME).dropindex(delete_documents=False)
+    hnsw.client.ft(HNSW_INDEX_NAME).dropindex(delete_documents=True)
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=6379)
+    parser.add_argument("--password", default=None)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 50000])
+    parser.add_argument("--dimensions", type=int, default=VECTOR_DIMENSIONS)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--top-k", type=int, default=6)
+    parser.add_argument("--m", type=int, default=HNSW_M)
+    parser.add_argument("--ef-construction", type=int, default=HNSW_EF_CONSTRUCTION)
+    parser.add_argument("--ef-runtime", type=int, nargs="+", default=[10, 50, 200])
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    print(f"{'size':>8} {'index':>6} {'ef':>5} {'recall@' + str(args.top_k):>10} {'p50 ms':>8} {'p99 ms':>8} {'build s':>8}")
+    for size in args.sizes:
+        for row in benchmark_size(size, args, rng):
+            print(f"{row['size']:>8} {row['index']:>6} {row['ef_runtime']:>5} {row['recall']:>10.3f} "
+                  f"{row['p50_ms']:>8.2f} {row['p99_ms']:>8.2f} {row['build_s']:>8}")
+
+
+if __name__ == "__main__":
+    main()
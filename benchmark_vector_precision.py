@@ -0,0 +1,87 @@
+"""
+Memory and recall comparison of the vector storage precisions.
+Stores the same synthetic embeddings in a local Redis stack as FLOAT32,
+FLOAT16 and scalar-quantized INT8, and reports bytes per vector, Redis
+memory per document, vector index size and recall@k of a FLAT KNN query
+against exact float32 ground truth computed in NumPy.
+
+FLOAT16 needs Redis Stack 7.2+ and INT8 needs Redis 8 (RediSearch 8.0+).
+
+Usage:
+    docker run -d -p 6379:6379 redis/redis-stack-server:latest
+    python benchmark_vector_precision.py --size 20000 --precisions FLOAT32 FLOAT16 INT8
+"""
+
+import argparse
+from typing import Dict, Any
+
+import numpy as np
+
+from grocery_concierge_backend import RedisVectorStore, VECTOR_DIMENSIONS, VECTOR_DTYPES
+from benchmark_vector_index import make_corpus, make_queries, load_corpus, wait_for_indexing, run_queries, recall_at_k
+
+
+def exact_top_k(corpus: np.ndarray, queries: np.ndarray, top_k: int, doc_prefix: str):
+    """Exact cosine top-k in float32, as Redis document ids."""
+    similarities = queries @ corpus.T
+    order = np.argsort(-similarities, axis=1)[:, :top_k]
+    return [[f"{doc_prefix}{i}" for i in row] for row in order]
+
+
+def memory_per_document(store: RedisVectorStore, size: int, samples: int = 200) -> float:
+    """Average MEMORY USAGE of a sample of stored hashes, in bytes."""
+    pipe = store.client.pipeline(transaction=False)
+    for i in np.linspace(0, size - 1, min(samples, size), dtype=int):
+        pipe.memory_usage(f"{store.doc_prefix}{i}")
+    return float(np.mean([usage or 0 for usage in pipe.execute()]))
+
+
+def benchmark_precision(precision: str, corpus: np.ndarray, queries: np.ndarray,
+                        args: argparse.Namespace) -> Dict[str, Any]:
+    prefix = f"bench_{precision.lower()}:"
+    store = RedisVectorStore(args.host, args.port, args.password, f"bench_{precision.lower()}_index", prefix,
+                             vector_dimensions=args.dimensions, use_local_index=False, precision=precision)
+    store.create_index(args.dimensions, algorithm="FLAT", drop_existing=True)
+    load_corpus(store, corpus)
+    wait_for_indexing(store, len(corpus))
+
+    results, latency = run_queries(store, queries, args.top_k)
+    info = store.client.ft(store.index_name).info()
+    row = {
+        "precision": precision,
+        "bytes_per_vector": args.dimensions * np.dtype(VECTOR_DTYPES[precision]).itemsize,
+        "doc_bytes": memory_per_document(store, len(corpus)),
+        "index_mb": float(info.get("vector_index_sz_mb", 0.0)),
+        "recall": recall_at_k(results, exact_top_k(corpus, queries, args.top_k, prefix), args.top_k),
+        "p50_ms": np.percentile(latency, 50)
+    }
+    store.client.ft(store.index_name).dropindex(delete_documents=True)
+    return row
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=6379)
+    parser.add_argument("--password", default=None)
+    parser.add_argument("--size", type=int, default=20000)
+    parser.add_argument("--dimensions", type=int, default=VECTOR_DIMENSIONS)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--top-k", type=int, default=6)
+    parser.add_argument("--precisions", nargs="+", default=list(VECTOR_DTYPES))
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    corpus, centers = make_corpus(args.size, args.dimensions, rng)
+    queries = make_queries(centers, args.queries, rng)
+
+    print(f"{'precision':>9} {'vec B':>7} {'doc B':>9} {'index MB':>9} {'recall@' + str(args.top_k):>10} {'p50 ms':>8}")
+    for precision in args.precisions:
+        row = benchmark_precision(precision, corpus, queries, args)
+        print(f"{row['precision']:>9} {row['bytes_per_vector']:>7} {row['doc_bytes']:>9.0f} "
+              f"{row['index_mb']:>9.1f} {row['recall']:>10.3f} {row['p50_ms']:>8.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -7,12 +7,24 @@ and leverages Ollama LLMs for SQL query generation and conversational responses.
 import orjson
 import json
 import time
-from typing import List, Dict, Any
+import asyncio
+from typing import List, Dict, Any, Callable, Iterator, AsyncIterator
 import numpy as np
 import pandas as pd
 import requests
 import re
+import math
+import hashlib
+import uuid
+import threading
+import weakref
+import sqlite3
+from decimal import Decimal
+from collections import OrderedDict, deque
+from contextlib import contextmanager
 import pyodbc
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from queue import Queue, Empty
 from getpass import getpass
 
 from sentence_transformers import SentenceTransformer
@@ -20,15 +32,99 @@ from langchain_ollama import OllamaLLM
 from langchain_ollama import OllamaEmbeddings
 from langchain.prompts import PromptTemplate
 from langchain.chains import LLMChain
+from langchain.callbacks.base import BaseCallbackHandler
 import redis
+import redis.asyncio
 from redis.commands.search.field import TagField, VectorField, NumericField, TextField
 from redis.commands.search.indexDefinition import IndexDefinition, IndexType
 from redis.commands.search.query import Query
+from redis.commands.search.document import Document
 
 # --- Configuration Constants ---
 VECTOR_DIMENSIONS = 1024
 INDEX_NAME = "story_index"
 DOC_PREFIX = "business_question:"
+# Serve few-shot retrieval from an in-process copy of the example embeddings.
+# Redis remains the persistence layer; set to False to always run KNN in Redis.
+USE_LOCAL_VECTOR_INDEX = True
+# Number of business questions embedded per model call, and how many batches run at once.
+INGEST_BATCH_SIZE = 32
+INGEST_MAX_WORKERS = 4
+# Diff the examples against Redis by content hash at start-up instead of flushing and re-ingesting everything.
+INCREMENTAL_SYNC = True
+# Vector index algorithm used by RediSearch: "FLAT" (exact) or "HNSW" (approximate, for large libraries).
+INDEX_ALGORITHM = "FLAT"
+HNSW_M = 16
+HNSW_EF_CONSTRUCTION = 200
+HNSW_EF_RUNTIME = 10
+# Storage precision of the vectors in Redis: "FLOAT32", "FLOAT16" (half the memory)
+# or "INT8" (a quarter of the memory, scalar-quantized with a per-vector scale).
+VECTOR_PRECISION = "FLOAT32"
+VECTOR_DTYPES = {"FLOAT32": np.float32, "FLOAT16": np.float16, "INT8": np.int8}
+# Query embedding cache: an in-process LRU in front of a shared Redis tier with a TTL.
+EMBEDDING_CACHE_SIZE = 1024
+EMBEDDING_CACHE_TTL_SECONDS = 7 * 24 * 3600
+EMBEDDING_CACHE_PREFIX = "embedding_cache:"
+# Semantic answer cache: reuse the final answer of a recent question within this cosine distance.
+ANSWER_CACHE_MAX_DISTANCE = 0.05
+ANSWER_CACHE_TTL_SECONDS = 600
+ANSWER_CACHE_SIZE = 256
+# Tables whose content answers depend on, and how often their checksums are compared for changes.
+INVENTORY_TABLES = ["SupermarketItems", "Recipes", "Instructions", "Ingredients"]
+INVENTORY_CHECK_INTERVAL_SECONDS = 30
+# Generated-SQL cache: run the stored query of an example this close to the question without calling the LLM,
+# and store SQL that executed successfully as a new "learned" example.
+SQL_CACHE_MAX_DISTANCE = 0.03
+PROMOTE_SUCCESSFUL_QUERIES = True
+# Learned examples become prompt content for every session, so a query is only promoted once it passes the
+# SQL validator and answered the same question LEARN_AFTER_SUCCESSES times, and only when no example is
+# already within LEARNED_EXAMPLE_MIN_DISTANCE. At most LEARNED_EXAMPLES_MAX are kept: the least recently
+# promoted ones are evicted beyond that, and any not promoted again within the TTL.
+LEARN_AFTER_SUCCESSES = 2
+LEARNED_EXAMPLE_MIN_DISTANCE = SQL_CACHE_MAX_DISTANCE
+LEARNED_EXAMPLES_MAX = 500
+LEARNED_EXAMPLE_TTL_SECONDS = 30 * 24 * 3600
+LEARNED_CANDIDATE_PREFIX = "learned_candidate:"
+# Intent templates: when the closest example is within this distance, re-bind the literals of its query
+# (category, brand, NutriScore, top-N, ...) to the values in the new question and run it without the LLM.
+TEMPLATE_MAX_DISTANCE = 0.10
+# Columns whose literals become template slots, and the slot type filled from the question.
+TEMPLATE_SLOT_COLUMNS = {
+    "ItemName": "item", "IngredientName": "item", "Brand": "brand", "Category": "category",
+    "NutriScore": "nutriscore", "RecipeName": "recipe", "Allergy": "allergy"
+}
+# Where the vocabulary of each slot type is read from, so values can be recognized in questions.
+TEMPLATE_VOCABULARY_SOURCES = {
+    "item": ("SupermarketItems", "ItemName"), "brand": ("SupermarketItems", "Brand"),
+    "category": ("SupermarketItems", "Category"), "recipe": ("Recipes", "RecipeName"),
+    "allergy": ("SupermarketItems", "Allergy")
+}
+NUMBER_WORDS = {"one": 1, "two": 2, "three": 3, "four": 4, "five": 5, "six": 6, "seven": 7, "eight": 8,
+                "nine": 9, "ten": 10, "twelve": 12, "fifteen": 15, "twenty": 20}
+# Words that flip what a query returns without changing its slots (ORDER BY direction, comparisons, negation).
+# A template is only bound when the question and the example use the same kinds of these words.
+INTENT_WORDS = {
+    "high": {"most", "more", "highest", "higher", "max", "maximum", "largest", "biggest", "greatest", "greater",
+             "priciest", "above", "over", "newest", "latest", "best"},
+    "low": {"least", "less", "fewer", "fewest", "lowest", "lower", "min", "minimum", "smallest", "cheapest",
+            "cheaper", "cheap", "below", "under", "oldest", "earliest", "worst"},
+    "negation": {"not", "no", "without", "except", "excluding", "never", "non", "isn't", "aren't", "doesn't"}
+}
+# Words asking for a column. A template is only bound when every column the question asks for appears in its SQL,
+# so a price question is not answered with the query of a location question that names the same item and brand.
+TEMPLATE_ATTRIBUTE_PATTERNS = {
+    "Price": r"\b(?:prices?|priced|costs?|how much|expensive|cheap|cheaper|cheapest|pricey|priciest)\b",
+    "NutriScore": r"\bnutri\s*-?\s*scores?\b",
+    "Location": r"\b(?:where|location|located|aisles?|section|shelf|find)\b",
+    "StockQuantity": r"\b(?:stock|in stock|availability|how many)\b",
+    "ExpiryDate": r"\b(?:expir\w*|best before|use by)\b",
+    "SalesPerMonth": r"\b(?:sold|sells?|selling|selled|sales|popular|bestsellers?)\b",
+    "Allergy": r"\ballerg\w*\b",
+    "Supplier": r"\b(?:suppliers?|supplied|supplies)\b"
+}
+# Examples whose stored query does not answer other questions of their intent, e.g. a Nutri Score question
+# stored with a query for the location; they still serve as few-shot context but are never bound as templates.
+NON_TEMPLATE_EXAMPLE_IDS = {3}
 
 # Database connection details (replace with secure environment variables in production)
 DB_SERVER = 'sql404server.database.windows.net'
@@ -38,6 +134,133 @@ DB_PASSWORD = 'hawu90KBV*NX'
 DB_PORT = 1433
 DB_DRIVER = '{ODBC Driver 17 for SQL Server}'
 
+# Database connection pool: connections kept open between queries, and how long a caller waits for one.
+DB_POOL_MIN_SIZE = 1
+DB_POOL_MAX_SIZE = 8
+DB_POOL_IDLE_TIMEOUT_SECONDS = 300
+DB_POOL_VALIDATE_AFTER_IDLE_SECONDS = 60
+DB_POOL_ACQUIRE_TIMEOUT_SECONDS = 30
+
+# Bounds on the rows fetched for one generated query, which end up in the chat prompt.
+RESULT_ROW_CAP = 200
+RESULT_BYTE_BUDGET = 64 * 1024
+FETCH_BATCH_SIZE = 50
+# When a result is truncated, run a COUNT of the query to report the total number of rows. Off by default:
+# the count runs the whole query again, which doubles the database cost of exactly the large results.
+COUNT_TRUNCATED_RESULTS = False
+
+# Result-set cache in front of execute_query, keyed by the canonical SQL text. Entries live for the
+# shortest TTL of the tables the query reads and are invalidated when one of those tables changes.
+USE_RESULT_CACHE = True
+RESULT_CACHE_SIZE = 512
+RESULT_CACHE_DEFAULT_TTL_SECONDS = 60
+RESULT_CACHE_TTL_SECONDS = {"SupermarketItems": 60, "Recipes": 3600, "Instructions": 3600, "Ingredients": 3600}
+
+# Query results are rendered into the chat prompt as a compact table within this budget
+# (tokens estimated at CHARS_PER_TOKEN characters); larger results are sampled and summarized.
+RESULT_TOKEN_BUDGET = 1200
+CHARS_PER_TOKEN = 4
+RESULT_FLOAT_DIGITS = 2
+
+# Only the tables relevant to a question are described in the SQL prompt: tables whose keywords
+# appear in the question, tables read by the closest SCHEMA_EXAMPLE_COUNT examples, and the tables
+# they reference. When nothing matches, every table is described.
+PRUNE_SQL_SCHEMA = True
+SCHEMA_EXAMPLE_COUNT = 2
+
+# How long Ollama keeps the models, and with them the KV cache of the last prompts, loaded after a call.
+# Prompts put static text first so consecutive calls share a cached prefix. The SQL and chat prompts
+# only keep separate caches when Ollama runs with OLLAMA_NUM_PARALLEL >= 2; with PRUNE_SQL_SCHEMA the
+# shared prefix of the SQL prompt ends where the per-question schema block starts.
+OLLAMA_KEEP_ALIVE = "30m"
+
+# The chat prompt holds the last CHAT_HISTORY_KEEP_TURNS question/answer turns verbatim, within
+# CHAT_HISTORY_TOKEN_BUDGET tokens. With SUMMARIZE_CHAT_HISTORY, older turns are folded by the chat
+# model into a running summary of at most CHAT_SUMMARY_TOKEN_BUDGET tokens, in the background.
+CHAT_HISTORY_KEEP_TURNS = 4
+CHAT_HISTORY_TOKEN_BUDGET = 600
+SUMMARIZE_CHAT_HISTORY = True
+CHAT_SUMMARY_TOKEN_BUDGET = 150
+
+# process_user_question_async starts the query embedding together with a database connection checkout
+# and, with ASYNC_WARM_SQL_PROMPT, a one-token Ollama call that puts the static prefix of the SQL prompt
+# in the model's cache. The warmup is cancelled when the answer turns out to need no SQL generation.
+ASYNC_WARM_SQL_PROMPT = True
+
+# Answer given when no SQL query could be generated and executed within the attempts.
+SQL_FAILURE_ANSWER = ("I apologize, but I encountered an issue while trying to retrieve that information. "
+                      "Please try rephrasing your question.")
+
+# Every question must be answered within REQUEST_DEADLINE_SECONDS. Each stage waits for at most the
+# remaining budget, capped by its STAGE_TIMEOUT_SECONDS; SQL generation and execution leave
+# CHAT_RESERVE_SECONDS of the budget to the chat answer, so retries cannot use it up. When the budget
+# runs out the concierge answers with what it has: the rows found so far, or the answer streamed so far.
+REQUEST_DEADLINE_SECONDS = 45
+STAGE_TIMEOUT_SECONDS = {"embedding": 5, "knn_search": 3, "sql_generation": 15, "sql_execution": 10,
+                         "chat_first_token": 15}
+CHAT_RESERVE_SECONDS = 15
+STAGE_WORKERS = 32 # Threads that run blocking stages for the sync pipeline while it waits with a timeout
+STREAM_WORKERS = 32 # Threads that consume chat streams for the sync pipeline, apart from the stage workers
+DEADLINE_ANSWER = "I'm sorry, that is taking me longer than it should. Please ask me again in a moment."
+DEADLINE_DATA_PREFIX = "I'm sorry, I could not finish my answer in time. Here is what I found: "
+DEADLINE_DATA_ROWS = 5
+DEADLINE_CUTOFF_SUFFIX = " I'm sorry, I have to stop here."
+
+# Stage latency quantiles cover the last METRICS_WINDOW_SIZE samples of each stage; counts, sums and
+# counters cover the lifetime of the process. Served as JSON and in Prometheus text format.
+METRICS_WINDOW_SIZE = 1024
+METRICS_QUANTILES = (0.5, 0.95, 0.99)
+
+# Optional read-only SQLite replica of the catalog tables, refreshed in the background
+# when a table checksum changes. Read-only queries are answered from it when enabled.
+USE_LOCAL_REPLICA = False
+LOCAL_REPLICA_PATH = "supermarket_replica.db"
+LOCAL_REPLICA_REFRESH_SECONDS = 300
+
+# Precomputed ranking tables, maintained in the database by a background materializer. A table is
+# rebuilt when the checksum of one of its sources changed, checked every `refresh_seconds`.
+# Needs CREATE/DROP TABLE rights on the database, which the concierge otherwise does not use.
+USE_AGGREGATE_TABLES = False
+LOW_STOCK_THRESHOLD = 10
+AGGREGATE_TABLES = {
+    "ItemRankings": {
+        "sources": ["SupermarketItems"],
+        "refresh_seconds": 300,
+        "description": "One row per item of SupermarketItems with its ItemName, Brand, Category, NutriScore, Price, "
+                       "StockQuantity, SalesPerMonth and Location, plus 1-based ranks: SalesRank, SalesRankInCategory "
+                       "and SalesRankInNutriScore (best seller first), PriceRankInCategory and PriceRankInNutriScore "
+                       "(cheapest first), StockRank and StockRankInCategory (lowest stock first), and IsLowStock (1 when "
+                       f"StockQuantity <= {LOW_STOCK_THRESHOLD}). Use it for best seller, cheapest and low stock questions.",
+        "select": f"""SELECT ItemName, Brand, Category, NutriScore, Price, StockQuantity, SalesPerMonth, Location,
+    ROW_NUMBER() OVER (ORDER BY SalesPerMonth DESC) AS SalesRank,
+    ROW_NUMBER() OVER (PARTITION BY Category ORDER BY SalesPerMonth DESC) AS SalesRankInCategory,
+    ROW_NUMBER() OVER (PARTITION BY NutriScore ORDER BY SalesPerMonth DESC) AS SalesRankInNutriScore,
+    ROW_NUMBER() OVER (PARTITION BY Category ORDER BY Price ASC) AS PriceRankInCategory,
+    ROW_NUMBER() OVER (PARTITION BY NutriScore ORDER BY Price ASC) AS PriceRankInNutriScore,
+    ROW_NUMBER() OVER (ORDER BY StockQuantity ASC) AS StockRank,
+    ROW_NUMBER() OVER (PARTITION BY Category ORDER BY StockQuantity ASC) AS StockRankInCategory,
+    CASE WHEN StockQuantity <= {LOW_STOCK_THRESHOLD} THEN 1 ELSE 0 END AS IsLowStock
+FROM [dbo].[SupermarketItems]""",
+        "indexes": [["SalesRank"], ["Category", "SalesRankInCategory"], ["NutriScore", "SalesRankInNutriScore"],
+                    ["Category", "PriceRankInCategory"], ["NutriScore", "PriceRankInNutriScore"], ["IsLowStock", "StockRank"]],
+        "keywords": ["most", "best", "top", "sold", "selling", "seller", "popular", "cheapest", "least", "low", "running"]
+    },
+    "CategorySummary": {
+        "sources": ["SupermarketItems"],
+        "refresh_seconds": 300,
+        "description": "One row per Category and NutriScore of SupermarketItems with ItemCount, TotalSalesPerMonth, "
+                       "AveragePrice, MinPrice, MaxPrice, TotalStock and LowStockItems. Use it for questions that "
+                       "compare categories or NutriScore grades.",
+        "select": f"""SELECT Category, NutriScore, COUNT(*) AS ItemCount, SUM(SalesPerMonth) AS TotalSalesPerMonth,
+    AVG(Price) AS AveragePrice, MIN(Price) AS MinPrice, MAX(Price) AS MaxPrice, SUM(StockQuantity) AS TotalStock,
+    SUM(CASE WHEN StockQuantity <= {LOW_STOCK_THRESHOLD} THEN 1 ELSE 0 END) AS LowStockItems
+FROM [dbo].[SupermarketItems]
+GROUP BY Category, NutriScore""",
+        "indexes": [["Category", "NutriScore"]],
+        "keywords": ["categories", "category", "compare", "grades", "overall"]
+    }
+}
+
 # Redis connection details (replace with secure environment variables in production)
 REDIS_HOST = "redis-18805.c282.east-us-mz.azure.redns.redis-cloud.com"
 REDIS_PORT = 18805
@@ -104,6 +327,90 @@ BUSINESS_QUESTIONS_DATA = [
     }
 ]
 
+# Examples answered from the aggregate tables, used instead of the example they `replaces` when
+# USE_AGGREGATE_TABLES is on and the tables have been built.
+AGGREGATE_QUESTIONS_DATA = [
+    {
+        "id": 101,
+        "replaces": 11,
+        "business_question": "Can you give me the list of most selled product with Nutriscore 'A'?",
+        "business_query": "SELECT TOP 5 ItemName, Brand, NutriScore, Price FROM [dbo].[ItemRankings] WHERE NutriScore = 'A' ORDER BY SalesRankInNutriScore ASC"
+    },
+    {
+        "id": 102,
+        "replaces": 10,
+        "business_question": "Show me the the less expensive item with Nutriscore A",
+        "business_query": "SELECT ItemName, Brand, NutriScore, Price FROM [dbo].[ItemRankings] WHERE NutriScore = 'A' ORDER BY PriceRankInNutriScore ASC"
+    },
+    {
+        "id": 103,
+        "business_question": "Which products are running low in stock?",
+        "business_query": "SELECT ItemName, Brand, Category, StockQuantity, Location FROM [dbo].[ItemRankings] WHERE IsLowStock = 1 ORDER BY StockRank ASC"
+    },
+    {
+        "id": 104,
+        "business_question": "What are the best selling products in the 'Dairy' category?",
+        "business_query": "SELECT TOP 5 ItemName, Brand, Price, SalesPerMonth FROM [dbo].[ItemRankings] WHERE Category = 'Dairy' ORDER BY SalesRankInCategory ASC"
+    },
+    {
+        "id": 105,
+        "business_question": "Which category sells the most products with NutriScore 'A'?",
+        "business_query": "SELECT TOP 1 Category, TotalSalesPerMonth FROM [dbo].[CategorySummary] WHERE NutriScore = 'A' ORDER BY TotalSalesPerMonth DESC"
+    }
+]
+
+# Description of the tables the concierge may query, rendered into the SQL prompt: per table a
+# short description, (column, type, note) triples, the columns referencing other tables, and the
+# words of a question that make the table relevant.
+TABLE_DESCRIPTIONS = {
+    "SupermarketItems": {
+        "description": "Items sold in the store.",
+        "columns": [
+            ("ID", "nvarchar(10)", "item code, not a key"), ("ItemName", "nvarchar(255)", ""),
+            ("Category", "nvarchar(100)", "e.g. Dairy, Produce"), ("Brand", "nvarchar(100)", ""),
+            ("Price", "float", ""), ("StockQuantity", "int", "units available"), ("ExpiryDate", "date", ""),
+            ("Supplier", "nvarchar(100)", ""), ("Allergy", "nvarchar(50)", "e.g. Nuts, Gluten free"),
+            ("Location", "nvarchar(50)", "store section"), ("NutriScore", "nvarchar(5)", "A to E"),
+            ("SalesPerMonth", "int", "units sold per month")
+        ],
+        "references": {},
+        "keywords": ["item", "items", "product", "products", "price", "prices", "cost", "costs", "expensive", "cheap",
+                     "cheapest", "brand", "stock", "buy", "find", "where", "location", "aisle", "nutri", "nutriscore",
+                     "gluten", "allergy", "allergies", "sold", "sell", "selling", "supplier", "expiry", "expire"]
+    },
+    "Recipes": {
+        "description": "Recipes the store suggests.",
+        "columns": [
+            ("RecipeID", "int", "primary key"), ("RecipeName", "nvarchar(100)", ""),
+            ("Description", "nvarchar(255)", ""), ("Category", "nvarchar(50)", "e.g. Dessert, Vegan")
+        ],
+        "references": {},
+        "keywords": ["recipe", "recipes", "receipe", "dish", "dishes", "meal", "meals", "cook", "dessert", "vegan"]
+    },
+    "Instructions": {
+        "description": "Cooking steps of each recipe.",
+        "columns": [
+            ("InstructionID", "int", "primary key"), ("RecipeID", "int", ""),
+            ("StepNumber", "int", "order of the step"), ("StepDescription", "nvarchar(500)", "")
+        ],
+        "references": {"RecipeID": "Recipes.RecipeID"},
+        "keywords": ["instruction", "instructions", "step", "steps", "cook", "prepare", "make", "how"]
+    },
+    "Ingredients": {
+        "description": "Ingredients of each recipe.",
+        "columns": [
+            ("IngredientID", "int", "primary key"), ("RecipeID", "int", ""),
+            ("IngredientName", "nvarchar(100)", ""), ("Quantity", "nvarchar(100)", "e.g. 2 cups, 100g")
+        ],
+        "references": {"RecipeID": "Recipes.RecipeID", "IngredientName": "SupermarketItems.ItemName"},
+        "keywords": ["ingredient", "ingredients", "need", "quantity", "recipe", "receipe", "cost"]
+    }
+}
+
+# Columns of the tables the concierge may query. Used to validate generated SQL locally;
+# refreshed from INFORMATION_SCHEMA when the database is reachable.
+SCHEMA_COLUMNS = {table: [column for column, _, _ in spec["columns"]] for table, spec in TABLE_DESCRIPTIONS.items()}
+
 # --- Helper Functions ---
 
 def get_db_connection_string() -> str:
@@ -121,6 +428,21 @@ def get_db_connection_string() -> str:
         LoginTimeout=30;
     """
 
+def get_business_questions(use_aggregates: bool = False) -> List[Dict[str, Any]]:
+    """
+    Returns the examples to index in Redis.
+    Args:
+        use_aggregates (bool): Swap in the examples that read from the aggregate tables.
+    Returns:
+        List[Dict[str, Any]]: The examples, each with 'id', 'business_question' and 'business_query'.
+    """
+    if not use_aggregates:
+        return BUSINESS_QUESTIONS_DATA
+    replaced = {example["replaces"] for example in AGGREGATE_QUESTIONS_DATA if "replaces" in example}
+    return [example for example in BUSINESS_QUESTIONS_DATA if example["id"] not in replaced] + [
+        {key: value for key, value in example.items() if key != "replaces"} for example in AGGREGATE_QUESTIONS_DATA
+    ]
+
 def extract_sql_query_from_llm_output(text: str) -> str | None:
     """
     Extracts the first SQL query enclosed in ```sql\n...\n``` from the given text.
@@ -135,18 +457,565 @@ def extract_sql_query_from_llm_output(text: str) -> str | None:
         return matches[0].strip()
     return None
 
+def encode_embedding(embedding: Any, precision: str = VECTOR_PRECISION) -> tuple[bytes, float]:
+    """
+    Serializes an embedding for storage in Redis at the given precision.
+    INT8 uses symmetric scalar quantization: each vector is divided by its own
+    scale (max absolute value / 127) and rounded.
+    Args:
+        embedding (Any): The float embedding.
+        precision (str): One of the keys of VECTOR_DTYPES.
+    Returns:
+        tuple[bytes, float]: The vector bytes and the scale needed to decode them.
+    """
+    vector = np.asarray(embedding, dtype=np.float32)
+    if precision == "INT8":
+        max_abs = float(np.max(np.abs(vector))) if vector.size else 0.0
+        scale = max_abs / 127.0 if max_abs > 0 else 1.0
+        return np.clip(np.rint(vector / scale), -127, 127).astype(np.int8).tobytes(), scale
+    return vector.astype(VECTOR_DTYPES[precision]).tobytes(), 1.0
+
+def decode_embedding(data: bytes, precision: str = VECTOR_PRECISION, scale: float = 1.0) -> np.ndarray:
+    """
+    Restores a float32 embedding from the bytes written by `encode_embedding`.
+    Args:
+        data (bytes): The stored vector.
+        precision (str): The precision the vector was stored with.
+        scale (float): The per-vector scale (INT8 only).
+    Returns:
+        np.ndarray: The float32 embedding.
+    """
+    vector = np.frombuffer(data, dtype=VECTOR_DTYPES[precision]).astype(np.float32)
+    return vector * np.float32(scale) if precision == "INT8" else vector
+
+def extract_table_names(sql: str) -> List[str]:
+    """
+    Returns the table names referenced after FROM or JOIN in a SQL query,
+    without schema prefix or brackets, e.g. "[dbo].[Recipes]" -> "Recipes".
+    Args:
+        sql (str): The SQL query.
+    Returns:
+        List[str]: The distinct table names, in order of appearance.
+    """
+    pattern = r'\b(?:FROM|JOIN)\s+((?:\[?\w+\]?\.)?\[?\w+\]?)'
+    tables = []
+    for match in re.findall(pattern, sql, re.IGNORECASE):
+        name = match.split(".")[-1].strip("[]")
+        if name not in tables:
+            tables.append(name)
+    return tables
+
+def apply_row_limit(sql: str, limit: int) -> str:
+    """
+    Adds `TOP (limit)` to a single SELECT that has no TOP clause yet. Queries
+    starting with WITH or combining SELECTs with UNION/EXCEPT/INTERSECT are
+    returned unchanged, since a single TOP would not bound them, and so are
+    queries paging with OFFSET/FETCH, which SQL Server does not allow with TOP.
+    Args:
+        sql (str): The SQL query.
+        limit (int): The maximum number of rows.
+    Returns:
+        str: The rewritten query.
+    """
+    match = re.match(r'\s*SELECT(\s+(?:DISTINCT|ALL))?\s+', sql, re.IGNORECASE)
+    if not match or re.match(r'\s*SELECT(\s+(?:DISTINCT|ALL))?\s+TOP\b', sql, re.IGNORECASE):
+        return sql
+    if re.search(r'\b(?:UNION|EXCEPT|INTERSECT)\b', sql, re.IGNORECASE):
+        return sql
+    if re.search(r'\bOFFSET\b.*?\bROWS?\b|\bFETCH\s+(?:NEXT|FIRST)\b', sql, re.IGNORECASE | re.DOTALL):
+        return sql # The fetch cap still bounds what is read
+    return f"{sql[:match.end()]}TOP ({int(limit)}) {sql[match.end():]}"
+
+def fetch_bounded(cursor, max_rows: int | None, max_bytes: int | None) -> tuple[List[Any], bool]:
+    """
+    Reads rows from an executed cursor with `fetchmany` until the result is
+    exhausted, `max_rows` rows were read or the text size of the rows exceeds
+    `max_bytes` (at least one row is always returned).
+    Args:
+        cursor: A DB-API cursor on which a query was executed.
+        max_rows (int | None): Maximum number of rows, None for no cap.
+        max_bytes (int | None): Approximate budget for the text size of the rows, None for no budget.
+    Returns:
+        tuple[List[Any], bool]: The rows and whether more rows were left unread.
+    """
+    rows = []
+    size = 0
+    while True:
+        batch = cursor.fetchmany(FETCH_BATCH_SIZE)
+        if not batch:
+            return rows, False
+        for row in batch:
+            size += sum(len(str(value)) for value in row)
+            if (max_rows is not None and len(rows) >= max_rows) or (max_bytes is not None and size > max_bytes and rows):
+                return rows, True
+            rows.append(row)
+
+def format_value(value: Any) -> str:
+    """Renders one result value for the chat prompt: rounded numbers, ISO dates, single-line text."""
+    if value is None:
+        return ""
+    if isinstance(value, bool):
+        return str(value)
+    if isinstance(value, (float, Decimal)):
+        text = f"{value:.{RESULT_FLOAT_DIGITS}f}"
+        return text.rstrip("0").rstrip(".") if "." in text else text
+    if hasattr(value, "isoformat"):
+        return value.isoformat()
+    return " ".join(str(value).split()).replace("|", "/")
+
+def format_query_result(result: List[Any], token_budget: int = RESULT_TOKEN_BUDGET) -> str:
+    """
+    Renders query results as a compact table for the chat prompt: a header line
+    with the column names followed by one "a | b | c" line per row. Columns that
+    are empty in every row are dropped. When the table exceeds `token_budget`,
+    the leading rows that fit are kept and min/max/average of the numeric columns
+    over all rows are appended.
+    Args:
+        result (List[Any]): The rows, ideally a QueryResult carrying `columns`,
+                            `truncated` and `total_rows_estimate`.
+        token_budget (int): Approximate maximum number of prompt tokens.
+    Returns:
+        str: The formatted table.
+    """
+    rows = [tuple(row) for row in result]
+    if not rows:
+        return "No rows."
+    columns = list(getattr(result, "columns", None) or [f"column{i + 1}" for i in range(len(rows[0]))])
+    keep = [i for i in range(len(columns)) if any(row[i] is not None and row[i] != "" for row in rows)]
+    total_rows = getattr(result, "total_rows_estimate", None)
+    budget = token_budget * CHARS_PER_TOKEN
+
+    lines = [" | ".join(columns[i] for i in keep)]
+    size = len(lines[0])
+    for row in rows:
+        line = " | ".join(format_value(row[i]) for i in keep)
+        if size + len(line) + 1 > budget and len(lines) > 1:
+            break
+        lines.append(line)
+        size += len(line) + 1
+    shown = len(lines) - 1
+    if shown == len(rows) and not getattr(result, "truncated", False):
+        return "\n".join(lines)
+
+    # Rows were left out: describe the numeric columns over every fetched row
+    if total_rows is None:
+        total_rows = f"more than {len(rows)}" if getattr(result, "truncated", False) else len(rows)
+    lines.append(f"({shown} of {total_rows} rows shown)")
+    for i in keep:
+        values = [float(row[i]) for row in rows
+                  if isinstance(row[i], (int, float, Decimal)) and not isinstance(row[i], bool)]
+        if len(values) == len(rows):
+            lines.append(f"{columns[i]}: min {format_value(min(values))}, max {format_value(max(values))}, "
+                         f"avg {format_value(sum(values) / len(values))}")
+    return "\n".join(lines)
+
+def translate_tsql_to_sqlite(sql: str) -> str:
+    """
+    Translates the T-SQL constructs our prompts produce into SQLite: bracketed
+    identifiers, the dbo schema prefix, TOP n (to LIMIT n), N'' literals, NOLOCK
+    hints and a few function names. String literals are left untouched.
+    Args:
+        sql (str): The T-SQL query.
+    Returns:
+        str: The SQLite query.
+    Raises:
+        ValueError: If the query uses TOP anywhere but in the outer SELECT, or TOP PERCENT / WITH TIES.
+    """
+    functions = {"GETDATE": "CURRENT_TIMESTAMP", "LEN": "LENGTH", "ISNULL": "IFNULL", "COUNT_BIG": "COUNT"}
+
+    def replace(match):
+        token = match.group()
+        if token.startswith("'"):
+            return token
+        if token[0] in "Nn" and token[1:2] == "'":
+            return token[1:]
+        if re.fullmatch(r'WITH\s*\(\s*NOLOCK\s*\)|(?:\[dbo\]|dbo)\s*\.\s*', token, re.IGNORECASE):
+            return ""
+        if token.startswith("["):
+            return '"' + token[1:-1].replace('"', '""') + '"'
+        return functions.get(token.upper(), token)
+
+    sql = re.sub(r"'(?:[^']|'')*'|[Nn]'(?:[^']|'')*'|(?:\[dbo\]|\bdbo)\s*\.\s*|\[[^\]]*\]|WITH\s*\(\s*NOLOCK\s*\)"
+                 r"|\b(?:GETDATE|LEN|ISNULL|COUNT_BIG)\b(?=\s*\()",
+                 replace, sql, flags=re.IGNORECASE)
+    sql = re.sub(r"CURRENT_TIMESTAMP\s*\(\s*\)", "CURRENT_TIMESTAMP", sql)
+
+    sql = sql.strip().rstrip(";").rstrip()
+    # Look for TOP with the string literals blanked out, so positions still line up with `sql`
+    masked = re.sub(r"'(?:[^']|'')*'", lambda match: "'" + " " * (len(match.group()) - 2) + "'", sql)
+    tops = list(re.finditer(r"\bTOP\s*(?:\(\s*(\d+)\s*\)|(\d+))(\s+PERCENT|\s+WITH\s+TIES)?\s*", masked, re.IGNORECASE))
+    if not tops:
+        return sql
+    outer = re.match(r"\s*SELECT(?:\s+(?:DISTINCT|ALL))?\s+", masked, re.IGNORECASE)
+    top = tops[0]
+    if len(tops) > 1 or top.group(3) or not outer or top.start() != outer.end():
+        raise ValueError("Only a plain TOP n on the outer SELECT can be translated.")
+    return f"{sql[:top.start()]}{sql[top.end():]} LIMIT {top.group(1) or top.group(2)}"
+
 # --- Classes ---
 
+class InMemoryVectorIndex:
+    """
+    In-process cosine similarity index over the business question embeddings.
+    Embeddings are kept L2-normalized in one contiguous float32 matrix so a
+    search is a single matrix-vector product followed by an argpartition top-k.
+    """
+    def __init__(self, vector_dimensions: int):
+        self.vector_dimensions = vector_dimensions
+        self._lock = threading.Lock()
+        # Readers take a reference to this tuple; writers replace it as a whole.
+        self._state = ([], [], np.empty((0, vector_dimensions), dtype=np.float32))
+
+    def __len__(self) -> int:
+        return len(self._state[0])
+
+    def _normalize(self, vectors: np.ndarray) -> np.ndarray:
+        """Returns a float32 copy of `vectors` with every row scaled to unit length."""
+        vectors = np.asarray(vectors, dtype=np.float32).reshape(-1, self.vector_dimensions)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return np.ascontiguousarray(vectors / norms, dtype=np.float32)
+
+    def upsert(self, keys: List[str], fields: List[Dict[str, Any]], embeddings: Any):
+        """
+        Adds or replaces documents in the index.
+        Args:
+            keys (List[str]): The Redis keys of the documents.
+            fields (List[Dict[str, Any]]): The returned fields of each document.
+            embeddings (Any): A (len(keys), vector_dimensions) array-like of embeddings.
+        """
+        vectors = self._normalize(embeddings)
+        with self._lock:
+            old_keys, old_fields, old_matrix = self._state
+            positions = {key: i for i, key in enumerate(old_keys)}
+            new_keys, new_fields = list(old_keys), list(old_fields)
+            matrix = old_matrix.copy()
+            appended = []
+            for key, doc, vector in zip(keys, fields, vectors):
+                if key in positions:
+                    new_fields[positions[key]] = doc
+                    matrix[positions[key]] = vector
+                else:
+                    positions[key] = len(new_keys)
+                    new_keys.append(key)
+                    new_fields.append(doc)
+                    appended.append(vector)
+            if appended:
+                matrix = np.vstack([matrix, np.stack(appended)])
+            self._state = (new_keys, new_fields, np.ascontiguousarray(matrix))
+
+    def remove(self, keys: List[str]):
+        """Removes the given keys from the index, ignoring unknown ones."""
+        drop = set(keys)
+        with self._lock:
+            old_keys, old_fields, old_matrix = self._state
+            keep = [i for i, key in enumerate(old_keys) if key not in drop]
+            self._state = (
+                [old_keys[i] for i in keep],
+                [old_fields[i] for i in keep],
+                np.ascontiguousarray(old_matrix[keep]),
+            )
+
+    def clear(self):
+        """Removes every document from the index."""
+        with self._lock:
+            self._state = ([], [], np.empty((0, self.vector_dimensions), dtype=np.float32))
+
+    def search(self, query_embedding: Any, top_k: int) -> List[Document]:
+        """
+        Finds the `top_k` documents closest to `query_embedding` by cosine distance.
+        Args:
+            query_embedding (Any): The embedding of the user question.
+            top_k (int): The number of results to return.
+        Returns:
+            List[Document]: Documents shaped like a RediSearch KNN result, sorted by
+                            ascending cosine distance in the `score` field, with the
+                            Redis key as `id`.
+        """
+        keys, fields, matrix = self._state
+        if not keys or top_k <= 0:
+            return []
+        query = self._normalize(query_embedding)[0]
+        distances = 1.0 - matrix @ query
+        k = min(top_k, len(keys))
+        if k < len(keys):
+            candidates = np.argpartition(distances, k - 1)[:k]
+        else:
+            candidates = np.arange(len(keys))
+        ordered = candidates[np.argsort(distances[candidates], kind="stable")]
+        return [
+            # Like redis-py, a stored "id" field never shadows the document key
+            Document(id=keys[i], payload=None, score=str(float(distances[i])),
+                     **{name: value for name, value in fields[i].items() if name != "id"})
+            for i in ordered
+        ]
+
+class LoopLocal:
+    """
+    Holds one instance of an async client per running event loop, created on first use
+    by `factory`. Async Redis and Ollama clients keep connections bound to the loop that
+    opened them, so a client created in one `asyncio.run` must not be reused in the next.
+    """
+    def __init__(self, factory: Callable[[], Any]):
+        self.factory = factory
+        self._instances = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+
+    def get(self) -> Any:
+        """Returns the instance for the running event loop, creating it if needed."""
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            instance = self._instances.get(loop)
+            if instance is None:
+                instance = self._instances[loop] = self.factory()
+            return instance
+
+class EmbeddingCache:
+    """
+    Two-tier cache of query embeddings keyed on the normalized question text and
+    the embedding model name. The first tier is an in-process LRU; the second is
+    shared through Redis with a TTL so every process benefits from a hit.
+    `aget` and `aput` reach the second tier through `async_client`, which holds the
+    async Redis client of each event loop.
+    """
+    def __init__(self, client: redis.Redis, model_name: str, max_size: int = EMBEDDING_CACHE_SIZE,
+                 ttl_seconds: int = EMBEDDING_CACHE_TTL_SECONDS, prefix: str = EMBEDDING_CACHE_PREFIX,
+                 async_client: LoopLocal = None):
+        self.client = client # Must not decode responses, embeddings are raw float32 bytes
+        self.async_client = async_client # Same requirement
+        self.model_name = model_name
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self.prefix = prefix
+        self._lru: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+        self.local_hits = 0
+        self.redis_hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def normalize(text: str) -> str:
+        """Lowercases, collapses whitespace and drops trailing punctuation."""
+        return re.sub(r"\s+", " ", text.strip().lower()).rstrip(" ?!.")
+
+    def _key(self, text: str) -> str:
+        digest = hashlib.sha256(f"{self.model_name}\x1f{self.normalize(text)}".encode("utf-8")).hexdigest()
+        return f"{self.prefix}{digest}"
+
+    def get(self, text: str) -> np.ndarray | None:
+        """Returns the cached embedding of `text`, or None on a miss in both tiers."""
+        key = self._key(text)
+        embedding = self._get_local(key)
+        if embedding is not None:
+            return embedding
+        try:
+            data = self.client.get(key)
+        except redis.exceptions.RedisError as e:
+            print(f"Embedding cache lookup failed: {e}")
+            data = None
+        return self._from_redis(key, data)
+
+    async def aget(self, text: str) -> np.ndarray | None:
+        """Async variant of `get`."""
+        key = self._key(text)
+        embedding = self._get_local(key)
+        if embedding is not None:
+            return embedding
+        try:
+            data = await self.async_client.get().get(key)
+        except redis.exceptions.RedisError as e:
+            print(f"Embedding cache lookup failed: {e}")
+            data = None
+        return self._from_redis(key, data)
+
+    def put(self, text: str, embedding: Any):
+        """Stores the embedding of `text` in both tiers."""
+        key = self._key(text)
+        embedding = np.array(embedding, dtype=np.float32)
+        self._put_local(key, embedding)
+        try:
+            self.client.set(key, embedding.tobytes(), ex=self.ttl_seconds)
+        except redis.exceptions.RedisError as e:
+            print(f"Embedding cache write failed: {e}")
+
+    async def aput(self, text: str, embedding: Any):
+        """Async variant of `put`."""
+        key = self._key(text)
+        embedding = np.array(embedding, dtype=np.float32)
+        self._put_local(key, embedding)
+        try:
+            await self.async_client.get().set(key, embedding.tobytes(), ex=self.ttl_seconds)
+        except redis.exceptions.RedisError as e:
+            print(f"Embedding cache write failed: {e}")
+
+    def _get_local(self, key: str) -> np.ndarray | None:
+        with self._lock:
+            if key in self._lru:
+                self._lru.move_to_end(key)
+                self.local_hits += 1
+                return self._lru[key]
+        return None
+
+    def _from_redis(self, key: str, data: bytes | None) -> np.ndarray | None:
+        with self._lock:
+            if data is None:
+                self.misses += 1
+                return None
+            self.redis_hits += 1
+        embedding = np.frombuffer(data, dtype=np.float32)
+        self._put_local(key, embedding)
+        return embedding
+
+    def _put_local(self, key: str, embedding: np.ndarray):
+        with self._lock:
+            self._lru[key] = embedding
+            self._lru.move_to_end(key)
+            while len(self._lru) > self.max_size:
+                self._lru.popitem(last=False)
+
+    def stats(self) -> Dict[str, Any]:
+        """Returns the hit and miss counters of both tiers."""
+        with self._lock:
+            lookups = self.local_hits + self.redis_hits + self.misses
+            return {
+                "local_hits": self.local_hits,
+                "redis_hits": self.redis_hits,
+                "misses": self.misses,
+                "hit_rate": (self.local_hits + self.redis_hits) / lookups if lookups else 0.0,
+                "local_size": len(self._lru)
+            }
+
+class SemanticAnswerCache:
+    """
+    In-process cache of final answers keyed by question embedding. A lookup hits
+    when a cached question lies within `max_distance` cosine distance of the new
+    one and names the same slot values, since questions differing only in a brand
+    or a NutriScore grade embed close together. Answers written with chat history
+    are only served back to their own session. Entries expire after `ttl_seconds`
+    and are dropped when one of the tables their SQL read from changes.
+    """
+    def __init__(self, max_distance: float = ANSWER_CACHE_MAX_DISTANCE,
+                 ttl_seconds: int = ANSWER_CACHE_TTL_SECONDS, max_size: int = ANSWER_CACHE_SIZE):
+        self.max_distance = max_distance
+        self.ttl_seconds = ttl_seconds
+        self.max_size = max_size
+        self._entries: List[Dict[str, Any]] = []
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _expire(self, now: float):
+        self._entries = [entry for entry in self._entries if now - entry["created_at"] < self.ttl_seconds]
+
+    def get(self, embedding: Any, slots: Dict[str, Any] = None, session_id: str = None) -> str | None:
+        """
+        Returns the cached answer of the closest recent question, if close enough.
+        Args:
+            embedding (Any): The embedding of the new question.
+            slots (Dict[str, Any], optional): The slot values named in the new question.
+            session_id (str, optional): The session asking; answers written with the chat
+                                        history of another session are never returned.
+        Returns:
+            str | None: The cached answer, or None on a miss.
+        """
+        query = np.asarray(embedding, dtype=np.float32)
+        query = query / (np.linalg.norm(query) or 1.0)
+        slots = slots or {}
+        with self._lock:
+            self._expire(time.monotonic())
+            candidates = [entry for entry in self._entries
+                          if entry["slots"] == slots and entry["session_id"] in (None, session_id)]
+            if candidates:
+                distances = 1.0 - np.stack([entry["embedding"] for entry in candidates]) @ query
+                best = int(np.argmin(distances))
+                if distances[best] <= self.max_distance:
+                    self.hits += 1
+                    print(f"Answer cache hit (distance {distances[best]:.4f}): '{candidates[best]['question']}'")
+                    return candidates[best]["answer"]
+            self.misses += 1
+            return None
+
+    def put(self, question: str, embedding: Any, answer: str, tables: List[str], slots: Dict[str, Any] = None,
+            session_id: str = None):
+        """
+        Caches the final answer of a question.
+        Args:
+            question (str): The user question.
+            embedding (Any): The embedding of the question.
+            answer (str): The final answer.
+            tables (List[str]): The tables the answer was computed from.
+            slots (Dict[str, Any], optional): The slot values named in the question.
+            session_id (str, optional): The session whose chat history the answer was written
+                                        with; None when it was written without history.
+        """
+        vector = np.asarray(embedding, dtype=np.float32)
+        vector = vector / (np.linalg.norm(vector) or 1.0)
+        with self._lock:
+            self._entries.append({
+                "question": question, "embedding": vector, "answer": answer, "tables": set(tables),
+                "slots": slots or {}, "session_id": session_id, "created_at": time.monotonic()
+            })
+            del self._entries[:-self.max_size]
+
+    def invalidate(self, tables: List[str] = None):
+        """
+        Drops cached answers.
+        Args:
+            tables (List[str], optional): Only drop answers that read from these tables.
+                                          Every entry is dropped when omitted.
+        """
+        with self._lock:
+            if tables is None:
+                self._entries = []
+            else:
+                changed = set(tables)
+                self._entries = [entry for entry in self._entries if not entry["tables"] & changed]
+
+    def stats(self) -> Dict[str, Any]:
+        """Returns the hit and miss counters."""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {"hits": self.hits, "misses": self.misses, "size": len(self._entries),
+                    "hit_rate": self.hits / lookups if lookups else 0.0}
+
 class RedisVectorStore:
     """
     Manages connection and operations with a Redis vector database.
     Handles index creation, data ingestion, and vector search.
     """
-    def __init__(self, host: str, port: int, password: str, index_name: str, doc_prefix: str):
+    def __init__(self, host: str, port: int, password: str, index_name: str, doc_prefix: str,
+                 vector_dimensions: int = VECTOR_DIMENSIONS, use_local_index: bool = USE_LOCAL_VECTOR_INDEX,
+                 precision: str = VECTOR_PRECISION):
+        if precision not in VECTOR_DTYPES:
+            raise ValueError(f"Unsupported vector precision: {precision}")
         self.client = redis.Redis(host=host, port=port, password=password, decode_responses=True)
+        # Embeddings are raw bytes, so reading them back needs a client that does not decode responses.
+        self.binary_client = redis.Redis(host=host, port=port, password=password, decode_responses=False)
+        # Async counterparts for the asyncio pipeline, created per event loop on first use
+        self._async_clients = LoopLocal(lambda: redis.asyncio.Redis(host=host, port=port, password=password,
+                                                                    decode_responses=True))
+        self._async_binary_clients = LoopLocal(lambda: redis.asyncio.Redis(host=host, port=port, password=password,
+                                                                           decode_responses=False))
         self.index_name = index_name
         self.doc_prefix = doc_prefix
-        self.embeddings_model = OllamaEmbeddings(model="mxbai-embed-large") # Initialize embedding model here
+        self.precision = precision
+        self.embeddings_model = OllamaEmbeddings(model="mxbai-embed-large", # Initialize embedding model here
+                                                 client_kwargs={"timeout": REQUEST_DEADLINE_SECONDS})
+        self._async_embeddings_models = LoopLocal(lambda: OllamaEmbeddings(
+            model=self.embeddings_model.model, client_kwargs={"timeout": REQUEST_DEADLINE_SECONDS}))
+        self.local_index = InMemoryVectorIndex(vector_dimensions) if use_local_index else None
+        self.embedding_cache = EmbeddingCache(self.binary_client, self.embeddings_model.model,
+                                              async_client=self._async_binary_clients)
+
+    @property
+    def async_client(self) -> redis.asyncio.Redis:
+        """The async Redis client of the running event loop."""
+        return self._async_clients.get()
+
+    @property
+    def async_embeddings_model(self) -> OllamaEmbeddings:
+        """The embedding model whose async Ollama client belongs to the running event loop."""
+        return self._async_embeddings_models.get()
 
     def _check_connection(self):
         """Pings Redis to check connection."""
@@ -159,157 +1028,1705 @@ class RedisVectorStore:
             print(f"Redis connection error: {e}")
             raise
 
-    def create_index(self, vector_dimensions: int):
+    def create_index(self, vector_dimensions: int, algorithm: str = INDEX_ALGORITHM, m: int = HNSW_M,
+                     ef_construction: int = HNSW_EF_CONSTRUCTION, ef_runtime: int = HNSW_EF_RUNTIME,
+                     drop_existing: bool = False):
         """
         Creates a RediSearch index for vector similarity search if it doesn't exist.
         Args:
             vector_dimensions (int): The dimension of the embeddings.
+            algorithm (str): "FLAT" for exact search or "HNSW" for approximate search.
+            m (int): HNSW only. Maximum number of outgoing edges per node and layer.
+            ef_construction (int): HNSW only. Candidate list size while building the graph.
+            ef_runtime (int): HNSW only. Default candidate list size at query time.
+            drop_existing (bool): Drop an existing index (keeping its documents) and recreate it,
+                                  e.g. to switch algorithm or HNSW settings.
         """
         self._check_connection()
+        algorithm = algorithm.upper()
+        if algorithm not in ("FLAT", "HNSW"):
+            raise ValueError(f"Unsupported vector index algorithm: {algorithm}")
         try:
             self.client.ft(self.index_name).info()
-            print(f"Index '{self.index_name}' already exists!")
-        except Exception: # RediSearch throws an exception if index doesn't exist
-            schema = (
-                NumericField('id'),
-                TextField('business_question'),
-                TextField('business_query'),
-                VectorField('embedding',
-                    'FLAT', {
-                    "TYPE": "FLOAT32",
-                    "DIM": vector_dimensions,
-                    "DISTANCE_METRIC": "COSINE"
-                })
-            )
-            definition = IndexDefinition(prefix=[self.doc_prefix], index_type=IndexType.HASH)
-            self.client.ft(self.index_name).create_index(fields=schema, definition=definition)
-            print(f"Index '{self.index_name}' created successfully.")
+            if not drop_existing:
+                print(f"Index '{self.index_name}' already exists!")
+                return
+            self.client.ft(self.index_name).dropindex(delete_documents=False)
+            print(f"Index '{self.index_name}' dropped.")
+        except redis.exceptions.ResponseError: # RediSearch throws an exception if index doesn't exist
+            pass
+
+        attributes = {
+            "TYPE": self.precision,
+            "DIM": vector_dimensions,
+            "DISTANCE_METRIC": "COSINE"
+        }
+        if algorithm == "HNSW":
+            attributes.update({"M": m, "EF_CONSTRUCTION": ef_construction, "EF_RUNTIME": ef_runtime})
+        schema = (
+            NumericField('id'),
+            TextField('business_question'),
+            TextField('business_query'),
+            VectorField('embedding', algorithm, attributes)
+        )
+        definition = IndexDefinition(prefix=[self.doc_prefix], index_type=IndexType.HASH)
+        self.client.ft(self.index_name).create_index(fields=schema, definition=definition)
+        print(f"Index '{self.index_name}' ({algorithm}) created successfully.")
 
-    def ingest_data(self, data: List[Dict[str, Any]]):
+    def ingest_data(self, data: List[Dict[str, Any]], batch_size: int = INGEST_BATCH_SIZE,
+                    max_workers: int = INGEST_MAX_WORKERS) -> Dict[str, float]:
         """
         Ingests data into Redis, generating embeddings for business questions.
+        Questions are embedded in batches with one `embed_documents` call each, and
+        every batch is written with a single pipelined round trip. Batches run on a
+        bounded thread pool so the embedding model and Redis are kept busy.
         Args:
             data (List[Dict[str, Any]]): A list of dictionaries, each containing
                                          'id', 'business_question', and 'business_query'.
+            batch_size (int): Number of questions embedded per model call.
+            max_workers (int): Maximum number of batches processed concurrently.
+        Returns:
+            Dict[str, float]: The number of documents ingested, the elapsed seconds
+                              and the throughput in documents per second.
         """
         self._check_connection()
         print("Ingesting data into Redis...")
-        pipe = self.client.pipeline()
-        for obj in data:
-            key = f"{self.doc_prefix}{obj['id']}"
-            # Generate embeddings for the business question
-            embeddings = self.embeddings_model.embed_documents(obj['business_question'])[0]
-            obj["embedding"] = np.array(embeddings, dtype=np.float32).tobytes()
-            pipe.hset(key, mapping=obj)
+        start_time = time.perf_counter()
+        batches = [data[i:i + batch_size] for i in range(0, len(data), batch_size)]
+        ingested = 0
+        if batches:
+            with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(batches)))) as executor:
+                for count in executor.map(self._ingest_batch, batches):
+                    ingested += count
+        elapsed = time.perf_counter() - start_time
+        docs_per_sec = ingested / elapsed if elapsed > 0 else 0.0
+        print(f"Ingested {ingested} documents into Redis in {elapsed:.2f}s ({docs_per_sec:.1f} docs/sec).")
+        return {"documents": ingested, "seconds": elapsed, "docs_per_sec": docs_per_sec}
+
+    def _ingest_batch(self, batch: List[Dict[str, Any]]) -> int:
+        """
+        Embeds one batch of business questions and writes it to Redis.
+        Args:
+            batch (List[Dict[str, Any]]): The examples to ingest.
+        Returns:
+            int: The number of documents written.
+        """
+        embeddings = np.array(
+            self.embeddings_model.embed_documents([obj["business_question"] for obj in batch]),
+            dtype=np.float32
+        )
+        keys = [f"{self.doc_prefix}{obj['id']}" for obj in batch]
+        pipe = self.client.pipeline(transaction=False)
+        for key, obj, embedding in zip(keys, batch, embeddings):
+            vector, scale = encode_embedding(embedding, self.precision)
+            pipe.hset(key, mapping={**obj, "embedding": vector, "embedding_scale": scale,
+                                    "content_hash": self._content_hash(obj)})
         res = pipe.execute()
-        print(f"Ingested {len(res)} documents into Redis.")
+        if self.local_index is not None:
+            self.local_index.upsert(
+                keys=keys,
+                fields=[{"business_question": obj["business_question"], "business_query": obj["business_query"]} for obj in batch],
+                embeddings=embeddings
+            )
+        return len(res)
+
+    def _content_hash(self, obj: Dict[str, Any]) -> str:
+        """Hashes the question, the query, the embedding model name and the storage precision of an example."""
+        content = "\x1f".join([self.embeddings_model.model, self.precision, obj["business_question"], obj["business_query"]])
+        return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+    def sync_data(self, data: List[Dict[str, Any]]) -> Dict[str, int]:
+        """
+        Incrementally brings Redis in line with `data`. Only examples that are new or
+        whose content hash changed are re-embedded; examples no longer present are
+        deleted by key. An unchanged corpus is synced without any embedding call.
+        Args:
+            data (List[Dict[str, Any]]): A list of dictionaries, each containing
+                                         'id', 'business_question', and 'business_query'.
+        Returns:
+            Dict[str, int]: The number of added, updated, deleted and unchanged examples,
+                            plus the number of learned examples that were kept.
+        """
+        self._check_connection()
+        wanted = {f"{self.doc_prefix}{obj['id']}": obj for obj in data}
+        existing_keys = list(self.client.scan_iter(match=f"{self.doc_prefix}*"))
+        pipe = self.client.pipeline(transaction=False)
+        for key in existing_keys:
+            pipe.hmget(key, "content_hash", "source")
+        stored = dict(zip(existing_keys, pipe.execute()))
+        stored_hashes = {key: content_hash for key, (content_hash, source) in stored.items()}
+        # Learned examples are not part of the curated corpus and must survive the sync
+        learned = [key for key, (content_hash, source) in stored.items() if source == "learned"]
+        if learned:
+            # Track learned examples stored before eviction existed, so they age out like the others
+            self.client.zadd(self.learned_set_key, {key: time.time() for key in learned}, nx=True)
+
+        to_ingest, added, updated = [], 0, 0
+        for key, obj in wanted.items():
+            stored_hash = stored_hashes.get(key)
+            if stored_hash is None:
+                added += 1
+                to_ingest.append(obj)
+            elif stored_hash != self._content_hash(obj):
+                updated += 1
+                to_ingest.append(obj)
+        removed = [key for key in existing_keys if key not in wanted and stored[key][1] != "learned"]
+
+        if removed:
+            self.client.delete(*removed)
+            if self.local_index is not None:
+                self.local_index.remove(removed)
+        if to_ingest:
+            self.ingest_data(to_ingest)
+        if self.local_index is not None and len(self.local_index) != len(wanted) + len(learned):
+            self.load_local_index()
+
+        stats = {"added": added, "updated": updated, "deleted": len(removed),
+                 "unchanged": len(wanted) - len(to_ingest), "learned": len(learned)}
+        print(f"Synced examples with Redis: {stats}")
+        return stats
+
+    @property
+    def learned_set_key(self) -> str:
+        """Sorted set of the learned example keys, scored by when they were last promoted."""
+        return f"{self.index_name}:learned"
+
+    def learned_key(self, question: str) -> str:
+        """The key of the learned example of a question; derived from the normalized question."""
+        digest = hashlib.sha256(EmbeddingCache.normalize(question).encode("utf-8")).hexdigest()
+        return f"{self.doc_prefix}{int(digest[:13], 16)}"
+
+    def record_learning_candidate(self, question: str, query: str) -> int:
+        """
+        Counts a successful answer of a question by a generated query.
+        Args:
+            question (str): The user question.
+            query (str): The SQL query that answered it.
+        Returns:
+            int: How many times this query answered this question within LEARNED_EXAMPLE_TTL_SECONDS.
+        """
+        digest = hashlib.sha256(f"{EmbeddingCache.normalize(question)}\x1f{query}".encode("utf-8")).hexdigest()
+        pipe = self.client.pipeline(transaction=False)
+        pipe.incr(f"{LEARNED_CANDIDATE_PREFIX}{digest}")
+        pipe.expire(f"{LEARNED_CANDIDATE_PREFIX}{digest}", LEARNED_EXAMPLE_TTL_SECONDS)
+        return int(pipe.execute()[0])
 
-    def search_similar_questions(self, user_question: str, top_k: int = 6) -> List[Any]:
+    def add_learned_example(self, question: str, query: str, embedding: Any) -> str:
+        """
+        Stores a question and the SQL that answered it as a new few-shot example,
+        reusing the question embedding that was already computed. The id is derived
+        from the normalized question, so repeating a question replaces its example.
+        Learned examples beyond LEARNED_EXAMPLES_MAX or older than the TTL are evicted.
+        Args:
+            question (str): The user question.
+            query (str): The SQL query that executed successfully.
+            embedding (Any): The embedding of the question.
+        Returns:
+            str: The Redis key of the example.
+        """
+        key = self.learned_key(question)
+        obj = {"id": int(key[len(self.doc_prefix):]), "business_question": question, "business_query": query}
+        vector, scale = encode_embedding(embedding, self.precision)
+        pipe = self.client.pipeline(transaction=False)
+        pipe.hset(key, mapping={**obj, "embedding": vector, "embedding_scale": scale,
+                                "content_hash": self._content_hash(obj), "source": "learned"})
+        pipe.zadd(self.learned_set_key, {key: time.time()})
+        pipe.execute()
+        if self.local_index is not None:
+            self.local_index.upsert([key], [{"business_question": question, "business_query": query}], [embedding])
+        print(f"Stored learned example '{key}' for: '{question}'")
+        self.evict_learned_examples()
+        return key
+
+    def evict_learned_examples(self, max_examples: int = LEARNED_EXAMPLES_MAX,
+                               ttl_seconds: int = LEARNED_EXAMPLE_TTL_SECONDS) -> int:
+        """
+        Deletes the learned examples not promoted within `ttl_seconds`, then the least
+        recently promoted ones beyond `max_examples`.
+        Returns:
+            int: The number of examples deleted.
+        """
+        expired = self.client.zrangebyscore(self.learned_set_key, "-inf", time.time() - ttl_seconds)
+        excess = self.client.zcard(self.learned_set_key) - len(expired) - max_examples
+        oldest = self.client.zrange(self.learned_set_key, len(expired), len(expired) + excess - 1) if excess > 0 else []
+        evicted = expired + oldest
+        if evicted:
+            pipe = self.client.pipeline(transaction=False)
+            pipe.delete(*evicted)
+            pipe.zrem(self.learned_set_key, *evicted)
+            pipe.execute()
+            if self.local_index is not None:
+                self.local_index.remove(evicted)
+            print(f"Evicted {len(evicted)} learned examples.")
+        return len(evicted)
+
+    def load_local_index(self):
+        """
+        Rebuilds the in-process index from the documents persisted in Redis,
+        e.g. when the examples were ingested by another process.
+        """
+        if self.local_index is None:
+            return
+        self._check_connection()
+        keys = list(self.binary_client.scan_iter(match=f"{self.doc_prefix}*"))
+        pipe = self.binary_client.pipeline(transaction=False)
+        for key in keys:
+            pipe.hgetall(key)
+        doc_keys, fields, embeddings = [], [], []
+        for key, doc in zip(keys, pipe.execute()):
+            if b"embedding" not in doc:
+                continue
+            doc_keys.append(key.decode())
+            fields.append({
+                "business_question": doc.get(b"business_question", b"").decode(),
+                "business_query": doc.get(b"business_query", b"").decode()
+            })
+            embeddings.append(decode_embedding(doc[b"embedding"], self.precision, float(doc.get(b"embedding_scale", 1.0))))
+        self.local_index.clear()
+        if doc_keys:
+            self.local_index.upsert(doc_keys, fields, np.stack(embeddings))
+        print(f"Loaded {len(doc_keys)} documents into the local vector index.")
+
+    def embed_query(self, text: str) -> np.ndarray:
+        """
+        Embeds a user question, skipping the embedding model when the normalized
+        question is already in the query embedding cache.
+        Args:
+            text (str): The question to embed.
+        Returns:
+            np.ndarray: The float32 embedding.
         """
-        Performs a vector similarity search in Redis to find similar business questions.
+        embedding = self.embedding_cache.get(text)
+        if embedding is None:
+            embedding = np.array(self.embeddings_model.embed_query(text), dtype=np.float32)
+            self.embedding_cache.put(text, embedding)
+        return embedding
+
+    async def aembed_query(self, text: str) -> np.ndarray:
+        """Async variant of `embed_query`, using the async Redis and Ollama clients."""
+        embedding = await self.embedding_cache.aget(text)
+        if embedding is None:
+            embedding = np.array(await self.async_embeddings_model.aembed_query(text), dtype=np.float32)
+            await self.embedding_cache.aput(text, embedding)
+        return embedding
+
+    def search_similar_questions(self, user_question: str, top_k: int = 6, embedding: Any = None) -> List[Any]:
+        """
+        Performs a vector similarity search to find similar business questions.
+        The in-process index is used when it is enabled and populated; otherwise
+        the KNN query runs in Redis.
         Args:
             user_question (str): The question asked by the user.
             top_k (int): The number of top similar results to retrieve.
+            embedding (Any, optional): The embedding of the question, if already computed.
+        Returns:
+            List[Any]: A list of search results, sorted by ascending cosine distance.
+        """
+        print(f"Searching for similar questions to: '{user_question}'")
+        user_question_embedding = self.embed_query(user_question) if embedding is None else embedding
+
+        if self.local_index is not None and len(self.local_index) > 0:
+            results = self.local_index.search(user_question_embedding, top_k)
+            print(f"Found {len(results)} similar questions.")
+            return results
+
+        results = self.search_by_embedding(user_question_embedding, top_k)
+        print(f"Found {len(results)} similar questions.")
+        return results
+
+    async def asearch_similar_questions(self, user_question: str, top_k: int = 6, embedding: Any = None) -> List[Any]:
+        """Async variant of `search_similar_questions`; the in-process index is searched inline."""
+        print(f"Searching for similar questions to: '{user_question}'")
+        user_question_embedding = await self.aembed_query(user_question) if embedding is None else embedding
+
+        if self.local_index is not None and len(self.local_index) > 0:
+            results = self.local_index.search(user_question_embedding, top_k)
+        else:
+            query, query_params = self._knn_query(user_question_embedding, top_k)
+            results = (await self.async_client.ft(self.index_name).search(query, query_params)).docs
+        print(f"Found {len(results)} similar questions.")
+        return results
+
+    def search_by_embedding(self, embedding: Any, top_k: int = 6, ef_runtime: int = None) -> List[Any]:
+        """
+        Runs a KNN query in Redis for an already computed embedding.
+        Args:
+            embedding (Any): The query embedding.
+            top_k (int): The number of top similar results to retrieve.
+            ef_runtime (int, optional): HNSW only. Overrides the index EF_RUNTIME for this query.
         Returns:
             List[Any]: A list of search results from Redis.
         """
         self._check_connection()
-        print(f"Searching for similar questions to: '{user_question}'")
-        user_question_embedding = self.embeddings_model.embed_documents(user_question)[0]
-        
-        query = Query(f"(*)=>[KNN {top_k} @embedding $vec AS score]") \
+        query, query_params = self._knn_query(embedding, top_k, ef_runtime)
+        return self.client.ft(self.index_name).search(query, query_params).docs
+
+    def _knn_query(self, embedding: Any, top_k: int, ef_runtime: int = None) -> tuple[Query, Dict[str, Any]]:
+        ef_clause = " EF_RUNTIME $ef" if ef_runtime else ""
+        query = Query(f"(*)=>[KNN {top_k} @embedding $vec{ef_clause} AS score]") \
             .return_fields("id", "business_question", "business_query", "score") \
             .sort_by("score") \
             .dialect(2) \
             .paging(0, top_k)
-        
-        query_params = {"vec": np.array(user_question_embedding, dtype=np.float32).tobytes()}
-        
-        results = self.client.ft(self.index_name).search(query, query_params).docs
-        print(f"Found {len(results)} similar questions.")
-        return results
 
-class SQLDatabaseManager:
+        query_params = {"vec": encode_embedding(embedding, self.precision)[0]}
+        if ef_runtime:
+            query_params["ef"] = ef_runtime
+        return query, query_params
+
+class IntentTemplate:
     """
-    Manages connections and queries to the SQL Server database.
+    A business query with its literals turned into typed slots. Built from an
+    example's SQL: quoted values compared with a column in TEMPLATE_SLOT_COLUMNS
+    and the TOP count become slots that can be re-bound to other values.
     """
-    def __init__(self, connection_string: str):
-        self.connection_string = connection_string
-        self.conn = None
+    LITERAL_PATTERN = re.compile(
+        r"\b(?:\[?\w+\]?\.)?\[?(" + "|".join(TEMPLATE_SLOT_COLUMNS) + r")\]?\s*(=|LIKE)\s*N?'(%?)((?:[^']|'')*?)(%?)'",
+        re.IGNORECASE
+    )
+    TOP_PATTERN = re.compile(r"\bTOP\s*\(?\s*(\d+)\s*\)?", re.IGNORECASE)
+
+    def __init__(self, sql: str):
+        self.sql = sql
+        self.slots: List[Dict[str, Any]] = [] # Ordered by position in the SQL
+        columns = {column.upper(): slot for column, slot in TEMPLATE_SLOT_COLUMNS.items()}
+        for match in self.LITERAL_PATTERN.finditer(sql):
+            self.slots.append({
+                "type": columns[match.group(1).upper()], "start": match.start(4), "end": match.end(4),
+                "value": match.group(4).replace("''", "'")
+            })
+        top = self.TOP_PATTERN.search(sql)
+        if top:
+            self.slots.append({"type": "top_n", "start": top.start(1), "end": top.end(1), "value": int(top.group(1))})
+        self.slots.sort(key=lambda slot: slot["start"])
+        self.slot_types = {slot["type"] for slot in self.slots}
+
+    def render(self, values: Dict[str, Any]) -> str:
+        """
+        Substitutes slot values into the query. String values are escaped as SQL
+        literals and top-N values are cast to int.
+        Args:
+            values (Dict[str, Any]): Slot type -> value; missing slots keep the example's value.
+        Returns:
+            str: The SQL query.
+        """
+        sql, offset = self.sql, 0
+        for slot in self.slots:
+            value = values.get(slot["type"], slot["value"])
+            text = str(int(value)) if slot["type"] == "top_n" else str(value).replace("'", "''")
+            sql = sql[:slot["start"] + offset] + text + sql[slot["end"] + offset:]
+            offset += len(text) - (slot["end"] - slot["start"])
+        return sql
+
+class IntentTemplateEngine:
+    """
+    Answers known intents without the SQL-generation LLM. The query of the
+    closest example is parsed into an IntentTemplate, slot values are extracted
+    from the user question, and the template is rendered when every slot the
+    question mentions is one the template has.
+    """
+    def __init__(self, examples: List[Dict[str, Any]] = None):
+        self.vocabulary: Dict[str, set] = {slot: set() for slot in TEMPLATE_VOCABULARY_SOURCES}
+        self._templates: Dict[str, IntentTemplate] = {}
+        self._lock = threading.Lock()
+        self.non_template_questions = {EmbeddingCache.normalize(example["business_question"])
+                                       for example in BUSINESS_QUESTIONS_DATA if example["id"] in NON_TEMPLATE_EXAMPLE_IDS}
+        # Seed the vocabulary with the values used by the examples themselves
+        for example in examples or []:
+            for slot in self.template_for(example["business_query"]).slots:
+                if slot["type"] in self.vocabulary and slot["value"].strip():
+                    self.vocabulary[slot["type"]].add(slot["value"].strip())
+
+    def load_vocabulary(self, db_manager: "SQLDatabaseManager"):
+        """Adds the distinct catalog values of every slot type to the vocabulary."""
+        for slot, (table, column) in TEMPLATE_VOCABULARY_SOURCES.items():
+            rows = db_manager.execute_query(
+                f"SELECT DISTINCT [{column}] FROM [dbo].[{table}] WHERE [{column}] IS NOT NULL",
+                max_rows=None, max_bytes=None
+            )
+            self.vocabulary[slot].update(str(row[0]).strip() for row in rows if str(row[0]).strip())
+        print(f"Loaded template vocabulary: { {slot: len(values) for slot, values in self.vocabulary.items()} }")
+
+    def template_for(self, sql: str) -> IntentTemplate:
+        """Returns the (cached) template of an example query."""
+        with self._lock:
+            template = self._templates.get(sql)
+            if template is None:
+                template = self._templates[sql] = IntentTemplate(sql)
+            return template
+
+    def extract_slots(self, question: str) -> Dict[str, Any]:
+        """
+        Finds slot values mentioned in a question: catalog values by longest
+        case-insensitive whole-word match, NutriScore grades and top-N counts.
+        Args:
+            question (str): The user question.
+        Returns:
+            Dict[str, Any]: Slot type -> value, with catalog values in their catalog spelling.
+        """
+        values: Dict[str, Any] = {}
+        lowered = question.lower()
+        for slot, vocabulary in self.vocabulary.items():
+            matches = [value for value in vocabulary
+                       if re.search(r"(?<!\w)" + re.escape(value.lower()) + r"(?!\w)", lowered)]
+            if matches:
+                values[slot] = max(matches, key=len)
+        grade = re.search(r"nutri\s*-?\s*score\s*(?:of\s+|is\s+|=\s*)?['\"]?([A-E])\b", question, re.IGNORECASE)
+        if grade:
+            values["nutriscore"] = grade.group(1).upper()
+        count = re.search(r"\btop\s+(\d+|" + "|".join(NUMBER_WORDS) + r")\b|\b(\d+|" + "|".join(NUMBER_WORDS)
+                          + r")\s+(?:most|best|cheapest|least|top|items|products)\b", lowered)
+        if count:
+            number = count.group(1) or count.group(2)
+            values["top_n"] = int(number) if number.isdigit() else NUMBER_WORDS[number]
+        return values
+
+    def _mask_slots(self, question: str) -> str:
+        """The lowercased question with its slot values blanked, so a 'Low Fat' item is not read as intent."""
+        masked = question.lower()
+        for value in self.extract_slots(question).values():
+            if isinstance(value, str):
+                masked = re.sub(r"(?<!\w)" + re.escape(value.lower()) + r"(?!\w)", " ", masked)
+        return masked
+
+    def intent_markers(self, question: str) -> set:
+        """The kinds of INTENT_WORDS in a question, outside its slot values."""
+        words = set(re.findall(r"[\w']+", self._mask_slots(question)))
+        return {kind for kind, markers in INTENT_WORDS.items() if words & markers}
+
+    def requested_columns(self, question: str) -> set:
+        """The columns of TEMPLATE_ATTRIBUTE_PATTERNS a question asks for, outside its slot values."""
+        masked = self._mask_slots(question)
+        return {column for column, pattern in TEMPLATE_ATTRIBUTE_PATTERNS.items() if re.search(pattern, masked)}
+
+    def bind(self, question: str, example_sql: str, example_question: str = None) -> str | None:
+        """
+        Renders the example's query with the slot values of the question.
+        Args:
+            question (str): The user question.
+            example_sql (str): The query of the closest example.
+            example_question (str, optional): The question of the example. When given, the
+                                              two questions must have the same intent markers.
+        Returns:
+            str | None: The SQL to run, or None when the question names a slot the
+                        template lacks or omits one it needs (top-N excepted), asks
+                        for the opposite order, comparison or a negation, asks for a
+                        column the query does not read, or the example is listed in
+                        NON_TEMPLATE_EXAMPLE_IDS.
+        """
+        if example_question is not None and EmbeddingCache.normalize(example_question) in self.non_template_questions:
+            return None
+        template = self.template_for(example_sql)
+        values = self.extract_slots(question)
+        required = template.slot_types - {"top_n"}
+        mentioned = set(values) - {"top_n"}
+        if mentioned != required:
+            return None
+        if example_question is not None and self.intent_markers(question) != self.intent_markers(example_question):
+            return None
+        if any(not re.search(rf"\b{column}\b", example_sql, re.IGNORECASE) for column in self.requested_columns(question)):
+            return None
+        sql = template.render(values)
+        if "top_n" in values and "top_n" not in template.slot_types:
+            sql = apply_row_limit(sql, values["top_n"])
+        return sql
+
+class SQLValidator:
+    """
+    Validates LLM-generated SQL locally before it is sent to the database.
+    Rejects anything but a single read-only SELECT and checks every referenced
+    table and column against a cached copy of the schema, returning an error in
+    the style of SQL Server so it can be fed straight back into the repair prompt.
+    Identifiers are compared case-insensitively, like the default SQL Server collation.
+    """
+    TOKEN_PATTERN = re.compile(r"""
+        (?P<string>N?'(?:[^']|'')*')
+        |(?P<bracket>\[[^\]]*\])
+        |(?P<quoted>"[^"]*")
+        |(?P<number>\d+(?:\.\d+)?)
+        |(?P<word>[A-Za-z_@#][\w@#$]*)
+        |(?P<op><=|>=|<>|!=|[.,()*=<>+\-/%;])
+    """, re.VERBOSE)
+    FORBIDDEN = {"INSERT", "UPDATE", "DELETE", "MERGE", "DROP", "CREATE", "ALTER", "TRUNCATE", "EXEC",
+                 "EXECUTE", "GRANT", "REVOKE", "DENY", "INTO", "BACKUP", "RESTORE", "SHUTDOWN", "DBCC", "USE"}
+    KEYWORDS = {"SELECT", "FROM", "WHERE", "AND", "OR", "NOT", "ON", "AS", "JOIN", "INNER", "LEFT", "RIGHT",
+                "FULL", "OUTER", "CROSS", "APPLY", "GROUP", "ORDER", "BY", "HAVING", "TOP", "DISTINCT", "ALL",
+                "UNION", "EXCEPT", "INTERSECT", "IN", "IS", "NULL", "LIKE", "BETWEEN", "EXISTS", "CASE", "WHEN",
+                "THEN", "ELSE", "END", "ASC", "DESC", "WITH", "OVER", "PARTITION", "PERCENT", "TIES", "OFFSET",
+                "ROWS", "ROW", "FETCH", "NEXT", "ONLY", "ESCAPE", "COLLATE", "CURRENT_TIMESTAMP", "NOLOCK",
+                "INT", "FLOAT", "DATE", "DATETIME", "NVARCHAR", "VARCHAR", "DECIMAL", "MONEY", "BIT"}
+    # Tokens after which an identifier is read as a column reference
+    COLUMN_CONTEXT = {"SELECT", "WHERE", "AND", "OR", "NOT", "ON", "BY", "HAVING", "DISTINCT", "WHEN", "THEN",
+                      "ELSE", "CASE", "BETWEEN", "LIKE", "IN", "IS", ",", "(", "=", "<", ">", "<=", ">=", "<>",
+                      "!=", "+", "-", "*", "/", "%"}
+    # Functions whose first argument is a date part keyword rather than a column, and those keywords
+    DATE_PART_FUNCTIONS = {"DATEADD", "DATEDIFF", "DATEDIFF_BIG", "DATEPART", "DATENAME", "DATETRUNC", "DATE_BUCKET"}
+    DATE_PARTS = {"YEAR", "YY", "YYYY", "QUARTER", "QQ", "Q", "MONTH", "MM", "M", "DAYOFYEAR", "DY", "Y", "DAY", "DD",
+                  "D", "WEEK", "WK", "WW", "WEEKDAY", "DW", "W", "HOUR", "HH", "MINUTE", "MI", "N", "SECOND", "SS", "S",
+                  "MILLISECOND", "MS", "MICROSECOND", "MCS", "NANOSECOND", "NS", "ISO_WEEK", "ISOWK", "ISOWW",
+                  "TZOFFSET", "TZ"}
+    # Valid queries the validator must accept, beyond the business examples; see self_check
+    SELF_CHECK_QUERIES = [
+        "SELECT ItemName, ExpiryDate FROM [dbo].[SupermarketItems] WHERE ExpiryDate <= DATEADD(day, 7, GETDATE())",
+        "SELECT ItemName FROM [dbo].[SupermarketItems] WHERE ExpiryDate < DATEADD(dd, 3, GETDATE())",
+        "SELECT ItemName, DATEDIFF(DAY, GETDATE(), ExpiryDate) AS DaysLeft FROM [dbo].[SupermarketItems]",
+        "SELECT DATEPART(month, ExpiryDate) AS ExpiryMonth, COUNT(*) FROM [dbo].[SupermarketItems] "
+        "GROUP BY DATEPART(month, ExpiryDate)",
+        "SELECT DATENAME(weekday, ExpiryDate), DATEDIFF_BIG(hh, GETDATE(), ExpiryDate) FROM [dbo].[SupermarketItems]",
+        "SELECT TOP (10) PERCENT WITH TIES ItemName, Price FROM [dbo].[SupermarketItems] ORDER BY Price DESC"
+    ]
+    # Invalid queries the validator must reject; see self_check
+    SELF_CHECK_INVALID_QUERIES = [
+        "SELECT TOP 5 Foo FROM [dbo].[SupermarketItems]",
+        "SELECT TOP (5) Foo, ItemName FROM [dbo].[SupermarketItems] ORDER BY Price",
+        "SELECT ItemName FROM [dbo].[SupermarketItems] WHERE ExpiryDate < DATEADD(Foo, 3, GETDATE())"
+    ]
+
+    def __init__(self, schema: Dict[str, List[str]] = None):
+        self.set_schema(schema or SCHEMA_COLUMNS)
+
+    def set_schema(self, schema: Dict[str, List[str]]):
+        """Replaces the cached schema (table name -> column names)."""
+        self.schema = {table.upper(): (table, {column.upper(): column for column in columns})
+                       for table, columns in schema.items()}
+
+    @classmethod
+    def tokenize(cls, sql: str) -> List[tuple[str, str]]:
+        """Splits SQL into (kind, value) tokens, dropping comments and whitespace."""
+        sql = re.sub(r"--[^\n]*|/\*.*?\*/", " ", sql, flags=re.DOTALL)
+        tokens = []
+        for match in cls.TOKEN_PATTERN.finditer(sql):
+            kind = match.lastgroup
+            value = match.group()
+            if kind in ("bracket", "quoted"):
+                kind, value = "ident", value[1:-1]
+            elif kind == "word":
+                kind = "keyword" if value.upper() in cls.KEYWORDS else "ident"
+            tokens.append((kind, value))
+        return tokens
+
+    @classmethod
+    def _read_only_error(cls, tokens: List[tuple[str, str]]) -> str | None:
+        """Returns why the tokens are not a single read-only SELECT, or None if they are."""
+        if not tokens:
+            return "The query is empty."
+        if ("op", ";") in tokens:
+            return "Only a single SELECT statement is allowed."
+        if tokens[0][1].upper() not in ("SELECT", "WITH"):
+            return f"Only read-only SELECT queries are allowed, but the query starts with '{tokens[0][1]}'."
+        for kind, value in tokens:
+            if kind == "ident" and value.upper() in cls.FORBIDDEN:
+                return f"Only read-only SELECT queries are allowed, but the query contains '{value.upper()}'."
+        return None
+
+    @classmethod
+    def is_read_only(cls, sql: str) -> bool:
+        """Checks that a query is a single SELECT without DDL or DML."""
+        tokens = cls.tokenize(sql)
+        while tokens and tokens[-1] == ("op", ";"):
+            tokens.pop()
+        return cls._read_only_error(tokens) is None
+
+    def validate(self, sql: str) -> str | None:
+        """
+        Validates a generated query.
+        Args:
+            sql (str): The SQL query.
+        Returns:
+            str | None: A description of the first problem found, or None if the query looks valid.
+        """
+        tokens = self.tokenize(sql)
+        while tokens and tokens[-1] == ("op", ";"):
+            tokens.pop()
+        error = self._read_only_error(tokens)
+        if error:
+            return error
+        tokens = self._strip_top(tokens)
+
+        # Pass 1: tables, their aliases, CTE names and column aliases
+        opening = {} # Index of each ")" -> index of its "("
+        stack = []
+        for i, token in enumerate(tokens):
+            if token == ("op", "("):
+                stack.append(i)
+            elif token == ("op", ")") and stack:
+                opening[i] = stack.pop()
+        aliases: Dict[str, str | None] = {} # Alias or name -> schema table key, None for CTEs and derived tables
+        column_aliases = set()
+        for i, (kind, value) in enumerate(tokens):
+            upper = value.upper()
+            previous = tokens[i - 1] if i > 0 else ("", "")
+            following = [token[1].upper() for token in tokens[i + 1:i + 3]]
+            if kind == "ident" and previous[1].upper() in ("WITH", ",") and following == ["AS", "("]:
+                aliases[upper] = None # Common table expression
+            elif kind == "keyword" and upper in ("FROM", "JOIN", "APPLY"):
+                j = i + 1
+                parts = []
+                while j < len(tokens) and tokens[j][0] == "ident":
+                    parts.append(tokens[j][1])
+                    j += 1
+                    if tokens[j:j + 1] != [("op", ".")]:
+                        break
+                    j += 1
+                if not parts:
+                    continue # Derived table, its alias is recorded after the closing parenthesis
+                name = parts[-1].upper()
+                if name not in self.schema and name not in aliases:
+                    known = ", ".join(table for table, _ in self.schema.values())
+                    return f"Invalid object name '{parts[-1]}'. Available tables: {known}."
+                table = name if name in self.schema else None
+                aliases[name] = table
+                if j < len(tokens) and tokens[j][1].upper() == "AS":
+                    j += 1
+                if j < len(tokens) and tokens[j][0] == "ident":
+                    aliases[tokens[j][1].upper()] = table
+            elif kind == "ident" and (previous[1].upper() == "AS" or previous[0] in ("ident", "number", "string")
+                                      or previous == ("op", ")")) and tokens[i - 2:i - 1] != [("op", ".")]:
+                # Alias of an expression, a column or a derived table
+                column_aliases.add(upper)
+                close = i - 2 if previous[1].upper() == "AS" else i - 1
+                if tokens[close:close + 1] == [("op", ")")] and close in opening \
+                        and tokens[opening[close] - 1][1].upper() in ("FROM", "JOIN", "APPLY"):
+                    aliases.setdefault(upper, None)
+
+        referenced = [table for table in aliases.values() if table is not None]
+        has_unknown_source = any(table is None for table in aliases.values())
+
+        # Pass 2: column references
+        for i, (kind, value) in enumerate(tokens):
+            if kind != "ident" or tokens[i + 1:i + 2] == [("op", "(")]:
+                continue
+            if tokens[i + 1:i + 2] == [("op", ".")]:
+                continue # Qualifier, checked together with the column that follows it
+            if i >= 2 and tokens[i - 1] == ("op", "."):
+                qualifier = tokens[i - 2][1].upper()
+                if qualifier not in aliases:
+                    if qualifier in self.schema or qualifier == "DBO" or i >= 4 and tokens[i - 3] == ("op", "."):
+                        continue # Part of a schema-qualified table name
+                    return f"The multi-part identifier '{tokens[i - 2][1]}.{value}' could not be bound."
+                table = aliases[qualifier]
+                if table is not None and value.upper() not in self.schema[table][1]:
+                    return self._invalid_column(value, [table])
+                continue
+            previous = tokens[i - 1][1].upper() if i > 0 else ""
+            if previous not in self.COLUMN_CONTEXT or value.upper() in aliases or value.upper() in column_aliases:
+                continue
+            if previous == "(" and i >= 2 and tokens[i - 2][1].upper() in self.DATE_PART_FUNCTIONS \
+                    and value.upper() in self.DATE_PARTS:
+                continue # DATEADD(day, ...) and the like
+            if value.startswith("@") or has_unknown_source or not referenced:
+                continue
+            if not any(value.upper() in self.schema[table][1] for table in referenced):
+                return self._invalid_column(value, referenced)
+        return None
+
+    @staticmethod
+    def _strip_top(tokens: List[tuple[str, str]]) -> List[tuple[str, str]]:
+        """
+        Drops every `TOP n` / `TOP (expression)` clause with its PERCENT and WITH TIES, so the
+        first column of the select list follows SELECT and is not read as the alias of n.
+        """
+        stripped = []
+        i = 0
+        while i < len(tokens):
+            if tokens[i][1].upper() != "TOP":
+                stripped.append(tokens[i])
+                i += 1
+                continue
+            i += 1
+            if tokens[i:i + 1] == [("op", "(")]:
+                depth = 0
+                while i < len(tokens):
+                    depth += {("op", "("): 1, ("op", ")"): -1}.get(tokens[i], 0)
+                    i += 1
+                    if depth == 0:
+                        break
+            elif i < len(tokens) and tokens[i][0] in ("number", "ident"):
+                i += 1
+            if i < len(tokens) and tokens[i][1].upper() == "PERCENT":
+                i += 1
+            if [token[1].upper() for token in tokens[i:i + 2]] == ["WITH", "TIES"]:
+                i += 2
+        return stripped
+
+    def self_check(self, queries: List[str] = None, invalid_queries: List[str] = None) -> Dict[str, str]:
+        """
+        Validates queries known to run on SQL Server, and queries known to fail on it,
+        against the current schema.
+        Args:
+            queries (List[str], optional): The valid queries; SELF_CHECK_QUERIES when omitted.
+            invalid_queries (List[str], optional): The invalid ones; SELF_CHECK_INVALID_QUERIES when omitted.
+        Returns:
+            Dict[str, str]: Query -> problem, for every query the validator gets wrong.
+        """
+        problems = {}
+        for query in queries or self.SELF_CHECK_QUERIES:
+            error = self.validate(query)
+            if error:
+                problems[query] = f"Rejected a valid query: {error}"
+        for query in invalid_queries or self.SELF_CHECK_INVALID_QUERIES:
+            if self.validate(query) is None:
+                problems[query] = "Accepted an invalid query."
+        return problems
+
+    def _invalid_column(self, column: str, tables: List[str]) -> str:
+        details = "; ".join(
+            f"{self.schema[table][0]} has columns: {', '.join(self.schema[table][1].values())}" for table in dict.fromkeys(tables)
+        )
+        return f"Invalid column name '{column}'. {details}."
 
-    def _get_connection(self):
-        """Establishes and returns a database connection."""
-        if self.conn is None or not self._is_connection_valid():
+class SQLConnectionPool:
+    """
+    Thread-safe bounded pool of database connections. Connections idle for longer
+    than `idle_timeout` are closed down to `min_size`, and a liveness check is only
+    run on checkout when a connection has been idle for `validate_after_idle` seconds.
+    """
+    def __init__(self, connect: Callable[[], Any], min_size: int = DB_POOL_MIN_SIZE, max_size: int = DB_POOL_MAX_SIZE,
+                 idle_timeout: float = DB_POOL_IDLE_TIMEOUT_SECONDS, validate_after_idle: float = DB_POOL_VALIDATE_AFTER_IDLE_SECONDS,
+                 acquire_timeout: float = DB_POOL_ACQUIRE_TIMEOUT_SECONDS):
+        if not 0 <= min_size <= max_size or max_size < 1:
+            raise ValueError("Pool sizes must satisfy 0 <= min_size <= max_size and max_size >= 1.")
+        self._connect = connect
+        self.min_size = min_size
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.validate_after_idle = validate_after_idle
+        self.acquire_timeout = acquire_timeout
+        self._idle: deque = deque() # (connection, last_used) pairs, most recently used on the right
+        self._size = 0 # Connections open or being opened, idle or checked out
+        self._cond = threading.Condition()
+        self._checkouts = 0
+        self._waits = 0
+        self._wait_seconds = 0.0
+        self._max_wait_seconds = 0.0
+        self._created = 0
+        self._discarded = 0
+
+    def warm_up(self):
+        """Opens connections until the pool holds `min_size` of them."""
+        while True:
+            with self._cond:
+                if self._size >= self.min_size:
+                    return
+                self._size += 1
             try:
-                self.conn = pyodbc.connect(self.connection_string)
-                print("Database connection established.")
-            except pyodbc.Error as e:
-                print(f"Error connecting to database: {e}")
+                conn = self._open()
+            except Exception:
+                with self._cond:
+                    self._size -= 1
                 raise
-        return self.conn
-
-    def _is_connection_valid(self) -> bool:
-        """Checks if the current database connection is valid."""
+            self.release(conn)
+
+    def _open(self):
+        conn = self._connect()
+        with self._cond:
+            self._created += 1
+        print("Database connection established.")
+        return conn
+
+    @staticmethod
+    def _is_alive(conn) -> bool:
+        """Checks if a connection is still usable."""
         try:
-            if self.conn:
-                cursor = self.conn.cursor()
-                cursor.execute("SELECT 1") # Simple query to check connection
-                return True
-            return False
+            conn.cursor().execute("SELECT 1").fetchall()
+            return True
         except pyodbc.Error:
             return False
 
-    def execute_query(self, query: str) -> List[Any]:
+    def _close(self, conn):
+        try:
+            conn.close()
+        except pyodbc.Error:
+            pass
+
+    def _reap_idle(self, now: float) -> List[Any]:
+        """Pops connections idle past the timeout, keeping `min_size`. Caller holds the lock."""
+        expired = []
+        while self._idle and self._size > self.min_size and now - self._idle[0][1] > self.idle_timeout:
+            expired.append(self._idle.popleft()[0])
+            self._size -= 1
+        return expired
+
+    def acquire(self):
+        """
+        Checks out a connection, opening one if the pool is below `max_size` or
+        waiting for a release otherwise.
+        Returns:
+            The database connection.
+        Raises:
+            TimeoutError: If no connection became available within `acquire_timeout`.
+        """
+        start = time.perf_counter()
+        waited = False
+        while True:
+            with self._cond:
+                expired = self._reap_idle(time.monotonic())
+                while not self._idle and self._size >= self.max_size:
+                    waited = True
+                    remaining = self.acquire_timeout - (time.perf_counter() - start)
+                    if remaining <= 0:
+                        raise TimeoutError(f"No database connection available after {self.acquire_timeout}s.")
+                    self._cond.wait(remaining)
+                if self._idle:
+                    conn, last_used = self._idle.pop()
+                else:
+                    conn, last_used = None, None
+                    self._size += 1
+                wait_seconds = time.perf_counter() - start
+            for stale in expired:
+                self._close(stale)
+
+            if conn is None:
+                try:
+                    conn = self._open()
+                except Exception:
+                    self.release(None, discard=True)
+                    raise
+            elif not (time.monotonic() - last_used < self.validate_after_idle or self._is_alive(conn)):
+                print("Discarding dead database connection.")
+                self.release(conn, discard=True)
+                continue
+            self._record_checkout(wait_seconds, waited)
+            return conn
+
+    def _record_checkout(self, wait_seconds: float, waited: bool):
+        """Updates the wait metrics once a connection is handed out."""
+        with self._cond:
+            self._checkouts += 1
+            if waited:
+                self._waits += 1
+            self._wait_seconds += wait_seconds
+            self._max_wait_seconds = max(self._max_wait_seconds, wait_seconds)
+
+    def release(self, conn, discard: bool = False):
+        """
+        Returns a connection to the pool.
+        Args:
+            conn: The connection obtained from `acquire`.
+            discard (bool): Close the connection instead, e.g. after a connection error.
+        """
+        with self._cond:
+            if discard or conn is None:
+                self._size -= 1
+                self._discarded += 1 if conn is not None else 0
+            else:
+                self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+        if discard and conn is not None:
+            self._close(conn)
+
+    @contextmanager
+    def connection(self):
+        """Checks out a connection for the duration of a `with` block."""
+        conn = self.acquire()
+        try:
+            yield conn
+        except pyodbc.ProgrammingError:
+            # The query was wrong, the connection is fine
+            self.release(conn)
+            raise
+        except BaseException:
+            self.release(conn, discard=True)
+            raise
+        else:
+            self.release(conn)
+
+    def close(self):
+        """Closes every idle connection."""
+        with self._cond:
+            idle = [conn for conn, _ in self._idle]
+            self._idle.clear()
+            self._size -= len(idle)
+        for conn in idle:
+            self._close(conn)
+
+    def stats(self) -> Dict[str, Any]:
+        """Returns the pool size and checkout wait-time metrics."""
+        with self._cond:
+            return {
+                "size": self._size,
+                "idle": len(self._idle),
+                "in_use": self._size - len(self._idle),
+                "checkouts": self._checkouts,
+                "waits": self._waits,
+                "avg_wait_ms": self._wait_seconds / self._checkouts * 1000 if self._checkouts else 0.0,
+                "max_wait_ms": self._max_wait_seconds * 1000,
+                "created": self._created,
+                "discarded": self._discarded
+            }
+
+class QueryResult(list):
+    """
+    The rows returned by `SQLDatabaseManager.execute_query`, together with the
+    column names and whether the fetch stopped at the row cap or byte budget.
+    """
+    def __init__(self, rows: List[Any] = (), columns: List[str] = None, truncated: bool = False,
+                 total_rows_estimate: int | None = None):
+        super().__init__(rows)
+        self.columns = columns or []
+        self.truncated = truncated
+        # Exact when the result is complete; a COUNT of the query (or None) when truncated
+        self.total_rows_estimate = len(self) if total_rows_estimate is None and not truncated else total_rows_estimate
+
+class QueryResultCache:
+    """
+    Caches query results by canonical SQL text, with a TTL per referenced table.
+    Concurrent lookups of the same uncached query are coalesced: one caller runs
+    the query and the others wait for its result (single flight). Every hit
+    counts the execution time it saved.
+    """
+    TOKEN_PATTERN = re.compile(
+        r"[Nn]?'(?:[^']|'')*'|(?:\[dbo\]|\bdbo)\s*\.|\[[^\]]*\]|\w+|[^\w\s]", re.IGNORECASE
+    )
+
+    def __init__(self, max_size: int = RESULT_CACHE_SIZE, table_ttls: Dict[str, float] = None,
+                 default_ttl: float = RESULT_CACHE_DEFAULT_TTL_SECONDS):
+        self.max_size = max_size
+        self.table_ttls = RESULT_CACHE_TTL_SECONDS if table_ttls is None else table_ttls
+        self.default_ttl = default_ttl
+        self._entries: OrderedDict = OrderedDict()
+        self._in_flight: Dict[tuple, Dict[str, Any]] = {}
+        self._generation = 0 # Bumped on invalidation, so results computed before it are not stored
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.saved_seconds = 0.0
+
+    @classmethod
+    def canonicalize(cls, sql: str) -> str:
+        """
+        Normalizes the parts of a query that do not change its result: whitespace,
+        the case of keywords and identifiers, brackets, the dbo prefix, N'' string
+        prefixes and a trailing semicolon. The content of literals is kept.
+        """
+        tokens = []
+        for token in cls.TOKEN_PATTERN.findall(sql):
+            if token.endswith("'"):
+                tokens.append(token[1:] if token[0] in "Nn" else token)
+            elif token.endswith(".") and len(token) > 1:
+                continue # dbo schema prefix
+            elif token.startswith("["):
+                inner = token[1:-1]
+                tokens.append(inner.upper() if re.fullmatch(r"\w+", inner) else token.upper())
+            else:
+                tokens.append(token.upper())
+        while tokens and tokens[-1] == ";":
+            tokens.pop()
+        return " ".join(tokens)
+
+    def _ttl(self, tables: List[str]) -> float:
+        return min((self.table_ttls.get(table, self.default_ttl) for table in tables), default=self.default_ttl)
+
+    def get_or_execute(self, sql: str, execute: Callable[[], QueryResult], *key_parts: Any) -> QueryResult:
+        """
+        Returns the cached result of a query, or runs it once for every concurrent caller.
+        Args:
+            sql (str): The query.
+            execute (Callable[[], QueryResult]): Runs the query.
+            *key_parts (Any): Further arguments the result depends on, such as the row cap.
+        Returns:
+            QueryResult: A copy of the result.
+        """
+        key = (self.canonicalize(sql),) + key_parts
+        with self._lock:
+            now = time.monotonic()
+            entry = self._entries.get(key)
+            if entry is not None and entry["expires_at"] > now:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                self.saved_seconds += entry["seconds"]
+                return self._copy(entry["result"])
+            self._entries.pop(key, None)
+            flight = self._in_flight.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._in_flight[key] = {"done": threading.Event(), "result": None, "error": None, "seconds": 0.0}
+                self.misses += 1
+            generation = self._generation
+
+        if not leader:
+            flight["done"].wait()
+            if flight["error"] is not None:
+                raise flight["error"]
+            with self._lock:
+                self.coalesced += 1
+                self.saved_seconds += flight["seconds"]
+            return self._copy(flight["result"])
+
+        start_time = time.perf_counter()
+        try:
+            flight["result"] = execute()
+        except Exception as e:
+            flight["error"] = e
+            raise
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+                if flight["error"] is None:
+                    flight["seconds"] = time.perf_counter() - start_time
+                    if generation == self._generation:
+                        tables = extract_table_names(sql)
+                        self._entries[key] = {"result": flight["result"], "tables": set(tables), "seconds": flight["seconds"],
+                                              "expires_at": time.monotonic() + self._ttl(tables)}
+                        while len(self._entries) > self.max_size:
+                            self._entries.popitem(last=False)
+            flight["done"].set()
+        return self._copy(flight["result"])
+
+    @staticmethod
+    def _copy(result: QueryResult) -> QueryResult:
+        """A shallow copy, so callers cannot change the cached rows."""
+        return QueryResult(result, result.columns, result.truncated, result.total_rows_estimate)
+
+    def invalidate(self, tables: List[str] = None):
+        """
+        Drops cached results.
+        Args:
+            tables (List[str], optional): Only drop results of queries that read these tables.
+                                          Every entry is dropped when omitted.
+        """
+        with self._lock:
+            self._generation += 1
+            if tables is None:
+                self._entries.clear()
+                return
+            changed = set(tables)
+            for key in [key for key, entry in self._entries.items() if entry["tables"] & changed]:
+                del self._entries[key]
+
+    def stats(self) -> Dict[str, Any]:
+        """Returns the hit, miss and coalesced counters, the hit ratio and the database time saved."""
+        with self._lock:
+            lookups = self.hits + self.misses + self.coalesced
+            return {"hits": self.hits, "misses": self.misses, "coalesced": self.coalesced, "size": len(self._entries),
+                    "hit_ratio": (self.hits + self.coalesced) / lookups if lookups else 0.0,
+                    "saved_seconds": round(self.saved_seconds, 3)}
+
+class LocalReplica:
+    """
+    Read-only SQLite copy of the catalog tables. Each refresh compares the
+    CHECKSUM_AGG of every source table with the one recorded at the last copy
+    and only re-copies tables that changed. The file persists across restarts,
+    so the replica can keep answering while the remote server is unreachable.
+    """
+    def __init__(self, path: str = LOCAL_REPLICA_PATH, tables: List[str] = None,
+                 refresh_seconds: float = LOCAL_REPLICA_REFRESH_SECONDS):
+        if path == ":memory:":
+            # Every thread opens its own connection, so they must share one named in-memory database
+            self._target, self._uri = "file:supermarket_replica?mode=memory&cache=shared", True
+        else:
+            self._target, self._uri = path, False
+        self.tables = tables or INVENTORY_TABLES
+        self.refresh_seconds = refresh_seconds
+        self._local = threading.local()
+        self._write_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        conn = self._connection()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("CREATE TABLE IF NOT EXISTS _replica_versions (table_name TEXT PRIMARY KEY, version TEXT, refreshed_at REAL)")
+        conn.commit()
+
+    def _connection(self) -> sqlite3.Connection:
+        """Returns this thread's connection to the replica."""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = sqlite3.connect(self._target, uri=self._uri, check_same_thread=False)
+        return conn
+
+    def versions(self) -> Dict[str, str]:
+        """Returns the source checksum each table was copied at."""
+        return dict(self._connection().execute("SELECT table_name, version FROM _replica_versions").fetchall())
+
+    @property
+    def ready(self) -> bool:
+        """True once every table has been copied at least once."""
+        return set(self.tables) <= set(self.versions())
+
+    def refresh(self, source: "SQLDatabaseManager", remote_versions: Dict[str, Any] = None) -> List[str]:
+        """
+        Copies the tables whose checksum changed since the last refresh.
+        Args:
+            source (SQLDatabaseManager): The manager of the remote database.
+            remote_versions (Dict[str, Any], optional): Checksums the caller just read; only these
+                                                        tables are compared. Read from `source` when omitted.
+        Returns:
+            List[str]: The tables that were copied.
+        """
+        if remote_versions is None:
+            remote_versions = source.get_table_versions(self.tables)
+        remote_versions = {table: str(version) for table, version in remote_versions.items()}
+        local_versions = self.versions()
+        changed = [table for table in self.tables
+                   if table in remote_versions and local_versions.get(table) != remote_versions[table]]
+        for table in changed:
+            rows = source.execute_query(f"SELECT * FROM [dbo].[{table}]", max_rows=None, max_bytes=None,
+                                        use_replica=False, use_cache=False)
+            self._replace_table(table, rows.columns, rows, remote_versions.get(table))
+        if changed:
+            print(f"Local replica refreshed: {changed}")
+        return changed
+
+    def invalidate(self, tables: List[str]):
+        """Forgets the copies of the given tables, so the replica is not ready until they are copied again."""
+        with self._write_lock:
+            conn = self._connection()
+            with conn:
+                conn.executemany("DELETE FROM _replica_versions WHERE table_name = ?", [(table,) for table in tables])
+
+    def _replace_table(self, table: str, columns: List[str], rows: List[Any], version: str):
+        """Atomically replaces the content of one replica table."""
+        def convert(value):
+            # Dates are stored as ISO strings, which compare and sort like the originals
+            return value.isoformat() if hasattr(value, "isoformat") else value
+
+        quoted = ", ".join(f'"{column}" COLLATE NOCASE' for column in columns)
+        placeholders = ", ".join("?" for _ in columns)
+        with self._write_lock:
+            conn = self._connection()
+            with conn: # One transaction: readers see either the old or the new table
+                conn.execute(f'DROP TABLE IF EXISTS "{table}"')
+                conn.execute(f'CREATE TABLE "{table}" ({quoted})')
+                conn.executemany(f'INSERT INTO "{table}" VALUES ({placeholders})',
+                                 [tuple(convert(value) for value in row) for row in rows])
+                conn.execute("INSERT OR REPLACE INTO _replica_versions VALUES (?, ?, ?)", (table, version, time.time()))
+
+    def execute(self, query: str, max_rows: int | None, max_bytes: int | None) -> tuple[List[Any], List[str], bool]:
+        """
+        Runs a T-SQL query against the replica.
+        Args:
+            query (str): The T-SQL query.
+            max_rows (int | None): Maximum number of rows, None for no cap.
+            max_bytes (int | None): Approximate budget for the text size of the rows, None for no budget.
+        Returns:
+            tuple[List[Any], List[str], bool]: The rows, the column names and whether rows were left unread.
+        """
+        cursor = self._connection().cursor()
+        try:
+            cursor.execute(translate_tsql_to_sqlite(query))
+            columns = [column[0] for column in cursor.description] if cursor.description else []
+            rows, truncated = fetch_bounded(cursor, max_rows, max_bytes)
+        finally:
+            cursor.close()
+        return rows, columns, truncated
+
+    def start(self, source: "SQLDatabaseManager"):
+        """Starts refreshing the replica from `source` every `refresh_seconds` in a daemon thread."""
+        if self._thread is not None:
+            return
+
+        def refresh_loop():
+            while not self._stop.wait(self.refresh_seconds):
+                try:
+                    self.refresh(source)
+                except Exception as e:
+                    print(f"Local replica refresh failed: {e}")
+
+        self._thread = threading.Thread(target=refresh_loop, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stops the background refresh."""
+        self._stop.set()
+
+class AggregateMaterializer:
+    """
+    Maintains the precomputed tables of AGGREGATE_TABLES in the database. Every
+    `refresh_seconds` a table's source checksums are compared with those it was
+    built from, and the table is rebuilt in one transaction if they differ.
+    """
+    def __init__(self, db_manager: "SQLDatabaseManager", tables: Dict[str, Dict[str, Any]] = None):
+        self.db_manager = db_manager
+        self.tables = tables or AGGREGATE_TABLES
+        self._state = {name: {"source_versions": None, "refreshed_at": None, "checked_at": 0.0, "stale": True}
+                       for name in self.tables}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def ready(self) -> bool:
+        """True once every aggregate table has been built by this process."""
+        return all(state["refreshed_at"] is not None for state in self._state.values())
+
+    def sources_of(self, tables: List[str]) -> List[str]:
+        """Replaces aggregate tables by the tables they are computed from."""
+        result = []
+        for table in tables:
+            for source in self.tables[table]["sources"] if table in self.tables else [table]:
+                if source not in result:
+                    result.append(source)
+        return result
+
+    def _build_statement(self, name: str) -> str:
+        """The batch that replaces one aggregate table atomically."""
+        spec = self.tables[name]
+        indexes = "".join(
+            f"CREATE INDEX [IX_{name}_{'_'.join(columns)}] ON [dbo].[{name}] ({', '.join(f'[{c}]' for c in columns)});\n"
+            for columns in spec.get("indexes", [])
+        )
+        return (
+            "SET XACT_ABORT ON;\n"
+            "BEGIN TRANSACTION;\n"
+            f"DROP TABLE IF EXISTS [dbo].[{name}];\n"
+            f"SELECT source.*, SYSUTCDATETIME() AS RefreshedAt INTO [dbo].[{name}] FROM (\n{spec['select']}\n) AS source;\n"
+            f"{indexes}"
+            "COMMIT TRANSACTION;"
+        )
+
+    def refresh(self, force: bool = False) -> List[str]:
+        """
+        Rebuilds the aggregate tables whose sources changed.
+        Args:
+            force (bool): Check every table now, regardless of its refresh interval.
+        Returns:
+            List[str]: The tables that were rebuilt.
+        """
+        with self._lock:
+            now = time.monotonic()
+            due = [name for name, spec in self.tables.items()
+                   if force or now - self._state[name]["checked_at"] >= spec["refresh_seconds"]]
+            if not due:
+                return []
+            versions = self.db_manager.get_table_versions(self.sources_of(due))
+            rebuilt = []
+            for name in due:
+                state = self._state[name]
+                state["checked_at"] = now
+                source_versions = {source: versions.get(source) for source in self.tables[name]["sources"]}
+                if state["refreshed_at"] is not None and source_versions == state["source_versions"]:
+                    continue
+                state["stale"] = True
+                try:
+                    start_time = time.perf_counter()
+                    self.db_manager.execute_statement(self._build_statement(name))
+                    state.update(source_versions=source_versions, refreshed_at=time.time(), stale=False)
+                    if self.db_manager.result_cache is not None:
+                        self.db_manager.result_cache.invalidate([name])
+                    rebuilt.append(name)
+                    print(f"Materialized {name} in {time.perf_counter() - start_time:.2f}s.")
+                except Exception as e:
+                    print(f"Could not materialize {name}: {e}")
+            return rebuilt
+
+    def staleness(self, tables: List[str]) -> Dict[str, Dict[str, Any]]:
+        """
+        Reports how fresh the aggregate tables among `tables` are.
+        Args:
+            tables (List[str]): Table names, e.g. those read by a query; others are ignored.
+        Returns:
+            Dict[str, Dict[str, Any]]: Per aggregate table, `refreshed_at` (epoch seconds),
+                                       `age_seconds` and `stale` (its sources changed since).
+        """
+        now = time.time()
+        report = {}
+        for table in tables:
+            state = self._state.get(table)
+            if state is None:
+                continue
+            refreshed_at = state["refreshed_at"]
+            report[table] = {
+                "refreshed_at": refreshed_at,
+                "age_seconds": round(now - refreshed_at, 1) if refreshed_at is not None else None,
+                "stale": state["stale"]
+            }
+        return report
+
+    def start(self):
+        """Keeps the tables up to date from a daemon thread."""
+        if self._thread is not None:
+            return
+
+        def refresh_loop():
+            interval = min(spec["refresh_seconds"] for spec in self.tables.values())
+            while not self._stop.wait(interval):
+                try:
+                    self.refresh()
+                except Exception as e:
+                    print(f"Aggregate refresh failed: {e}")
+
+        self._thread = threading.Thread(target=refresh_loop, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stops the background refresh."""
+        self._stop.set()
+
+class SQLDatabaseManager:
+    """
+    Manages connections and queries to the SQL Server database.
+    Connections are kept in a pool shared by every thread using this manager.
+    When a local replica is attached, read-only queries are answered from it,
+    and when a result cache is attached, repeated ones are answered from that.
+    """
+    def __init__(self, connection_string: str, pool: SQLConnectionPool = None, replica: LocalReplica = None,
+                 result_cache: QueryResultCache = None):
+        self.connection_string = connection_string
+        self.pool = pool or SQLConnectionPool(self._connect)
+        self.replica = replica
+        self.result_cache = result_cache
+
+    def _connect(self):
+        """Establishes and returns a new database connection."""
+        try:
+            # Autocommit keeps pooled connections free of open transactions between queries
+            return pyodbc.connect(self.connection_string, autocommit=True)
+        except pyodbc.Error as e:
+            print(f"Error connecting to database: {e}")
+            raise
+
+    def execute_query(self, query: str, max_rows: int | None = RESULT_ROW_CAP,
+                      max_bytes: int | None = RESULT_BYTE_BUDGET, use_replica: bool = True,
+                      use_cache: bool = True, timeout: float | None = None) -> QueryResult:
         """
         Executes a given SQL query and returns the results.
+        Rows are streamed with `fetchmany` and the fetch stops once `max_rows` rows
+        or roughly `max_bytes` of row text have been read. A query without TOP is
+        rewritten to ask the server for at most `max_rows + 1` rows.
         Args:
             query (str): The SQL query to execute.
+            max_rows (int | None): Maximum number of rows to return, None for no cap.
+            max_bytes (int | None): Approximate budget for the text size of the rows, None for no budget.
+            use_replica (bool): Allow answering a read-only query from the local replica.
+            use_cache (bool): Allow answering a read-only query from the result cache.
+            timeout (float | None): Query timeout in seconds on the database, rounded up; None for no timeout.
         Returns:
-            List[Any]: A list of rows returned by the query.
+            QueryResult: A list of rows returned by the query, with `columns`,
+                         `truncated` and `total_rows_estimate` attributes.
+        """
+        if use_cache and self.result_cache is not None and SQLValidator.is_read_only(query):
+            return self.result_cache.get_or_execute(
+                query, lambda: self.execute_query(query, max_rows, max_bytes, use_replica, use_cache=False, timeout=timeout),
+                max_rows, max_bytes
+            )
+        original_query = query
+        if max_rows is not None:
+            query = apply_row_limit(query, max_rows + 1) # One extra row tells us whether rows were cut off
+        rows, columns, truncated = None, [], False
+        if use_replica and self.replica is not None and self.replica.ready and SQLValidator.is_read_only(query):
+            try:
+                rows, columns, truncated = self.replica.execute(query, max_rows, max_bytes)
+                print(f"Query executed on local replica. Rows returned: {len(rows)}{' (truncated)' if truncated else ''}")
+            except (sqlite3.Error, ValueError) as e:
+                print(f"Local replica could not run the query ({e}), using the database.")
+                rows = None
+        if rows is None:
+            try:
+                with self.pool.connection() as conn:
+                    conn.timeout = math.ceil(timeout) if timeout else 0
+                    try:
+                        cursor = conn.cursor()
+                        cursor.execute(query)
+                        columns = [column[0] for column in cursor.description] if cursor.description else []
+                        rows, truncated = fetch_bounded(cursor, max_rows, max_bytes)
+                        cursor.close()
+                    finally:
+                        conn.timeout = 0 # Pooled connections are shared by queries without a deadline
+                print(f"Query executed successfully. Rows returned: {len(rows)}{' (truncated)' if truncated else ''}")
+            except pyodbc.Error as e:
+                print(f"Error executing SQL query: {e}")
+                raise
+        total_rows_estimate = self._count_rows(original_query) if truncated and COUNT_TRUNCATED_RESULTS else None
+        return QueryResult(rows, columns, truncated, total_rows_estimate)
+
+    def execute_statement(self, statement: str):
+        """
+        Executes a batch that returns no rows, such as the rebuild of an aggregate table.
+        Args:
+            statement (str): The T-SQL batch.
         """
-        rows = []
         try:
-            conn = self._get_connection()
-            cursor = conn.cursor()
-            cursor.execute(query)
-            rows = cursor.fetchall()
-            print(f"Query executed successfully. Rows returned: {len(rows)}")
+            with self.pool.connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute(statement)
+                while cursor.nextset(): # Run every statement of the batch to completion
+                    pass
+                cursor.close()
         except pyodbc.Error as e:
-            print(f"Error executing SQL query: {e}")
+            print(f"Error executing SQL statement: {e}")
             raise
+
+    def warm_connection(self):
+        """Checks a connection out and back in, so it is opened or revalidated before a query needs it."""
+        with self.pool.connection():
+            pass
+
+    def _count_rows(self, query: str) -> int | None:
+        """Counts the rows a query returns, or returns None if that fails."""
+        if apply_row_limit(query, 1) != query:
+            # ORDER BY is not allowed in a derived table without TOP, and does not change the count
+            query = re.sub(r'\s+ORDER\s+BY\s+[^()]*$', '', query, flags=re.IGNORECASE)
+        try:
+            rows = self.execute_query(f"SELECT COUNT_BIG(*) FROM ({query}) AS counted", max_rows=None, max_bytes=None)
+            return int(rows[0][0])
+        except (pyodbc.Error, IndexError, TypeError):
+            return None
+
+    def get_table_versions(self, tables: List[str]) -> Dict[str, int]:
+        """
+        Returns a checksum of the content of each table, used to detect changes.
+        Args:
+            tables (List[str]): The table names in the dbo schema.
+        Returns:
+            Dict[str, int]: The checksum of each table.
+        """
+        query = " UNION ALL ".join(
+            f"SELECT '{table}', CHECKSUM_AGG(BINARY_CHECKSUM(*)) FROM [dbo].[{table}]" for table in tables
+        )
+        rows = self.execute_query(query, max_rows=None, max_bytes=None, use_replica=False, use_cache=False)
+        return {row[0]: row[1] for row in rows}
+
+    def get_schema(self, tables: List[str]) -> Dict[str, List[str]]:
+        """
+        Reads the column names of the given tables from INFORMATION_SCHEMA.
+        Args:
+            tables (List[str]): The table names in the dbo schema.
+        Returns:
+            Dict[str, List[str]]: The columns of each table, in ordinal order.
+        """
+        table_list = ", ".join(f"'{table}'" for table in tables)
+        rows = self.execute_query(
+            "SELECT TABLE_NAME, COLUMN_NAME FROM INFORMATION_SCHEMA.COLUMNS "
+            f"WHERE TABLE_SCHEMA = 'dbo' AND TABLE_NAME IN ({table_list}) ORDER BY TABLE_NAME, ORDINAL_POSITION",
+            max_rows=None, max_bytes=None, use_replica=False, use_cache=False
+        )
+        schema: Dict[str, List[str]] = {}
+        for table, column in rows:
+            schema.setdefault(table, []).append(column)
+        return schema
+
+class SchemaRegistry:
+    """
+    Describes the queryable tables to the SQL-generation LLM. Each table is
+    registered once and rendered as a compact block; `select_tables` picks
+    the tables a question needs so the prompt carries only those.
+    """
+    def __init__(self, tables: Dict[str, Dict[str, Any]] = None):
+        self.tables: Dict[str, Dict[str, Any]] = {}
+        for name, spec in (TABLE_DESCRIPTIONS if tables is None else tables).items():
+            self.register(name, **spec)
+
+    def register(self, name: str, description: str, columns: List[tuple] = (), references: Dict[str, str] = None,
+                 keywords: List[str] = (), precomputed: bool = False):
+        """
+        Adds or replaces the description of a table.
+        Args:
+            name (str): The table name in the dbo schema.
+            description (str): What the table holds.
+            columns (List[tuple]): (name, type, note) of each column; may be empty when the description lists them.
+            references (Dict[str, str]): Column -> "Table.Column" it joins with.
+            keywords (List[str]): Lowercase words of a question that make the table relevant.
+            precomputed (bool): The table is an aggregate the LLM should prefer.
+        """
+        self.tables[name] = {"description": description, "columns": list(columns), "references": dict(references or {}),
+                             "keywords": set(keywords), "precomputed": precomputed}
+
+    def select_tables(self, question: str, example_queries: List[str] = ()) -> List[str]:
+        """
+        Picks the tables relevant to a question.
+        Args:
+            question (str): The user question.
+            example_queries (List[str]): Queries of the closest examples; the tables they read are included.
+        Returns:
+            List[str]: Table names in registration order; every table when nothing matches.
+        """
+        words = set(re.findall(r"\w+", question.lower()))
+        selected = {name for name, spec in self.tables.items() if spec["keywords"] & words}
+        for query in example_queries:
+            selected.update(table for table in extract_table_names(query) if table in self.tables)
+        if not selected:
+            return list(self.tables)
+        # Add the tables that selected ones join with, so the join columns are described
+        for name in list(selected):
+            for target in self.tables[name]["references"].values():
+                table = target.split(".")[0]
+                if table in self.tables:
+                    selected.add(table)
+        return [name for name in self.tables if name in selected]
+
+    def render(self, tables: List[str] = None) -> str:
+        """
+        Renders the schema block of the SQL prompt.
+        Args:
+            tables (List[str], optional): The tables to describe; all when omitted.
+        Returns:
+            str: One header line and one column line per table.
+        """
+        lines = []
+        for name in tables or list(self.tables):
+            spec = self.tables[name]
+            marker = " (precomputed, prefer it over sorting or aggregating its source tables)" if spec["precomputed"] else ""
+            lines.append(f"[dbo].[{name}]{marker}: {spec['description']}")
+            if spec["columns"]:
+                columns = []
+                for column, data_type, note in spec["columns"]:
+                    reference = spec["references"].get(column)
+                    details = "; ".join(part for part in (note, f"joins {reference}" if reference else "") if part)
+                    columns.append(f"{column} {data_type}" + (f" ({details})" if details else ""))
+                lines.append("  " + ", ".join(columns))
+        return "\n".join(lines)
+
+class PipelineMetrics:
+    """
+    Thread-safe latency and counter registry for the question pipeline. Each
+    stage keeps its lifetime count and total seconds plus its last `window_size`
+    samples, from which the p50/p95/p99 latencies are computed. Counters are
+    keyed by name and labels, e.g. `increment("requests", outcome="cached")`.
+    """
+    def __init__(self, window_size: int = METRICS_WINDOW_SIZE):
+        self.window_size = window_size
+        self._samples: Dict[str, deque] = {}
+        self._counts: Dict[str, int] = {}
+        self._sums: Dict[str, float] = {}
+        self._counters: Dict[tuple, float] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, stage: str, seconds: float):
+        """Records one latency sample of a stage."""
+        with self._lock:
+            if stage not in self._samples:
+                self._samples[stage] = deque(maxlen=self.window_size)
+                self._counts[stage] = 0
+                self._sums[stage] = 0.0
+            self._samples[stage].append(seconds)
+            self._counts[stage] += 1
+            self._sums[stage] += seconds
+
+    @contextmanager
+    def timer(self, stage: str):
+        """Records the duration of a `with` block as a sample of `stage`, whether or not it raises."""
+        start_time = time.perf_counter()
+        try:
+            yield
         finally:
-            # It's generally better to close connections when they are no longer needed,
-            # or manage them via a connection pool for a web service.
-            # For this example, we'll keep it simple and close after each operation.
-            if self.conn:
-                self.conn.close()
-                self.conn = None # Reset connection to force re-establishment on next call
-                print("Database connection closed.")
-        return rows
+            self.observe(stage, time.perf_counter() - start_time)
+
+    def increment(self, name: str, value: float = 1, **labels: str):
+        """Adds `value` to the counter `name` with the given labels."""
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def summary(self) -> Dict[str, Any]:
+        """Returns the stage latencies in milliseconds and the counters, keyed as `name{label=value}`."""
+        with self._lock:
+            samples = {stage: np.array(values) for stage, values in self._samples.items()}
+            counts, sums, counters = dict(self._counts), dict(self._sums), dict(self._counters)
+        stages = {}
+        for stage, values in samples.items():
+            stages[stage] = {"count": counts[stage], "avg_ms": round(sums[stage] / counts[stage] * 1000, 2),
+                             "max_ms": round(float(values.max()) * 1000, 2)}
+            for quantile in METRICS_QUANTILES:
+                stages[stage][f"p{round(quantile * 100)}_ms"] = round(float(np.quantile(values, quantile)) * 1000, 2)
+        return {"stages": stages, "counters": {self._counter_name(name, labels, "="): value
+                                               for (name, labels), value in sorted(counters.items())}}
+
+    def render_prometheus(self, gauges: Dict[str, float] = None, prefix: str = "concierge") -> str:
+        """
+        Renders the metrics in the Prometheus text exposition format.
+        Args:
+            gauges (Dict[str, float], optional): Point-in-time values to include, e.g. cache hit rates.
+            prefix (str): Prefix of every metric name.
+        Returns:
+            str: Stage latencies as one summary in seconds, counters with a `_total` suffix, then the gauges.
+        """
+        with self._lock:
+            samples = {stage: np.array(values) for stage, values in self._samples.items()}
+            counts, sums, counters = dict(self._counts), dict(self._sums), dict(self._counters)
+        lines = []
+        if samples:
+            name = f"{prefix}_stage_seconds"
+            lines.append(f"# TYPE {name} summary")
+            for stage, values in sorted(samples.items()):
+                for quantile in METRICS_QUANTILES:
+                    lines.append(f'{name}{{stage="{stage}",quantile="{quantile}"}} {np.quantile(values, quantile):.6f}')
+                lines.append(f'{name}_sum{{stage="{stage}"}} {sums[stage]:.6f}')
+                lines.append(f'{name}_count{{stage="{stage}"}} {counts[stage]}')
+        typed = set()
+        for (name, labels), value in sorted(counters.items()):
+            metric = f"{prefix}_{name}_total"
+            if metric not in typed:
+                lines.append(f"# TYPE {metric} counter")
+                typed.add(metric)
+            lines.append(f"{self._counter_name(metric, labels, '=', quote=True)} {value:g}")
+        for name, value in sorted((gauges or {}).items()):
+            lines.append(f"# TYPE {prefix}_{name} gauge")
+            lines.append(f"{prefix}_{name} {value:g}")
+        return "\n".join(lines) + "\n"
+
+    @staticmethod
+    def _counter_name(name: str, labels: tuple, separator: str, quote: bool = False) -> str:
+        if not labels:
+            return name
+        return name + "{" + ",".join(f'{key}{separator}"{value}"' if quote else f"{key}{separator}{value}"
+                                     for key, value in labels) + "}"
+
+class TokenUsageCallback(BaseCallbackHandler):
+    """Counts the prompt and completion tokens Ollama reports at the end of each call."""
+    def __init__(self, metrics: PipelineMetrics, role: str):
+        self.metrics = metrics
+        self.role = role
+
+    def on_llm_end(self, response: Any, **kwargs: Any):
+        for generations in response.generations:
+            for generation in generations:
+                info = generation.generation_info or {}
+                self.metrics.increment("llm_calls", role=self.role)
+                self.metrics.increment("llm_prompt_tokens", info.get("prompt_eval_count", 0), role=self.role)
+                self.metrics.increment("llm_completion_tokens", info.get("eval_count", 0), role=self.role)
 
 class LLMService:
     """
     Handles interactions with Ollama LLMs for SQL query generation and
     conversational responses.
     """
-    def __init__(self, sql_llm_model: str = "llama3.2", chat_llm_model: str = "llama3.2"):
-        self.sql_llm = OllamaLLM(model=sql_llm_model)
-        self.chat_llm = OllamaLLM(model=chat_llm_model)
+    def __init__(self, sql_llm_model: str = "llama3.2", chat_llm_model: str = "llama3.2",
+                 schema_registry: SchemaRegistry = None, metrics: PipelineMetrics = None):
+        # Keeping the models loaded also keeps their prompt cache, so the shared prefix is not evaluated again
+        # The HTTP timeout ends calls a request stopped waiting for at its deadline
+        self.sql_llm_model = sql_llm_model
+        self.chat_llm_model = chat_llm_model
+        self.sql_llm, self.chat_llm, self.warmup_llm = self._make_llms()
+        # The async paths use their own models, whose async Ollama clients belong to one event loop each
+        self._async_llms = LoopLocal(self._make_llms)
+        self.schema_registry = schema_registry or SchemaRegistry()
+        self.metrics = metrics
         self.sql_prompt_template = self._get_sql_prompt_template()
         self.chat_prompt_template = self._get_chat_prompt_template()
+        self.summary_prompt_template = self._get_summary_prompt_template()
+
+    def set_aggregate_tables(self, tables: List[str]):
+        """Describes the given precomputed tables in the SQL prompt, asking the LLM to prefer them."""
+        for table in tables:
+            spec = AGGREGATE_TABLES[table]
+            self.schema_registry.register(table, spec["description"], keywords=spec.get("keywords", ()), precomputed=True)
+
+    def _make_llms(self) -> tuple:
+        """Creates the SQL, chat and warmup models."""
+        client_kwargs = {"timeout": REQUEST_DEADLINE_SECONDS}
+        sql_llm = OllamaLLM(model=self.sql_llm_model, keep_alive=OLLAMA_KEEP_ALIVE, client_kwargs=client_kwargs)
+        chat_llm = OllamaLLM(model=self.chat_llm_model, keep_alive=OLLAMA_KEEP_ALIVE, client_kwargs=client_kwargs)
+        warmup_llm = OllamaLLM(model=self.sql_llm_model, keep_alive=OLLAMA_KEEP_ALIVE, num_predict=1,
+                               client_kwargs=client_kwargs)
+        return sql_llm, chat_llm, warmup_llm
 
     def _get_sql_prompt_template(self) -> PromptTemplate:
-        """Defines the prompt template for SQL query generation."""
+        """
+        Defines the prompt template for SQL query generation. Static instructions
+        come first and per-request values last, so Ollama can reuse the cached
+        prefix of the previous call instead of evaluating it again.
+        """
         template = """
 You are a Postgres expert. 
-Generate a SQL query to answer the {question}. 
+Generate a SQL query to answer the user question given at the end. 
 Your response must be based only on the provided context and must strictly follow the response guidelines and format instructions.
 === Response Guidelines
 Return ONLY the SQL query. Do not include any instructions, explanations, comments, or additional details or lines in the output.
 If the provided context is sufficient, generate a valid SQL query without any explanations, comments, or additional text.
 
-When the query: {query} is not None, it means that the query execution throw this kind of {exception}  in the previous query generation.. use this information to generate again the correct query
-.
+When a previous query and its error are given at the end, the previous query failed with that error: use this information to generate again the correct query.
+
 If the context is insufficient to generate a query, explain briefly why and conclude with: Decision: insufficient.
 
 When questions are phrased differently but have the same intent, rephrase the question to match the available data context and generate the query. 
@@ -331,145 +2748,23 @@ You use COUNT(DISTINCT column) instead of COUNT(column) unless it is certain tha
 
 
 ===Additional Context
-
-The following details are for the "SupermarketItems" table in the  schema:
-
-Table Name	Column Name	Data Type	Description
-SupermarketItems	ID	nvarchar(10)	Unique item ID (not primary key).
-SupermarketItems	ItemName	nvarchar(255)	Name of the supermarket item.
-SupermarketItems	Category	nvarchar(100)	Category (e.g., Dairy, Produce).
-SupermarketItems	Brand	nvarchar(100)	Brand name of the item.
-SupermarketItems	Price	float	Price of the item.
-SupermarketItems	StockQuantity	int	Number of units available.
-SupermarketItems	ExpiryDate	date	Expiration date.
-SupermarketItems	Supplier	nvarchar(100)	Supplier name.
-SupermarketItems	Allergy	nvarchar(50)	Allergy info (e.g., Nuts, Gluten).
-SupermarketItems	Location	nvarchar(50)	Store section where the item is found.
-SupermarketItems	NutriScore	nvarchar(5)	Nutritional score (e.g., A to E).
-SupermarketItems	SalesPerMonth	int	Number of units sold per month.
-
-The following details are for the "Recipes" table in the  schema:
-Table Name	Column Name	Data Type	Description
-Recipes	RecipeID	int	Unique ID for the recipe. Primary Key.
-Recipes	RecipeName	nvarchar(100)	Name of the recipe.
-Recipes	Description	nvarchar(255)	Short recipe description.
-Recipes	Category	nvarchar(50)	Recipe category (e.g., Dessert, Vegan).
-
-The following details are for the "Instructions" table in the  schema:
-Table Name	Column Name	Data Type	Description
-Instructions	InstructionID	int	Unique ID for each instruction. Primary Key.
-Instructions	RecipeID	int	Linked recipe ID. Foreign Key → Recipes(RecipeID).
-Instructions	StepNumber	int	Order of the instruction step.
-Instructions	StepDescription	nvarchar(500)	Description of what to do in that step.
-
-The following details are for the "Ingredients" table in the  schema:
-Table Name	Column Name	Data Type	Description
-Ingredients	IngredientID	int	Unique ID for each ingredient. Primary Key.
-Ingredients	RecipeID	int	Linked recipe ID. Foreign Key → Recipes(RecipeID).
-Ingredients	IngredientName	nvarchar(100)	Name of the ingredient.
-Ingredients	Quantity	nvarchar(100)	Quantity (e.g., "2 cups", "100g").
-
-
-here the schema of "SupermarketItems":
-/****** Object:  Table [dbo].[SupermarketItems]    Script Date: 09/07/2025 12:12:54 ******/
-SET ANSI_NULLS ON
-GO
-
-SET QUOTED_IDENTIFIER ON
-GO
-
-CREATE TABLE [dbo].[SupermarketItems](
-	[ID] [nvarchar](10) NULL,
-	[ItemName] [nvarchar](255) NULL,
-	[Category] [nvarchar](100) NULL,
-	[Brand] [nvarchar](100) NULL,
-	[Price] [float] NULL,
-	[StockQuantity] [int] NULL,
-	[ExpiryDate] [date] NULL,
-	[Supplier] [nvarchar](100) NULL,
-	[Allergy] [nvarchar](50) NULL,
-	[Location] [nvarchar](50) NULL,
-	[NutriScore] [nvarchar](5) NULL,
-	[SalesPerMonth] [int] NULL
-) ON [PRIMARY]
-GO
-
-here the schema of "Recipes":
-/****** Object:  Table [dbo].[Recipes]    Script Date: 09/07/2025 12:12:45 ******/
-SET ANSI_NULLS ON
-GO
-
-SET QUOTED_IDENTIFIER ON
-GO
-
-CREATE TABLE [dbo].[Recipes](
-	[RecipeID] [int] IDENTITY(1,1) NOT NULL,
-	[RecipeName] [nvarchar](100) NULL,
-	[Description] [nvarchar](255) NULL,
-	[Category] [nvarchar](50) NULL,
-PRIMARY KEY CLUSTERED 
-(
-	[RecipeID] ASC
-)WITH (STATISTICS_NORECOMPUTE = OFF, IGNORE_DUP_KEY = OFF, OPTIMIZE_FOR_SEQUENTIAL_KEY = OFF) ON [PRIMARY]
-) ON [PRIMARY]
-GO
-
-here the schema of "Instructions":
-/****** Object:  Table [dbo].[Instructions]    Script Date: 09/07/2025 12:12:37 ******/
-SET ANSI_NULLS ON
-GO
-
-SET QUOTED_IDENTIFIER ON
-GO
-
-CREATE TABLE [dbo].[Instructions](
-	[InstructionID] [int] IDENTITY(1,1) NOT NULL,
-	[RecipeID] [int] NULL,
-	[StepNumber] [int] NULL,
-	[StepDescription] [nvarchar](500) NULL,
-PRIMARY KEY CLUSTERED 
-(
-	[InstructionID] ASC
-)WITH (STATISTICS_NORECOMPUTE = OFF, IGNORE_DUP_KEY = OFF, OPTIMIZE_FOR_SEQUENTIAL_KEY = OFF) ON [PRIMARY]
-) ON [PRIMARY]
-GO
-
-ALTER TABLE [dbo].[Instructions]  WITH CHECK ADD FOREIGN KEY([RecipeID])
-REFERENCES [dbo].[Recipes] ([RecipeID])
-GO
-
-here the schema of "Ingredients":
-/****** Object:  Table [dbo].[Ingredients]    Script Date: 09/07/2025 12:12:26 ******/
-SET ANSI_NULLS ON
-GO
-
-SET QUOTED_IDENTIFIER ON
-GO
-
-CREATE TABLE [dbo].[Ingredients](
-	[IngredientID] [int] IDENTITY(1,1) NOT NULL,
-	[RecipeID] [int] NULL,
-	[IngredientName] [nvarchar](100) NULL,
-	[Quantity] [nvarchar](100) NULL,
-PRIMARY KEY CLUSTERED 
-(
-	[IngredientID] ASC
-)WITH (STATISTICS_NORECOMPUTE = OFF, IGNORE_DUP_KEY = OFF, OPTIMIZE_FOR_SEQUENTIAL_KEY = OFF) ON [PRIMARY]
-) ON [PRIMARY]
-GO
-
-ALTER TABLE [dbo].[Ingredients]  WITH CHECK ADD FOREIGN KEY([RecipeID])
-REFERENCES [dbo].[Recipes] ([RecipeID])
-GO
-
+The tables you can query (SQL Server, schema dbo):
+{schema}
 
 ===here the list of user question and relative query that you can use as examples to generate the right query:
 {business_question}
+
+===Previous query: {query}
+===Previous error: {exception}
+===User question: {question}
         """
-        return PromptTemplate(template=template, input_variables=["question", "business_question", "exception", "query"])
+        return PromptTemplate(template=template, input_variables=["question", "business_question", "exception", "query", "schema"])
 
     def _get_chat_prompt_template(self) -> PromptTemplate:
-        """Defines the prompt template for conversational responses."""
+        """
+        Defines the prompt template for conversational responses, with the static
+        instructions first and the growing chat history ahead of the new data.
+        """
         template = """
 You are an concierge of a Grocery Shop and you provide an answer to all irrespective of their age.
 === Response Guidelines
@@ -479,22 +2774,43 @@ Answer in the precise and in a simple sentences and in a natural language
 Do NOT print in the output <think> </think> content , strictly just provide an answer 
 Answer the question clearly and directly. Do not include any internal thoughts or <think> tags.
 Also answer in such a way that, the text i.e answer can be translted to Speech.
-=== Chat History:
-{chat_history}
-
-Question: {question} 
-read this information: {data} answer to this question.
 Please provide an answer as shorter as possible.
 If the ingredients is part of an answer, provide with any numbering, symbols or any kind of bullets
 Do not put the steps in any sort of symbols ex: *, - etc.
 Please use only the data which is been provided to answer the question. 
+=== Chat History:
+{chat_history}
+
+Read this information: 
+{data}
 
+Question: {question} 
 Answer:  
         """
-        #return PromptTemplate(template=template, input_variables=["question", "data"])
         return PromptTemplate(template=template, input_variables=["chat_history", "question", "data"])
 
-    def generate_sql_query(self, question: str, business_question_context: str, previous_query: str = None, previous_exception: str = None) -> str:
+    def _get_summary_prompt_template(self) -> PromptTemplate:
+        """
+        Defines the prompt template that folds old chat messages into the running summary.
+        """
+        template = """
+Summarize the conversation between a grocery shop customer and its concierge, so the concierge can continue it.
+Keep the products, recipes, quantities and preferences the customer mentioned and what was answered; leave out greetings.
+Write plain sentences, at most {max_words} words, with no <think> tags or other commentary.
+=== Summary so far:
+{summary}
+=== New messages:
+{messages}
+Summary:
+        """
+        return PromptTemplate(template=template, input_variables=["summary", "messages", "max_words"])
+
+    def _run_config(self, role: str) -> Dict[str, Any]:
+        """The chain config counting the tokens of one kind of call, when metrics are collected."""
+        return {"callbacks": [TokenUsageCallback(self.metrics, role)]} if self.metrics is not None else {}
+
+    def generate_sql_query(self, question: str, business_question_context: str, previous_query: str = None,
+                           previous_exception: str = None, example_queries: List[str] = ()) -> str:
         """
         Generates a SQL query based on the user's question and business context.
         Args:
@@ -502,49 +2818,259 @@ Answer:
             business_question_context (str): Context from similar business questions.
             previous_query (str, optional): The previously attempted query, if any.
             previous_exception (str, optional): The exception from the previous query, if any.
+            example_queries (List[str], optional): Queries of the closest examples, used to pick the tables
+                                                   described in the prompt.
         Returns:
             str: The generated SQL query.
         """
         sql_chain = self.sql_prompt_template | self.sql_llm
-        output = sql_chain.invoke({
+        output = sql_chain.invoke(self._sql_inputs(question, business_question_context, previous_query,
+                                                   previous_exception, example_queries), config=self._run_config("sql"))
+        return extract_sql_query_from_llm_output(output)
+
+    async def agenerate_sql_query(self, question: str, business_question_context: str, previous_query: str = None,
+                                  previous_exception: str = None, example_queries: List[str] = ()) -> str:
+        """Async variant of `generate_sql_query`, using the async Ollama client."""
+        sql_llm, _, _ = self._async_llms.get()
+        sql_chain = self.sql_prompt_template | sql_llm
+        output = await sql_chain.ainvoke(self._sql_inputs(question, business_question_context, previous_query,
+                                                          previous_exception, example_queries), config=self._run_config("sql"))
+        return extract_sql_query_from_llm_output(output)
+
+    def _sql_inputs(self, question: str, business_question_context: str, previous_query: str | None,
+                    previous_exception: str | None, example_queries: List[str]) -> Dict[str, Any]:
+        tables = self.schema_registry.select_tables(question, example_queries) if PRUNE_SQL_SCHEMA else None
+        return {
             "question": question,
             "business_question": business_question_context,
             "exception": previous_exception,
-            "query": previous_query
-        })
-        return extract_sql_query_from_llm_output(output)
+            "query": previous_query,
+            "schema": self.schema_registry.render(tables)
+        }
 
-    def generate_chat_response(self, question: str, data: List[Any], chat_history: List[Dict[str, str]]) -> str:
+    async def awarm_sql_prompt(self):
         """
-        Generates a conversational response based on the user's question and query results.
+        Evaluates the static prefix of the SQL prompt with a single output token, so the
+        SQL generation that follows only pays for the per-question tail.
+        """
+        prefix = self.sql_prompt_template.template.split("{", 1)[0]
+        _, _, warmup_llm = self._async_llms.get()
+        await warmup_llm.ainvoke(prefix, config=self._run_config("warmup"))
+
+    def stream_chat_response(self, question: str, data: List[Any], chat_history: str) -> Iterator[str]:
+        """
+        Streams a conversational response based on the user's question and query results.
+        The chat model runs once; its tokens are yielded as they are generated.
         Args:
             question (str): The user's natural language question.
-            data (List[Any]): The data retrieved from the database.
-            chat_history (List[Dict[str, str]]):
+            data (List[Any]): The data retrieved from the database, formatted with `format_query_result`.
+            chat_history (str): The formatted conversation so far.
         Returns:
-            str: The conversational response.
+            Iterator[str]: The chunks of the response.
         """
-        ## Added code
-        #chain = LLMChain(llm=self.chat_llm, prompt=self.chat_prompt_template)
-        
         chat_chain = self.chat_prompt_template | self.chat_llm
-        full_response = ""
-
-        # Use .stream() instead of .invoke()
-        for chunk in chat_chain.stream({"question": question, "data": data, "chat_history": chat_history}):
-            full_response += chunk
+        for chunk in chat_chain.stream({"question": question, "data": format_query_result(data), "chat_history": chat_history},
+                                       config=self._run_config("chat")):
+            print(chunk, end="", flush=True)
+            yield chunk
+        print()
+
+    async def astream_chat_response(self, question: str, data: List[Any], chat_history: str) -> AsyncIterator[str]:
+        """Async variant of `stream_chat_response`, using the async Ollama client."""
+        _, chat_llm, _ = self._async_llms.get()
+        chat_chain = self.chat_prompt_template | chat_llm
+        async for chunk in chat_chain.astream({"question": question, "data": format_query_result(data), "chat_history": chat_history},
+                                              config=self._run_config("chat")):
             print(chunk, end="", flush=True)
+            yield chunk
+        print()
 
-        chat_chain = self.chat_prompt_template | self.chat_llm
-        output = chat_chain.invoke({"question": question, "data": str(data), "chat_history": chat_history})
-        return full_response
+    def generate_chat_response(self, question: str, data: List[Any], chat_history: str) -> str:
+        """
+        Generates a conversational response based on the user's question and query results.
+        Args:
+            question (str): The user's natural language question.
+            data (List[Any]): The data retrieved from the database, formatted with `format_query_result`.
+            chat_history (str): The formatted conversation so far.
+        Returns:
+            str: The conversational response.
+        """
+        return "".join(self.stream_chat_response(question, data, chat_history))
+
+    def summarize_chat(self, summary: str, messages: str) -> str:
+        """
+        Folds chat messages into a running summary of the conversation.
+        Args:
+            summary (str): The summary so far, empty for the first call.
+            messages (str): The formatted messages to add to it.
+        Returns:
+            str: The new summary.
+        """
+        summary_chain = self.summary_prompt_template | self.chat_llm
+        output = summary_chain.invoke({
+            "summary": summary or "(none)",
+            "messages": messages,
+            "max_words": CHAT_SUMMARY_TOKEN_BUDGET * 3 // 4
+        }, config=self._run_config("summary"))
+        return re.sub(r"<think>.*?</think>", "", output, flags=re.DOTALL).strip()
 
 # --- Main Application Logic ---
 
+class DeadlineExceeded(Exception):
+    """Raised when a stage of a request cannot finish within the request's deadline."""
+    def __init__(self, stage: str):
+        super().__init__(f"Deadline exceeded during {stage}.")
+        self.stage = stage
+
+class Deadline:
+    """
+    The point in time by which a request must be answered. Stage timeouts are
+    derived from the remaining time, capped by STAGE_TIMEOUT_SECONDS.
+    """
+    def __init__(self, seconds: float = REQUEST_DEADLINE_SECONDS):
+        self.expires_at = time.monotonic() + seconds
+
+    def remaining(self) -> float:
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def timeout(self, stage: str, reserve: float = 0.0) -> float:
+        """
+        Returns how long a stage may take.
+        Args:
+            stage (str): The stage, a key of STAGE_TIMEOUT_SECONDS; uncapped when it is not one.
+            reserve (float): Seconds of the remaining time to leave for later stages.
+        Raises:
+            DeadlineExceeded: If no time is left for the stage.
+        """
+        timeout = min(STAGE_TIMEOUT_SECONDS.get(stage, math.inf), self.remaining() - reserve)
+        if timeout <= 0:
+            raise DeadlineExceeded(stage)
+        return timeout
+
+class ChatHistory:
+    """
+    The chat history of one conversation, bounded for the chat prompt. The last
+    `keep_turns` turns are kept verbatim, within `token_budget` estimated tokens.
+    Older messages are folded into a running summary by `summarize`, on
+    `executor`, so no answer waits for it; until the summary lands they stay in
+    the prompt as they were. Without `summarize` they are dropped.
+    The formatted history is extended as messages arrive rather than rebuilt on every turn.
+    """
+    def __init__(self, summarize: Callable[[str, str], str] = None, executor: ThreadPoolExecutor = None,
+                 keep_turns: int = CHAT_HISTORY_KEEP_TURNS, token_budget: int = CHAT_HISTORY_TOKEN_BUDGET):
+        self.summarize = summarize
+        self.executor = executor
+        self.keep_turns = keep_turns
+        self.token_budget = token_budget
+        self.summary = ""
+        self._messages: deque = deque()
+        self._lines: deque = deque() # Formatted messages, parallel to _messages
+        self._recent = "" # "".join(_lines)
+        self._pending: List[str] = [] # Evicted lines not folded into the summary yet
+        self._prefix = "" # The summary and the pending lines, formatted
+        self._summarizing = False
+        self._generation = 0 # Bumped by clear(), so summaries of cleared messages are discarded
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def format_message(message: Dict[str, str]) -> str:
+        return f"{message['role'].capitalize()}: {message['content']}\n"
+
+    def __len__(self) -> int:
+        return len(self._messages)
+
+    def __iter__(self) -> Iterator[Dict[str, str]]:
+        with self._lock:
+            return iter(list(self._messages))
+
+    def __getitem__(self, index: int) -> Dict[str, str]:
+        return self._messages[index]
+
+    def append(self, message: Dict[str, str]):
+        """Adds a message, evicting the oldest ones beyond the window or the token budget."""
+        line = self.format_message(message)
+        with self._lock:
+            self._messages.append(message)
+            self._lines.append(line)
+            self._recent += line
+            evicted = False
+            # The newest message always stays, even when it alone exceeds the budget
+            while len(self._messages) > 1 and (len(self._messages) > 2 * self.keep_turns
+                                               or len(self._recent) > self.token_budget * CHARS_PER_TOKEN):
+                self._messages.popleft()
+                evicted_line = self._lines.popleft()
+                self._recent = self._recent[len(evicted_line):]
+                if self.summarize is not None:
+                    self._pending.append(evicted_line)
+                evicted = True
+            if evicted:
+                self._update_prefix()
+                self._schedule_summary()
+
+    def clear(self):
+        with self._lock:
+            self.summary = ""
+            self._messages.clear()
+            self._lines.clear()
+            self._recent = ""
+            self._pending = []
+            self._prefix = ""
+            self._generation += 1
+
+    def format(self) -> str:
+        """The history as it goes into the chat prompt: the summary, pending lines and recent messages."""
+        with self._lock:
+            return self._prefix + self._recent
+
+    def _update_prefix(self):
+        summary = f"Summary of the earlier conversation: {self.summary}\n" if self.summary else ""
+        self._prefix = summary + "".join(self._pending)
+
+    def _schedule_summary(self):
+        """Starts folding the pending lines unless a summary is already being written. Called with the lock held."""
+        if self._summarizing or not self._pending:
+            return
+        self._summarizing = True
+        args = (self.summary, list(self._pending), self._generation)
+        if self.executor is not None:
+            self.executor.submit(self._fold, *args)
+        else:
+            threading.Thread(target=self._fold, args=args, daemon=True).start()
+
+    def _fold(self, summary: str, lines: List[str], generation: int):
+        try:
+            new_summary = self.summarize(summary, "".join(lines))[:CHAT_SUMMARY_TOKEN_BUDGET * CHARS_PER_TOKEN]
+        except Exception as e:
+            # Keep the window bounded anyway; only the older context is lost
+            print(f"Could not summarize chat history: {e}")
+            new_summary = summary
+        with self._lock:
+            self._summarizing = False
+            if generation != self._generation:
+                return
+            self.summary = new_summary
+            del self._pending[:len(lines)]
+            self._update_prefix()
+            self._schedule_summary() # Lines evicted while this summary was written
+
+class ConciergeSession:
+    """
+    The state of one conversation: its chat history, the metadata of its last
+    answer and its client settings. Everything else (vector store, database
+    pool, LLM clients, caches) is shared through one GroceryConciergeApp.
+    """
+    def __init__(self, session_id: str = None, settings: Dict[str, Any] = None, chat_history: ChatHistory = None):
+        self.session_id = session_id or uuid.uuid4().hex
+        self.settings: Dict[str, Any] = dict(settings or {})
+        self.chat_history = chat_history if chat_history is not None else ChatHistory()
+        self.last_answer_metadata: Dict[str, Any] = {}
+        self.created_at = time.time()
+
 class GroceryConciergeApp:
     """
     Main application class orchestrating the interactions between
-    Redis, SQL database, and LLM services.
+    Redis, SQL database, and LLM services. One instance is meant to be shared
+    by every conversation of the process, each represented by a ConciergeSession.
     """
     def __init__(self):
         self.redis_store = RedisVectorStore(
@@ -554,92 +3080,716 @@ class GroceryConciergeApp:
             index_name=INDEX_NAME,
             doc_prefix=DOC_PREFIX
         )
-        self.db_manager = SQLDatabaseManager(get_db_connection_string())
-        self.llm_service = LLMService()
-        self.chat_history: List[Dict[str, str]] = [] # Initialize chat history
-
-    def initialize_backend(self):
-        """Initializes Redis index and ingests initial data."""
+        replica_tables = INVENTORY_TABLES + (list(AGGREGATE_TABLES) if USE_AGGREGATE_TABLES else [])
+        self.db_manager = SQLDatabaseManager(
+            get_db_connection_string(),
+            replica=LocalReplica(tables=replica_tables) if USE_LOCAL_REPLICA else None,
+            result_cache=QueryResultCache() if USE_RESULT_CACHE else None
+        )
+        self.materializer = AggregateMaterializer(self.db_manager) if USE_AGGREGATE_TABLES else None
+        self.metrics = PipelineMetrics()
+        self.llm_service = LLMService(metrics=self.metrics)
+        # One worker, so summaries of every session queue up instead of competing for the chat model
+        self.summary_executor = ThreadPoolExecutor(max_workers=1) if SUMMARIZE_CHAT_HISTORY else None
+        self.stage_executor = ThreadPoolExecutor(max_workers=STAGE_WORKERS)
+        # Streams hold their worker for the whole answer, so they must not take the workers stages queue for
+        self.stream_executor = ThreadPoolExecutor(max_workers=STREAM_WORKERS)
+        self.default_session = ConciergeSession("default", chat_history=self._new_chat_history()) # Used when no session is passed
+        self.answer_cache = SemanticAnswerCache()
+        self.sql_validator = SQLValidator()
+        self.examples = get_business_questions(use_aggregates=False)
+        self.template_engine = IntentTemplateEngine(get_business_questions(use_aggregates=USE_AGGREGATE_TABLES))
+        self._table_versions: Dict[str, int] = {}
+        self._table_versions_checked_at = 0.0
+        self._inventory_watch = None
+        self._inventory_watch_stop = threading.Event()
+        self._warmup_tasks = set() # Keeps the background warmups of the async pipeline referenced
+
+    @property
+    def chat_history(self) -> ChatHistory:
+        """The chat history of the default session."""
+        return self.default_session.chat_history
+
+    @property
+    def last_answer_metadata(self) -> Dict[str, Any]:
+        """The metadata of the last answer of the default session."""
+        return self.default_session.last_answer_metadata
+
+    def new_session(self, settings: Dict[str, Any] = None) -> ConciergeSession:
+        """Creates the state of a new conversation; cheap enough to call on every page load."""
+        return ConciergeSession(settings=settings, chat_history=self._new_chat_history())
+
+    def component_stats(self) -> Dict[str, Dict[str, Any]]:
+        """Returns the counters of the caches and the connection pool."""
+        stats = {"embedding_cache": self.redis_store.embedding_cache.stats(), "answer_cache": self.answer_cache.stats()}
+        if self.db_manager.result_cache is not None:
+            stats["result_cache"] = self.db_manager.result_cache.stats()
+        if getattr(self.db_manager, "pool", None) is not None:
+            stats["db_pool"] = self.db_manager.pool.stats()
+        return stats
+
+    def metrics_summary(self) -> Dict[str, Any]:
+        """Returns the stage latencies, pipeline counters and component counters as one JSON-serializable dict."""
+        return {**self.metrics.summary(), "components": self.component_stats()}
+
+    def metrics_prometheus(self) -> str:
+        """Returns the pipeline metrics in Prometheus text format, with the numeric component counters as gauges."""
+        gauges = {f"{component}_{name}": value for component, stats in self.component_stats().items()
+                  for name, value in stats.items() if isinstance(value, (int, float))}
+        return self.metrics.render_prometheus(gauges)
+
+    def _new_chat_history(self) -> ChatHistory:
+        if not SUMMARIZE_CHAT_HISTORY:
+            return ChatHistory()
+        return ChatHistory(summarize=self.llm_service.summarize_chat, executor=self.summary_executor)
+
+    def refresh_answer_cache(self, force: bool = False):
+        """
+        Compares the inventory table checksums with the last known ones, at most once
+        every INVENTORY_CHECK_INTERVAL_SECONDS. Tables that changed are copied into the
+        local replica first, then the cached answers and query results that read from
+        them are dropped.
+        Args:
+            force (bool): Check now regardless of the interval.
+        """
+        now = time.monotonic()
+        if not force and now - self._table_versions_checked_at < INVENTORY_CHECK_INTERVAL_SECONDS:
+            return
+        self._table_versions_checked_at = now
+        try:
+            versions = self.db_manager.get_table_versions(INVENTORY_TABLES)
+        except Exception as e:
+            # Without a checksum we cannot tell whether cached answers are stale
+            print(f"Could not check inventory tables for changes: {e}")
+            self.answer_cache.invalidate()
+            if self.db_manager.result_cache is not None:
+                self.db_manager.result_cache.invalidate()
+            return
+        changed = [table for table, version in versions.items() if self._table_versions.get(table) != version]
+        if changed and self._table_versions:
+            print(f"Inventory tables changed: {changed}. Invalidating cached answers.")
+            # Bring the replica up to date first, or the next requests would refill the caches from old rows
+            replica = self.db_manager.replica
+            if replica is not None:
+                try:
+                    replica.refresh(self.db_manager, {table: versions[table] for table in changed})
+                except Exception as e:
+                    print(f"Could not refresh the local replica: {e}. Using the database until it is copied again.")
+                    replica.invalidate(changed)
+            self.answer_cache.invalidate(changed)
+            if self.db_manager.result_cache is not None:
+                self.db_manager.result_cache.invalidate(changed)
+        self._table_versions = versions
+
+    def start_inventory_watch(self):
+        """
+        Runs `refresh_answer_cache` every INVENTORY_CHECK_INTERVAL_SECONDS in a daemon thread,
+        so the checksum query never sits on the path of a request.
+        """
+        if self._inventory_watch is not None:
+            return
+
+        def watch_loop():
+            while True:
+                try:
+                    self.refresh_answer_cache(force=True)
+                except Exception as e:
+                    print(f"Inventory check failed: {e}")
+                if self._inventory_watch_stop.wait(INVENTORY_CHECK_INTERVAL_SECONDS):
+                    return
+
+        self._inventory_watch = threading.Thread(target=watch_loop, daemon=True)
+        self._inventory_watch.start()
+
+    def stop_inventory_watch(self):
+        """Stops the background inventory check."""
+        self._inventory_watch_stop.set()
+
+    def initialize_backend(self, incremental: bool = INCREMENTAL_SYNC):
+        """
+        Initializes Redis index and ingests initial data.
+        Args:
+            incremental (bool): When True, only new or changed examples are embedded and
+                                removed ones are deleted. When False, Redis is flushed
+                                and every example is re-ingested.
+        """
         print("Initializing backend...")
+        tables = INVENTORY_TABLES
+        try:
+            self.db_manager.pool.warm_up()
+            if self.materializer is not None:
+                self.materializer.refresh(force=True)
+                if self.materializer.ready:
+                    # Only steer the LLM and the examples to the aggregate tables once they exist
+                    tables = INVENTORY_TABLES + list(self.materializer.tables)
+                    self.examples = get_business_questions(use_aggregates=True)
+                    self.llm_service.set_aggregate_tables(list(self.materializer.tables))
+                self.materializer.start()
+            schema = self.db_manager.get_schema(tables)
+            if schema:
+                self.sql_validator.set_schema(schema)
+            self.template_engine.load_vocabulary(self.db_manager)
+        except Exception as e:
+            print(f"Could not open database connections: {e}. Continuing anyway.")
+        # A rejected valid query would cost every such question its SQL retries
+        problems = self.sql_validator.self_check(
+            SQLValidator.SELF_CHECK_QUERIES + [example["business_query"] for example in self.examples])
+        for query, problem in problems.items():
+            print(f"SQL validator self-check: {problem} Query: {query}")
+
+        replica = self.db_manager.replica
+        if replica is not None:
+            try:
+                replica.refresh(self.db_manager)
+            except Exception as e:
+                print(f"Could not refresh the local replica: {e}. Ready: {replica.ready}.")
+            replica.start(self.db_manager)
+        self.start_inventory_watch()
+
+        if incremental:
+            self.redis_store.create_index(vector_dimensions=VECTOR_DIMENSIONS)
+            self.redis_store.sync_data(self.examples)
+            print("Backend initialization complete.")
+            return
+
         # Flush all data in Redis (use with caution in production)
         try:
             self.redis_store.client.flushall()
             print("All data in Redis have been cleared.")
+            if self.redis_store.local_index is not None:
+                self.redis_store.local_index.clear()
         except Exception as e:
             print(f"Could not flush Redis: {e}. Continuing anyway.")
 
         self.redis_store.create_index(vector_dimensions=VECTOR_DIMENSIONS)
-        self.redis_store.ingest_data(BUSINESS_QUESTIONS_DATA)
+        self.redis_store.ingest_data(self.examples)
         print("Backend initialization complete.")
 
-    def process_user_question(self, user_question: str) -> str:
+    def process_user_question(self, user_question: str, session: ConciergeSession = None,
+                              deadline: Deadline = None) -> str:
+        """
+        Processes a user's question and returns the complete answer.
+        See `process_user_question_stream` for the steps.
+        Args:
+            user_question (str): The natural language question from the user.
+            session (ConciergeSession, optional): The conversation; the default session when omitted.
+            deadline (Deadline, optional): When the answer is due; REQUEST_DEADLINE_SECONDS from now when omitted.
+        Returns:
+            str: The conversational answer to the user's question.
+        """
+        return "".join(self.process_user_question_stream(user_question, session, deadline))
+
+    def process_user_question_stream(self, user_question: str, session: ConciergeSession = None,
+                                     deadline: Deadline = None) -> Iterator[str]:
         """
         Processes a user's question by:
         1. Finding similar business questions in Redis.
-        2. Generating a SQL query using an LLM.
+        2. Generating a SQL query using an LLM, unless a stored example is close
+           enough to reuse its query directly.
         3. Executing the SQL query against the database.
         4. Generating a conversational response using another LLM.
+        The answer is yielded token by token as the chat model generates it.
+        The SQL behind the answer, the tables it read and the age of any aggregate
+        table among them are left in the session's `last_answer_metadata` once it is complete.
+        The latency of every stage, retries and cache outcomes are recorded in `metrics`.
+        Blocking stages run on `stage_executor` and the chat stream on `stream_executor`;
+        both are waited for with a timeout derived from `deadline`, and when it passes
+        a partial answer is given instead.
         Args:
             user_question (str): The natural language question from the user.
+            session (ConciergeSession, optional): The conversation; the default session when omitted.
+            deadline (Deadline, optional): When the answer is due; REQUEST_DEADLINE_SECONDS from now when omitted.
         Returns:
-            str: The conversational answer to the user's question.
+            Iterator[str]: The chunks of the conversational answer.
         """
         print(f"\n--- Processing User Question: '{user_question}' ---")
-        
-        # Step 1: Find similar business questions
-        similar_questions_results = self.redis_store.search_similar_questions(user_question)
-        business_question_context = str(similar_questions_results)
+        session = session or self.default_session
+        session.last_answer_metadata = {}
+        deadline = deadline or Deadline()
+        request_start = time.perf_counter()
+        answer_scope = self._answer_cache_scope(session, user_question)
+        session.chat_history.append({"role": "user", "content": user_question})
+
+        question_embedding = None
+        sql_query = None
+        db_results = []
+        exception_message = None
+        query_succeeded = False
+        sql_from_cache = False
+        final_answer = ""
+        try:
+            # Step 0: Reuse the answer of a near-identical recent question
+            question_embedding = self._run_stage("embedding", deadline, self.redis_store.embed_query, user_question)
+            cached_answer = self.answer_cache.get(question_embedding, **answer_scope)
+            if cached_answer is not None:
+                self._record_cached_answer(session, cached_answer, request_start)
+                yield cached_answer
+                self.metrics.observe("total", time.perf_counter() - request_start)
+                return
+
+            # Step 1: Find similar business questions
+            similar_questions_results = self._run_stage("knn_search", deadline, self.redis_store.search_similar_questions,
+                                                        user_question, embedding=question_embedding)
+            business_question_context = str(similar_questions_results)
+
+            # Step 2a: Reuse the stored query of a close example, skipping SQL generation
+            reusable_sql = self._reusable_sql(user_question, similar_questions_results)
+            if reusable_sql:
+                sql_query = reusable_sql
+                try:
+                    db_results = self._execute_with_deadline(sql_query, deadline)
+                    query_succeeded = sql_from_cache = True
+                    self.metrics.increment("sql_reused")
+                except DeadlineExceeded:
+                    raise
+                except Exception as e:
+                    # Fall back to generation, passing the failure so the LLM can repair the query
+                    exception_message = str(e)
+                    print(f"Stored SQL failed: {exception_message}")
+                    self.metrics.increment("sql_errors", source="stored")
+
+            # Step 2 & 3: Generate and execute SQL query (with retry logic)
+            max_retries = 3
+            for attempt in range(0 if sql_from_cache else max_retries):
+                print(f"Attempt {attempt + 1} to generate and execute SQL query...")
+                self.metrics.increment("sql_attempts")
+                if attempt > 0:
+                    self.metrics.increment("sql_retries")
+                try:
+                    generated_sql = self._run_stage(
+                        "sql_generation", deadline, self.llm_service.generate_sql_query,
+                        reserve=CHAT_RESERVE_SECONDS,
+                        question=user_question,
+                        business_question_context=business_question_context,
+                        previous_query=sql_query, # Pass previous query for re-generation
+                        previous_exception=exception_message, # Pass previous exception for re-generation
+                        example_queries=[result.business_query for result in similar_questions_results[:SCHEMA_EXAMPLE_COUNT]]
+                        #chat_history=self.chat_history
+                    )
+
+                    if not generated_sql:
+                        print("LLM did not generate a valid SQL query.")
+                        exception_message = "LLM failed to generate a valid SQL query."
+                        continue # Try again if LLM didn't produce SQL
+
+                    print(f"Generated SQL: {generated_sql}")
+                    sql_query = generated_sql # Store for potential retry
+
+                    # Catch invalid queries locally instead of paying a database round trip
+                    validation_error = self.sql_validator.validate(sql_query)
+                    if validation_error:
+                        raise ValueError(validation_error) # Handled like a database error below
+
+                    db_results = self._execute_with_deadline(sql_query, deadline)
+                    query_succeeded = True
+                    print("SQL query executed successfully.")
+                    break # Exit loop if successful
+                except DeadlineExceeded:
+                    raise
+                except Exception as e:
+                    exception_message = str(e)
+                    print(f"SQL execution failed: {exception_message}")
+                    self.metrics.increment("sql_errors", source="generated")
+                    if attempt == max_retries - 1:
+                        print("Max retries reached for SQL query generation/execution.")
+                        self.metrics.increment("requests", outcome="failed")
+                        self.metrics.observe("total", time.perf_counter() - request_start)
+                        # If all retries fail, return an error message to the user
+                        yield SQL_FAILURE_ANSWER
+                        return
+
+            # Store generated SQL that returned data as a new example for retrieval and reuse
+            if query_succeeded and not sql_from_cache and db_results and PROMOTE_SUCCESSFUL_QUERIES:
+                try:
+                    self._promote_learned_example(user_question, sql_query, question_embedding, similar_questions_results)
+                except Exception as e:
+                    print(f"Could not store learned example: {e}")
+
+            # Step 4: Stream the conversational response
+            chat_start = time.perf_counter()
+            for chunk in self._stream_with_deadline(self.llm_service.stream_chat_response(
+                    question = user_question, 
+                    data = db_results,
+                    chat_history=session.chat_history.format()
+            ), deadline):
+                if not final_answer:
+                    self.metrics.observe("chat_first_token", time.perf_counter() - chat_start)
+                    self.metrics.observe("first_token", time.perf_counter() - request_start)
+                final_answer += chunk
+                yield chunk
+            self.metrics.observe("chat_generation", time.perf_counter() - chat_start)
+        except DeadlineExceeded as e:
+            ending = self._deadline_answer(e, final_answer, db_results if query_succeeded else [])
+            final_answer += ending
+            yield ending
+            self._finish_answer(session, user_question, question_embedding, sql_query if query_succeeded else None,
+                                final_answer, request_start, answer_scope, deadline_stage=e.stage)
+            return
+        self._finish_answer(session, user_question, question_embedding, sql_query if query_succeeded else None,
+                            final_answer, request_start, answer_scope)
+
+    async def process_user_question_async(self, user_question: str, session: ConciergeSession = None,
+                                          deadline: Deadline = None) -> str:
+        """
+        Asyncio variant of `process_user_question`.
+        See `process_user_question_stream_async` for how it differs.
+        Args:
+            user_question (str): The natural language question from the user.
+            session (ConciergeSession, optional): The conversation; the default session when omitted.
+            deadline (Deadline, optional): When the answer is due; REQUEST_DEADLINE_SECONDS from now when omitted.
+        Returns:
+            str: The conversational answer to the user's question.
+        """
+        return "".join([chunk async for chunk in self.process_user_question_stream_async(user_question, session, deadline)])
 
+    async def process_user_question_stream_async(self, user_question: str, session: ConciergeSession = None,
+                                                 deadline: Deadline = None) -> AsyncIterator[str]:
+        """
+        Asyncio variant of `process_user_question_stream`, for serving many sessions from
+        one event loop. The steps are the same, but the stages that do not depend on each
+        other overlap: the query embedding runs together with a database connection
+        checkout and the SQL prompt warmup. Redis and Ollama
+        are called through their async clients; the blocking pyodbc and SQLite calls run
+        in the default thread pool executor. Stages are cancelled at their deadline-derived timeout.
+        Args:
+            user_question (str): The natural language question from the user.
+            session (ConciergeSession, optional): The conversation; the default session when omitted.
+            deadline (Deadline, optional): When the answer is due; REQUEST_DEADLINE_SECONDS from now when omitted.
+        Returns:
+            AsyncIterator[str]: The chunks of the conversational answer.
+        """
+        print(f"\n--- Processing User Question: '{user_question}' ---")
+        session = session or self.default_session
+        session.last_answer_metadata = {}
+        deadline = deadline or Deadline()
+        request_start = time.perf_counter()
+        answer_scope = self._answer_cache_scope(session, user_question)
+        session.chat_history.append({"role": "user", "content": user_question})
+
+        question_embedding = None
         sql_query = None
         db_results = []
         exception_message = None
-        self.chat_history.append({"role": "user", "content": user_question})
-        
-        # Step 2 & 3: Generate and execute SQL query (with retry logic)
-        max_retries = 3
-        for attempt in range(max_retries):
-            print(f"Attempt {attempt + 1} to generate and execute SQL query...")
-            try:
-                generated_sql = self.llm_service.generate_sql_query(
+        query_succeeded = False
+        sql_from_cache = False
+        final_answer = ""
+        # Step 0: Start everything that only needs the question, then check for a cached answer
+        self._start_warmup(asyncio.to_thread(self.db_manager.warm_connection), "Database connection")
+        sql_warmup = self._start_warmup(self.llm_service.awarm_sql_prompt(), "SQL prompt") if ASYNC_WARM_SQL_PROMPT else None
+        try:
+            question_embedding = await self._astage("embedding", deadline, self.redis_store.aembed_query(user_question))
+            cached_answer = self.answer_cache.get(question_embedding, **answer_scope)
+            if cached_answer is not None:
+                if sql_warmup is not None:
+                    sql_warmup.cancel()
+                self._record_cached_answer(session, cached_answer, request_start)
+                yield cached_answer
+                self.metrics.observe("total", time.perf_counter() - request_start)
+                return
+
+            # Step 1: Find similar business questions
+            similar_questions_results = await self._astage("knn_search", deadline, self.redis_store.asearch_similar_questions(
+                user_question, embedding=question_embedding))
+            business_question_context = str(similar_questions_results)
+
+            # Step 2a: Reuse the stored query of a close example, skipping SQL generation
+            reusable_sql = self._reusable_sql(user_question, similar_questions_results)
+            if reusable_sql:
+                sql_query = reusable_sql
+                try:
+                    db_results = await self._aexecute_with_deadline(sql_query, deadline)
+                    query_succeeded = sql_from_cache = True
+                    self.metrics.increment("sql_reused")
+                    if sql_warmup is not None:
+                        sql_warmup.cancel()
+                except DeadlineExceeded:
+                    raise
+                except Exception as e:
+                    # Fall back to generation, passing the failure so the LLM can repair the query
+                    exception_message = str(e)
+                    print(f"Stored SQL failed: {exception_message}")
+                    self.metrics.increment("sql_errors", source="stored")
+
+            # Step 2 & 3: Generate and execute SQL query (with retry logic)
+            max_retries = 3
+            for attempt in range(0 if sql_from_cache else max_retries):
+                print(f"Attempt {attempt + 1} to generate and execute SQL query...")
+                self.metrics.increment("sql_attempts")
+                if attempt > 0:
+                    self.metrics.increment("sql_retries")
+                try:
+                    generated_sql = await self._astage("sql_generation", deadline, self.llm_service.agenerate_sql_query(
+                        question=user_question,
+                        business_question_context=business_question_context,
+                        previous_query=sql_query,
+                        previous_exception=exception_message,
+                        example_queries=[result.business_query for result in similar_questions_results[:SCHEMA_EXAMPLE_COUNT]]
+                    ), reserve=CHAT_RESERVE_SECONDS)
+                    if not generated_sql:
+                        print("LLM did not generate a valid SQL query.")
+                        exception_message = "LLM failed to generate a valid SQL query."
+                        continue
+
+                    print(f"Generated SQL: {generated_sql}")
+                    sql_query = generated_sql
+                    validation_error = self.sql_validator.validate(sql_query)
+                    if validation_error:
+                        raise ValueError(validation_error)
+
+                    db_results = await self._aexecute_with_deadline(sql_query, deadline)
+                    query_succeeded = True
+                    print("SQL query executed successfully.")
+                    break
+                except DeadlineExceeded:
+                    raise
+                except Exception as e:
+                    exception_message = str(e)
+                    print(f"SQL execution failed: {exception_message}")
+                    self.metrics.increment("sql_errors", source="generated")
+                    if attempt == max_retries - 1:
+                        print("Max retries reached for SQL query generation/execution.")
+                        self.metrics.increment("requests", outcome="failed")
+                        self.metrics.observe("total", time.perf_counter() - request_start)
+                        yield SQL_FAILURE_ANSWER
+                        return
+
+            # Store generated SQL that returned data as a new example for retrieval and reuse
+            if query_succeeded and not sql_from_cache and db_results and PROMOTE_SUCCESSFUL_QUERIES:
+                try:
+                    await asyncio.to_thread(self._promote_learned_example, user_question, sql_query, question_embedding,
+                                            similar_questions_results)
+                except Exception as e:
+                    print(f"Could not store learned example: {e}")
+
+            # Step 4: Stream the conversational response
+            chat_start = time.perf_counter()
+            async for chunk in self._astream_with_deadline(self.llm_service.astream_chat_response(
                     question=user_question,
-                    business_question_context=business_question_context,
-                    previous_query=sql_query, # Pass previous query for re-generation
-                    previous_exception=exception_message # Pass previous exception for re-generation
-                    #chat_history=self.chat_history
-                )
-                
-                if not generated_sql:
-                    print("LLM did not generate a valid SQL query.")
-                    exception_message = "LLM failed to generate a valid SQL query."
-                    continue # Try again if LLM didn't produce SQL
-
-                print(f"Generated SQL: {generated_sql}")
-                sql_query = generated_sql # Store for potential retry
-                
-                db_results = self.db_manager.execute_query(sql_query)
-                print("SQL query executed successfully.")
-                break # Exit loop if successful
+                    data=db_results,
+                    chat_history=session.chat_history.format()
+            ), deadline):
+                if not final_answer:
+                    self.metrics.observe("chat_first_token", time.perf_counter() - chat_start)
+                    self.metrics.observe("first_token", time.perf_counter() - request_start)
+                final_answer += chunk
+                yield chunk
+            self.metrics.observe("chat_generation", time.perf_counter() - chat_start)
+        except DeadlineExceeded as e:
+            if sql_warmup is not None:
+                sql_warmup.cancel()
+            ending = self._deadline_answer(e, final_answer, db_results if query_succeeded else [])
+            final_answer += ending
+            yield ending
+            self._finish_answer(session, user_question, question_embedding, sql_query if query_succeeded else None,
+                                final_answer, request_start, answer_scope, deadline_stage=e.stage)
+            return
+        self._finish_answer(session, user_question, question_embedding, sql_query if query_succeeded else None,
+                            final_answer, request_start, answer_scope)
+
+    def _run_stage(self, stage: str, deadline: Deadline, function: Callable, *args: Any,
+                   reserve: float = 0.0, **kwargs: Any) -> Any:
+        """
+        Runs a blocking stage on `stage_executor`, recording its duration, and waits for it
+        until its deadline-derived timeout. A stage that times out keeps running on its
+        worker until it returns; the request no longer waits for it. That is bounded by
+        the database query timeout and the Ollama HTTP timeout, which end the call.
+        Raises:
+            DeadlineExceeded: If the stage did not finish in time.
+        """
+        timeout = deadline.timeout(stage, reserve)
+        with self.metrics.timer(stage):
+            future = self.stage_executor.submit(function, *args, **kwargs)
+            try:
+                return future.result(timeout=timeout)
+            except FutureTimeoutError:
+                if future.done():
+                    raise # The stage itself timed out
+                future.cancel()
+                raise DeadlineExceeded(stage) from None
+
+    async def _astage(self, stage: str, deadline: Deadline, awaitable: Any, reserve: float = 0.0) -> Any:
+        """Async variant of `_run_stage`; a stage that times out is cancelled."""
+        timeout = deadline.timeout(stage, reserve)
+        with self.metrics.timer(stage):
+            task = asyncio.ensure_future(awaitable)
+            done, _ = await asyncio.wait({task}, timeout=timeout)
+            if not done:
+                task.cancel()
+                await asyncio.wait({task}) # Let it unwind
+                raise DeadlineExceeded(stage)
+            return task.result()
+
+    def _execute_with_deadline(self, sql_query: str, deadline: Deadline) -> QueryResult:
+        """Executes a query with the database query timeout set to what the deadline leaves."""
+        timeout = deadline.timeout("sql_execution", CHAT_RESERVE_SECONDS)
+        return self._run_stage("sql_execution", deadline, self.db_manager.execute_query, sql_query,
+                               reserve=CHAT_RESERVE_SECONDS, timeout=timeout)
+
+    async def _aexecute_with_deadline(self, sql_query: str, deadline: Deadline) -> QueryResult:
+        timeout = deadline.timeout("sql_execution", CHAT_RESERVE_SECONDS)
+        return await self._astage("sql_execution", deadline, asyncio.to_thread(
+            self.db_manager.execute_query, sql_query, timeout=timeout), reserve=CHAT_RESERVE_SECONDS)
+
+    def _stream_with_deadline(self, chunks: Iterator[str], deadline: Deadline) -> Iterator[str]:
+        """
+        Yields the chunks of a stream that is consumed on a stream worker, waiting for the
+        first one at most the chat_first_token timeout and for the others at most the
+        remaining time. The stream is closed when the consumer stops early.
+        Raises:
+            DeadlineExceeded: If the next chunk did not arrive in time.
+        """
+        queue = Queue()
+        stopped = threading.Event()
+        end = object()
+
+        def produce():
+            try:
+                for chunk in chunks:
+                    if stopped.is_set():
+                        break
+                    queue.put(chunk)
             except Exception as e:
-                exception_message = str(e)
-                print(f"SQL execution failed: {exception_message}")
-                if attempt == max_retries - 1:
-                    print("Max retries reached for SQL query generation/execution.")
-                    # If all retries fail, return an error message to the user
-                    return "I apologize, but I encountered an issue while trying to retrieve that information. Please try rephrasing your question."
-        
-        formatted_chat_history = ""
-        for message in self.chat_history:
-            formatted_chat_history += f"{message['role'].capitalize()}: {message['content']}\n"
-
-        # Step 4: Generate conversational response
-        final_answer = self.llm_service.generate_chat_response(
-                question = user_question, 
-                data = db_results,
-                chat_history=formatted_chat_history
-        )
-        self.chat_history.append({"role": "ai", "content": final_answer})
+                queue.put(e)
+            finally:
+                chunks.close()
+                queue.put(end)
+
+        self.stream_executor.submit(produce)
+        stage = "chat_first_token"
+        try:
+            while True:
+                try:
+                    item = queue.get(timeout=deadline.timeout(stage))
+                except Empty:
+                    raise DeadlineExceeded(stage) from None
+                if item is end:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                stage = "chat_generation"
+                yield item
+        finally:
+            stopped.set()
+
+    async def _astream_with_deadline(self, chunks: AsyncIterator[str], deadline: Deadline) -> AsyncIterator[str]:
+        """Async variant of `_stream_with_deadline`; the stream is cancelled at the deadline."""
+        iterator = chunks.__aiter__()
+        stage = "chat_first_token"
+        try:
+            while True:
+                next_chunk = asyncio.ensure_future(iterator.__anext__())
+                done, _ = await asyncio.wait({next_chunk}, timeout=deadline.timeout(stage))
+                if not done:
+                    next_chunk.cancel()
+                    await asyncio.wait({next_chunk}) # The generator must stop running before it is closed
+                    raise DeadlineExceeded(stage)
+                try:
+                    chunk = next_chunk.result()
+                except StopAsyncIteration:
+                    return
+                stage = "chat_generation"
+                yield chunk
+        finally:
+            await iterator.aclose()
+
+    def _deadline_answer(self, error: DeadlineExceeded, partial_answer: str, db_results: List[Any]) -> str:
+        """
+        The text that ends an answer cut short by the deadline: an apology after the part
+        already streamed, otherwise the first rows found, otherwise a plain apology.
+        """
+        print(f"\n{error} Answering with what is available.")
+        self.metrics.increment("deadline_exceeded", stage=error.stage)
+        if partial_answer:
+            return DEADLINE_CUTOFF_SUFFIX.lstrip() if partial_answer[-1].isspace() else DEADLINE_CUTOFF_SUFFIX
+        if db_results:
+            rows = [" ".join(format_value(value) for value in row if value is not None)
+                    for row in db_results[:DEADLINE_DATA_ROWS]]
+            return DEADLINE_DATA_PREFIX + "; ".join(rows) + "."
+        return DEADLINE_ANSWER
+
+    def _start_warmup(self, awaitable: Any, name: str) -> asyncio.Task:
+        """Runs a warmup in the background. No request waits for it, so a failure is only logged."""
+        async def warmup():
+            try:
+                await awaitable
+            except Exception as e:
+                print(f"{name} warmup failed: {e}")
+        task = asyncio.ensure_future(warmup())
+        self._warmup_tasks.add(task)
+        task.add_done_callback(self._warmup_tasks.discard)
+        return task
+
+    def _record_cached_answer(self, session: ConciergeSession, cached_answer: str, request_start: float):
+        session.chat_history.append({"role": "ai", "content": cached_answer})
+        session.last_answer_metadata = {"cached": True}
+        print(f"Final Answer: {cached_answer}")
+        self.metrics.increment("requests", outcome="cached")
+        self.metrics.observe("first_token", time.perf_counter() - request_start)
+
+    def _answer_cache_scope(self, session: ConciergeSession, user_question: str) -> Dict[str, Any]:
+        """
+        What an answer to the question may be shared with: questions naming the same slot values,
+        and only this session when the answer is written with its chat history.
+        """
+        return {"slots": self.template_engine.extract_slots(user_question),
+                "session_id": session.session_id if len(session.chat_history) else None}
+
+    def _promote_learned_example(self, user_question: str, sql_query: str, question_embedding: Any,
+                                 similar_questions_results: List[Any]):
+        """
+        Stores generated SQL that answered the question as a learned example, once it passes the
+        SQL validator, has answered the question LEARN_AFTER_SUCCESSES times and no other example
+        lies within LEARNED_EXAMPLE_MIN_DISTANCE of the question.
+        """
+        if self.sql_validator.validate(sql_query):
+            return
+        key = self.redis_store.learned_key(user_question)
+        closest = next((result for result in similar_questions_results if result.id != key), None)
+        if closest is not None and float(closest.score) < LEARNED_EXAMPLE_MIN_DISTANCE:
+            return
+        if self.redis_store.record_learning_candidate(user_question, sql_query) >= LEARN_AFTER_SUCCESSES:
+            self.redis_store.add_learned_example(user_question, sql_query, question_embedding)
+
+    def _reusable_sql(self, user_question: str, similar_questions_results: List[Any]) -> str | None:
+        """
+        Returns the stored query of the closest example when it can answer the question without
+        SQL generation. Queries with slots are re-bound to the values in the question; others must
+        be a near-identical match.
+        """
+        closest = similar_questions_results[0] if similar_questions_results else None
+        reusable_sql = None
+        if closest is not None and float(closest.score) <= TEMPLATE_MAX_DISTANCE:
+            if self.template_engine.template_for(closest.business_query).slots:
+                reusable_sql = self.template_engine.bind(user_question, closest.business_query, closest.business_question)
+            elif float(closest.score) <= SQL_CACHE_MAX_DISTANCE:
+                reusable_sql = closest.business_query
+        if reusable_sql:
+            print(f"Reusing stored SQL of '{closest.business_question}': {reusable_sql}")
+        return reusable_sql
+
+    def _finish_answer(self, session: ConciergeSession, user_question: str, question_embedding: Any,
+                       sql_query: str | None, final_answer: str, request_start: float, answer_scope: Dict[str, Any],
+                       deadline_stage: str = None):
+        """
+        Records a streamed answer in the session, the answer cache and the metrics. `sql_query`
+        is None when no query succeeded; `answer_scope` comes from `_answer_cache_scope`;
+        `deadline_stage` is the stage that ran out of time when the answer was cut short, which
+        keeps it out of the answer cache.
+        """
+        session.chat_history.append({"role": "ai", "content": final_answer})
+        tables = extract_table_names(sql_query) if sql_query else []
+        session.last_answer_metadata = {"sql": sql_query, "tables": tables}
+        if deadline_stage:
+            session.last_answer_metadata["deadline_exceeded"] = deadline_stage
+        if self.materializer is not None:
+            session.last_answer_metadata["aggregates"] = self.materializer.staleness(tables)
+            tables = self.materializer.sources_of(tables) # Invalidate with the tables the aggregates read
+        if sql_query and not deadline_stage:
+            self.answer_cache.put(user_question, question_embedding, final_answer, tables, **answer_scope)
+        outcome = "partial" if deadline_stage else "answered" if sql_query else "unanswered"
+        self.metrics.increment("requests", outcome=outcome)
+        self.metrics.observe("total", time.perf_counter() - request_start)
         print(f"Final Answer: {final_answer}")
-        return final_answer
 
 # --- Entry Point for Backend Service (Example Usage) ---
 if __name__ == "__main__":
@@ -658,4 +3808,6 @@ if __name__ == "__main__":
         response = app.process_user_question(user_input)
         print(f"Concierge: {response}")
 
+    print(json.dumps(app.metrics_summary(), indent=2))
+
 